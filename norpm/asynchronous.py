@@ -0,0 +1,115 @@
+"""
+asyncio entry points for the specfile expansion.
+
+The expansion itself is synchronous (CPU bound), so these methods either
+drive the specfile_expand_generator() pipeline and give the control back to
+the event loop every YIELD_EVERY expanded parts, or run the whole expansion in
+an executor.
+
+The changes done to the macro registry are kept only if the expansion
+finishes; if the task is cancelled (or the async generator is closed before
+it is exhausted, or an exception is raised), the registry is rolled back to
+the original state.
+"""
+
+import asyncio
+import threading
+
+from norpm.budget import ExpansionBudget
+from norpm.specfile import _SpecContext, _specfile_expand_generator
+
+
+YIELD_EVERY = 64
+
+
+async def specfile_expand_async_generator(content, macros, hooks=None,
+                                          budget=None,
+                                          yield_every=YIELD_EVERY):
+    """
+    Async generator variant of specfile_expand_generator().  Yield the
+    expanded parts of the specfile CONTENT, and let the other tasks run every
+    YIELD_EVERY parts.
+    """
+    context = _SpecContext(hooks, budget).start()
+    token = macros.checkpoint()
+    try:
+        generator = _specfile_expand_generator(context, content, macros)
+        for count, part in enumerate(generator, start=1):
+            yield part
+            if count % yield_every == 0:
+                await asyncio.sleep(0)
+    except BaseException:
+        macros.rollback(token)
+        raise
+    macros.commit(token)
+
+
+class _Cancelled(Exception):
+    """Raised in the executor thread once the awaiting task is cancelled"""
+
+
+class _CancellableBudget(ExpansionBudget):
+    """ExpansionBudget copying the limits of BUDGET, checking for
+    cancellation on each expansion step."""
+    def __init__(self, budget):
+        budget = budget or ExpansionBudget()
+        super().__init__(budget.max_steps, budget.max_output,
+                         budget.max_depth, budget.max_time)
+        self.cancelled = threading.Event()
+
+    def step(self, depth):
+        if self.cancelled.is_set():
+            raise _Cancelled()
+        super().step(depth)
+
+
+def _expand(content, macros, hooks, budget):
+    context = _SpecContext(hooks, budget).start()
+    return "".join(_specfile_expand_generator(context, content, macros))
+
+
+async def specfile_expand_async(content, macros, hooks=None, budget=None,
+                                yield_every=YIELD_EVERY, executor=None):
+    """
+    Async variant of specfile_expand().  By default, the expansion runs in
+    the event loop thread and yields the control every YIELD_EVERY expanded
+    parts.  With EXECUTOR (concurrent.futures.Executor, or True for the
+    loop's default executor), the expansion is done there instead, which
+    suits large (CPU heavy) specfiles.  The executor must run in the same
+    process (threads), and the MACROS must not be used by anyone else until
+    this finishes.
+    """
+    if executor is None:
+        parts = []
+        async for part in specfile_expand_async_generator(
+                content, macros, hooks, budget, yield_every):
+            parts.append(part)
+        return "".join(parts)
+
+    cancellable = _CancellableBudget(budget)
+    loop = asyncio.get_running_loop()
+    token = macros.checkpoint()
+    future = loop.run_in_executor(
+        None if executor is True else executor,
+        _expand, content, macros, hooks, cancellable)
+    try:
+        result = await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # Stop the thread, and wait till it stops touching the registry.
+        cancellable.cancelled.set()
+        await asyncio.wait([future])
+        if not future.cancelled():
+            future.exception()
+        macros.rollback(token)
+        raise
+    except BaseException:
+        macros.rollback(token)
+        raise
+    finally:
+        if budget:
+            budget.steps = cancellable.steps
+            budget.output = cancellable.output
+            budget.depth = cancellable.depth
+            budget.started = cancellable.started
+    macros.commit(token)
+    return result
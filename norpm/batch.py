@@ -0,0 +1,590 @@
+"""
+Batch expansion of many specfiles, in parallel worker processes.
+
+Each worker builds the macro registry once, and expands the specfiles one by
+one; changes done by one specfile are reverted using the
+MacroRegistry.checkpoint() and rollback() methods (instead of deepcopy).
+
+Alternatively, the fork-server variant (forkserver_expand) loads the registry
+once in the parent process, and forks a short-lived child per (small batch of)
+specfile; the isolation is then provided by the copy-on-write memory pages.
+"""
+
+from collections import deque
+from dataclasses import dataclass
+import gc
+import glob
+import hashlib
+import itertools
+import multiprocessing
+import os
+import pickle
+import resource
+import selectors
+import signal
+import time
+
+from norpm.cache import code_version, default_cache
+from norpm.exceptions import NorpmResourceError
+from norpm.macrofile import system_macro_registry
+from norpm.overrides import override_macro_registry
+from norpm.scheduling import schedule
+from norpm.specfile import specfile_expand, ParserHooks
+
+
+@dataclass(frozen=True)
+class RegistryConfig:
+    """
+    Recipe for building the MacroRegistry in worker processes.  ARCH and
+    PREFIX are passed down to system_macro_registry(), OVERRIDES is a
+    (filename, tag) pair for override_macro_registry(), DEFINES is a list of
+    additional (name, value) definitions.
+    """
+    arch: str = None
+    prefix: str = None
+    overrides: tuple = None
+    defines: tuple = ()
+
+    def build(self):
+        """Create the MacroRegistry according to this config."""
+        registry = system_macro_registry(self.arch, self.prefix)
+        registry["dist"] = ""
+        registry.known_norpm_hacks()
+        if self.overrides:
+            registry = override_macro_registry(registry, *self.overrides)
+        for name, value in self.defines:
+            registry.clear(name)
+            registry.define(name, value)
+        return registry
+
+
+@dataclass(frozen=True)
+class ResourceLimits:
+    """
+    Limits of the worker processes, see forkserver_expand().  MEMORY is the
+    address space limit in bytes, CPU is the CPU time per specfile in seconds
+    (enforced by RLIMIT_CPU, with the one second granularity), and WALL is
+    the wall-clock time per specfile after which the worker is killed by the
+    watchdog.  None means unlimited.
+    """
+    memory: int = None
+    cpu: float = None
+    wall: float = None
+
+    def apply(self):
+        """Set the process-wide limits, in the worker process."""
+        if self.memory:
+            resource.setrlimit(resource.RLIMIT_AS,
+                               (self.memory, self.memory))
+
+    def start_spec(self):
+        """Give the next specfile its own CPU time allowance."""
+        if not self.cpu:
+            return
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        soft = int(usage.ru_utime + usage.ru_stime + self.cpu) + 1
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+# Exit status of the forkserver_expand() child that wants to be recycled.
+_RECYCLE_STATUS = 75
+
+
+def _resource_error(limit):
+    return f"{NorpmResourceError.__name__}: {limit} limit exceeded"
+
+
+def _is_resource_failure(result):
+    error = result["error"]
+    return bool(error) and \
+        error.startswith(f"{NorpmResourceError.__name__}: ")
+
+
+class _TagHooks(ParserHooks):
+    """
+    Gather the tag values, all of them or just the WANTED ones.  With
+    TRACK_READS, gather the macros read by the specfile, too.
+    """
+    def __init__(self, wanted=None, track_reads=False):
+        self.wanted = wanted
+        self.tags = {}
+        self.track_reads = track_reads
+        self.reads = None
+
+    def tag_found(self, name, value, _tag_raw):
+        if self.wanted and name not in self.wanted:
+            return
+        self.tags.setdefault(name, []).append(value)
+
+    def spec_reads(self, reads):
+        self.reads = {name: sorted(versions, key=str)
+                      for name, versions in sorted(reads.items())}
+
+
+def expand_spec(name, content, registry, tags=None, budget=None, cache=None,
+                reads=False):
+    """
+    Expand the specfile CONTENT using REGISTRY, and return the result
+    dictionary with the "spec" NAME, gathered "tags" (all of them, or just
+    those listed in TAGS), "error" (None or a string) and "time" in seconds.
+    The "cpu" item is the CPU time in seconds, and "max_rss" is the peak
+    resident set size of the process during this expansion (KiB; None if the
+    peak can't be reset per specfile, see _reset_peak_rss()).  The "cached"
+    item is
+    set to True if the result was served from the CACHE.
+    The REGISTRY is left unchanged.  The optional CACHE is a ResultCache, see
+    specfile_expand().  With READS, the result has also the "reads" item,
+    {macro name: list of definition versions} (see ParserHooks.tag_reads()),
+    or None if the expansion failed.
+    """
+    token = registry.checkpoint()
+    try:
+        return _expand_spec(name, content, registry, tags, budget, cache,
+                            reads)
+    finally:
+        registry.rollback(token)
+
+
+def _reset_peak_rss():
+    """
+    Reset the peak RSS of this process to the current RSS, so _peak_rss()
+    measures the following code only.  Return False if not supported (only
+    Linux 4.0+ allows this, through /proc/self/clear_refs).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as fd:
+            fd.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def _peak_rss():
+    """The peak RSS of this process (KiB), since the last _reset_peak_rss()."""
+    with open("/proc/self/status", "r", encoding="ascii") as fd:
+        for line in fd:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return None
+
+
+def _expand_spec(name, content, registry, tags, budget, cache=None,
+                 reads=False):
+    """expand_spec() without reverting the REGISTRY changes"""
+    hooks = _TagHooks(tags, reads)
+    error = None
+    start = time.monotonic()
+    cpu_start = time.process_time()
+    if cache is None:
+        cache = default_cache()
+    hits = cache.hits if cache else None
+    peak_reset = _reset_peak_rss()
+    try:
+        if cache:
+            cache.expand(content, registry, hooks, budget, text=False)
+        else:
+            specfile_expand(content, registry, hooks, budget=budget,
+                            cache=False)
+    except MemoryError:
+        error = _resource_error("memory")
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        error = f"{type(exc).__name__}: {exc}"
+    result = {
+        "spec": name,
+        "tags": hooks.tags,
+        "error": error,
+        "time": round(time.monotonic() - start, 6),
+        "cpu": round(time.process_time() - cpu_start, 6),
+        "max_rss": _peak_rss() if peak_reset else None,
+    }
+    if cache and cache.hits != hits:
+        result["cached"] = True
+    if reads:
+        result["reads"] = hooks.reads
+    return result
+
+
+def content_digest(content):
+    """The digest identifying the specfile CONTENT (e.g., in the indexes)."""
+    return hashlib.sha256(
+        content.encode("utf-8", errors="surrogateescape")).hexdigest()
+
+
+def run_settings(registry, tags=None, budget=None):
+    """
+    Everything but the specfile content the expand_spec() results depend on;
+    the REGISTRY fingerprint and target, the TAGS gathered, the BUDGET limits
+    and the norpm code version.  Return a JSON-serializable dictionary.
+    """
+    return {
+        "fingerprint": registry.fingerprint(),
+        "target": registry.target,
+        "tags": sorted(tags) if tags else None,
+        "budget": None if budget is None else [
+            budget.max_steps, budget.max_output, budget.max_depth,
+            budget.max_time],
+        "version": code_version(),
+    }
+
+
+def list_specfiles(paths):
+    """
+    Generator yielding the specfile names for the given PATHS.  Each path is
+    either a specfile, or a directory with *.spec files.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(glob.glob(os.path.join(path, "*.spec")))
+        else:
+            yield path
+
+
+def read_specfile(filename):
+    """Read the specfile content."""
+    with open(filename, "r", encoding="utf8", errors="replace") as fd:
+        return fd.read()
+
+
+def read_specfiles(paths):
+    """
+    Generator yielding (name, content) pairs for the given PATHS, see
+    list_specfiles().
+    """
+    for filename in list_specfiles(paths):
+        yield filename, read_specfile(filename)
+
+
+# Per-process state of the pool workers.
+_WORKER = {}
+
+
+def _init_worker(config, tags, budget, cache, reads=False):
+    _WORKER["registry"] = config.build()
+    _WORKER["tags"] = tags
+    _WORKER["budget"] = budget
+    _WORKER["cache"] = cache
+    _WORKER["reads"] = reads
+
+
+def _expand_in_worker(item):
+    name, content = item
+    return expand_spec(name, content, _WORKER["registry"], _WORKER["tags"],
+                       _WORKER["budget"], _WORKER["cache"], _WORKER["reads"])
+
+
+def _expand_batch_in_worker(batch):
+    return [_expand_in_worker(item) for item in batch]
+
+
+# The number of specfiles ordered by _schedule() at once.
+SCHEDULE_WINDOW = 4096
+
+
+def _schedule(specs, timings, processes, max_batch=None, window=None):
+    """
+    Order the SPECS into batches according to the TIMINGS (TimingHistory),
+    see norpm.scheduling.schedule().  The SPECS stream is consumed lazily,
+    WINDOW (SCHEDULE_WINDOW by default) specfiles at a time, each window
+    scheduled separately.  Return the iterator over the batches, and the
+    {name: (digest, size)} dictionary for _record_timings() (filled as the
+    windows are read).
+    """
+    contents = {}
+    window = window or SCHEDULE_WINDOW
+
+    def _batches():
+        items = iter(specs)
+        while True:
+            chunk = list(itertools.islice(items, window))
+            if not chunk:
+                return
+            for name, content in chunk:
+                contents[name] = (content_digest(content), len(content))
+            estimates = [timings.estimate(name, *contents[name])
+                         for name, _ in chunk]
+            yield from schedule(chunk, estimates, processes or os.cpu_count(),
+                                max_batch)
+
+    return _batches(), contents
+
+
+def _record_timings(results, timings, contents):
+    for result in results:
+        name = result["spec"]
+        digest, size = contents.pop(name, (None, None))
+        if result.get("cached"):
+            # the cache hit time says nothing about the expansion time
+            yield result
+            continue
+        timings.record(name, digest, result["time"], size)
+        yield result
+
+
+def batch_expand(specs, config=None, processes=None, ordered=False,
+                 tags=None, budget=None, chunksize=1, cache=None,
+                 reads=False, timings=None, limits=None):
+    """
+    Expand the SPECS, an iterable of (name, content) pairs, see
+    read_specfiles().  Yield the result dictionaries (see expand_spec()) in
+    the completion order, or in the input order if ORDERED is True.
+
+    The CONFIG is a RegistryConfig, PROCESSES is the number of worker
+    processes (defaults to the number of CPUs, 1 means no pool at all), TAGS
+    limits the gathered tags and BUDGET is an optional ExpansionBudget applied
+    to each specfile.  The CACHE is an optional ResultCache shared by the
+    workers.  With READS, the macros read by each specfile are reported.
+
+    The TIMINGS is an optional TimingHistory; the (expensive) specfiles are
+    then dispatched longest first, in batches (CHUNKSIZE is ignored), and the
+    history is updated.  The ORDERED results are not supported then.
+
+    With LIMITS (ResourceLimits), the specfiles are expanded by
+    forkserver_expand(), so the failing workers can be replaced.
+    """
+    config = config or RegistryConfig()
+    if limits is not None:
+        if ordered:
+            raise ValueError("The resource-limited results can not be "
+                             "ordered")
+        yield from forkserver_expand(specs, config, processes, tags, budget,
+                                     chunksize, cache, reads, timings, limits)
+        return
+    if timings is not None:
+        if ordered:
+            raise ValueError("The scheduled results can not be ordered")
+        batches, contents = _schedule(specs, timings, processes)
+        yield from _record_timings(_expand_batches(
+            batches, config, processes, (config, tags, budget, cache, reads)),
+            timings, contents)
+        return
+
+    if processes == 1:
+        registry = config.build()
+        for name, content in specs:
+            yield expand_spec(name, content, registry, tags, budget, cache,
+                              reads)
+        return
+
+    initargs = (config, tags, budget, cache, reads)
+    with multiprocessing.Pool(processes, initializer=_init_worker,
+                              initargs=initargs) as pool:
+        mapper = pool.imap if ordered else pool.imap_unordered
+        yield from mapper(_expand_in_worker, specs, chunksize)
+
+
+def _expand_batches(batches, config, processes, initargs):
+    """Expand the BATCHES in the order given, see batch_expand()."""
+    if processes == 1:
+        _init_worker(*initargs)
+        for batch in batches:
+            yield from _expand_batch_in_worker(batch)
+        return
+    with multiprocessing.Pool(processes, initializer=_init_worker,
+                              initargs=initargs) as pool:
+        for results in pool.imap_unordered(_expand_batch_in_worker, batches):
+            yield from results
+
+
+class _Child:
+    """A running forkserver_expand() child."""
+    def __init__(self, pid, batch, wall):
+        self.pid = pid
+        self.batch = batch
+        self.chunks = []
+        self.killed = None
+        self.deadline = None
+        self.progress(wall)
+
+    def progress(self, wall):
+        """The child sent some results, restart the WALL time watchdog."""
+        if wall:
+            self.deadline = time.monotonic() + wall
+
+
+def _batches(specs, batch_size):
+    batch = []
+    for item in specs:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _fork_child(batch, registry, tags, budget, cache, reads=False,
+                limits=None):
+    """
+    Fork a child expanding the BATCH, return (pid, read_fd) pair.  The child
+    sends the pickled results through the pipe, one length-prefixed frame per
+    specfile as soon as it is expanded.  With LIMITS, the child applies them,
+    and exits (to be recycled) after the first resource failure.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(write_fd)
+        return pid, read_fd
+
+    # child
+    status = 1
+    try:
+        os.close(read_fd)
+        if limits:
+            limits.apply()
+        with os.fdopen(write_fd, "wb") as fd:
+            for name, content in batch:
+                if limits:
+                    limits.start_spec()
+                # the specfiles in one batch must not see each other's
+                # definitions, roll back the registry after each one
+                result = expand_spec(name, content, registry, tags, budget,
+                                     cache, reads)
+                data = pickle.dumps(result)
+                fd.write(len(data).to_bytes(8, "big") + data)
+                fd.flush()
+                if _is_resource_failure(result):
+                    status = _RECYCLE_STATUS
+                    break
+            else:
+                status = 0
+    finally:
+        os._exit(status)  # pylint: disable=protected-access
+
+
+def _failed_result(name, error):
+    return {
+        "spec": name,
+        "tags": {},
+        "error": error,
+        "time": None,
+        "cpu": None,
+        "max_rss": None,
+    }
+
+
+def _collect_child(pid, batch, data, killed=None):
+    """
+    Wait for the child PID, and return the (results, unfinished) pair for the
+    BATCH.  If the child failed, the specfile it was expanding is reported as
+    failed (KILLED is the reason, if the child was killed by the watchdog),
+    and the rest of the BATCH is returned as unfinished.
+    """
+    results = []
+    while len(data) >= 8:
+        size = int.from_bytes(data[:8], "big")
+        if len(data) < 8 + size:
+            break
+        results.append(pickle.loads(data[8:8+size]))
+        data = data[8+size:]
+
+    _, status = os.waitpid(pid, 0)
+    status = os.waitstatus_to_exitcode(status)
+    done = len(results)
+    if status == 0 and done == len(batch):
+        return results, []
+    if status != _RECYCLE_STATUS and done < len(batch):
+        if killed:
+            error = _resource_error(killed)
+        elif status == -signal.SIGXCPU:
+            error = _resource_error("CPU time")
+        else:
+            error = f"Worker process failed with exit status {status}"
+        results.append(_failed_result(batch[done][0], error))
+        done += 1
+    return results, batch[done:]
+
+
+def forkserver_expand(specs, config=None, processes=None, tags=None,
+                      budget=None, batch_size=1, cache=None, reads=False,
+                      timings=None, limits=None):
+    """
+    Same as batch_expand(), but the registry is built only once in this
+    process, and a child process is forked for each BATCH_SIZE specfiles.
+    Children don't need to revert the registry changes, and the registry
+    memory is shared with the parent (copy-on-write).  Results are yielded in
+    the completion order.  With TIMINGS, the batches are scheduled as in
+    batch_expand(), each having up to BATCH_SIZE specfiles.
+
+    The LIMITS (ResourceLimits) are applied to the children.  The specfile
+    exceeding them is reported as failed (NorpmResourceError), and the rest
+    of its batch is expanded by a new child.
+    """
+    config = config or RegistryConfig()
+    processes = processes or os.cpu_count()
+    options = (tags, budget, cache, reads, limits)
+    if timings is not None:
+        batches, contents = _schedule(specs, timings, processes, batch_size)
+        yield from _record_timings(_forkserver_expand(
+            batches, config, processes, options), timings, contents)
+        return
+    yield from _forkserver_expand(_batches(specs, batch_size), config,
+                                  processes, options)
+
+
+def _forkserver_expand(batches, config, processes, options):
+    registry = config.build()
+    limits = options[-1]
+    wall = limits.wall if limits else None
+
+    # Move the registry objects to the permanent generation, so the garbage
+    # collector in children doesn't touch (and copy) their memory pages.
+    gc.collect()
+    gc.freeze()
+
+    running = {}
+    unfinished = deque()
+    try:
+        with selectors.DefaultSelector() as selector:
+            while True:
+                while len(running) < processes:
+                    if unfinished:
+                        batch = unfinished.popleft()
+                    else:
+                        batch = next(batches, None)
+                    if batch is None:
+                        break
+                    pid, read_fd = _fork_child(batch, registry, *options)
+                    running[read_fd] = _Child(pid, batch, wall)
+                    selector.register(read_fd, selectors.EVENT_READ)
+
+                if not running:
+                    break
+
+                timeout = None
+                if wall:
+                    timeout = max(0, min(child.deadline for child
+                                         in running.values()) - time.monotonic())
+                for key, _ in selector.select(timeout):
+                    child = running[key.fd]
+                    chunk = os.read(key.fd, 1 << 16)
+                    if chunk:
+                        child.chunks.append(chunk)
+                        child.progress(wall)
+                        continue
+                    selector.unregister(key.fd)
+                    os.close(key.fd)
+                    del running[key.fd]
+                    results, rest = _collect_child(
+                        child.pid, child.batch, b"".join(child.chunks),
+                        child.killed)
+                    if rest:
+                        unfinished.append(rest)
+                    yield from results
+
+                # the watchdog
+                now = time.monotonic()
+                for child in running.values():
+                    if wall and not child.killed and child.deadline <= now:
+                        os.kill(child.pid, signal.SIGKILL)
+                        child.killed = "wall time"
+    finally:
+        for read_fd, child in running.items():
+            os.close(read_fd)
+            if not child.killed:
+                os.kill(child.pid, signal.SIGKILL)
+            os.waitpid(child.pid, 0)
+        gc.unfreeze()
@@ -0,0 +1,90 @@
+"""
+Expansion budgets, limiting the work done when expanding a single specfile.
+"""
+
+import time
+
+from norpm.exceptions import NorpmBudgetError
+
+
+class ExpansionBudget:
+    """
+    Limits for the expansion engine.  Any limit set to None is unlimited.
+
+    max_steps : int
+        Maximum number of snippets (macro calls and text parts) processed.
+    max_output : int
+        Maximum number of characters produced by the expansion engine, counting
+        also the intermediate (nested) expansions, e.g., macro parameters.
+    max_depth : int
+        Maximum depth of the nested expansions.
+    max_time : float
+        Maximum wall-clock time, in seconds.
+
+    The budget object also gathers statistics, see stats().  Counters are
+    reset by start(), which is called by every entrypoint in norpm.specfile,
+    so one budget object applies to one specfile_expand() call.
+    """
+
+    # Checking the clock on every step would be too expensive.
+    TIME_CHECK_INTERVAL = 256
+
+    def __init__(self, max_steps=None, max_output=None, max_depth=None,
+                 max_time=None):
+        self.max_steps = max_steps
+        self.max_output = max_output
+        self.max_depth = max_depth
+        self.max_time = max_time
+        self.steps = 0
+        self.output = 0
+        self.depth = 0
+        self.started = time.monotonic()
+
+    def start(self):
+        """Reset the counters and the clock."""
+        self.steps = 0
+        self.output = 0
+        self.depth = 0
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self):
+        """Seconds elapsed since start()."""
+        return time.monotonic() - self.started
+
+    def stats(self):
+        """Return the (partial) statistics as a serializable dictionary."""
+        return {
+            "steps": self.steps,
+            "output": self.output,
+            "depth": self.depth,
+            "time": self.elapsed,
+        }
+
+    def _exceeded(self, what, limit):
+        raise NorpmBudgetError(
+            f"Expansion budget exceeded: {what} > {limit}", self.stats())
+
+    def step(self, depth):
+        """Account one expansion step, done in the given DEPTH."""
+        self.steps += 1
+        self.depth = max(self.depth, depth)
+        if self.max_steps is not None and self.steps > self.max_steps:
+            self._exceeded("steps", self.max_steps)
+        if self.max_depth is not None and depth > self.max_depth:
+            self._exceeded("depth", self.max_depth)
+        if self.max_time is not None \
+                and self.steps % self.TIME_CHECK_INTERVAL == 0 \
+                and self.elapsed > self.max_time:
+            self._exceeded("time", self.max_time)
+
+    def reserve(self, size):
+        """Raise NorpmBudgetError if producing SIZE more characters would
+        exceed the output limit."""
+        if self.max_output is not None and self.output + size > self.max_output:
+            self._exceeded("output", self.max_output)
+
+    def produced(self, size):
+        """Account SIZE characters of output."""
+        self.reserve(size)
+        self.output += size
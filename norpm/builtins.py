@@ -27,6 +27,12 @@ class _Builtin:
         """evaluate the builtin, return the expanded value"""
         raise NotImplementedError
 
+    @classmethod
+    def output_size(cls, params):
+        """Estimate the size of the output before calling eval(), for builtins
+        that may produce large outputs.  None if not known."""
+        return None
+
 
 class _BuiltinBasename(_Builtin):
     @classmethod
@@ -129,6 +135,13 @@ class _BuiltinRep(_Builtin):
         """
         return ''.join(params[0] for _ in range(int(params[1])))
 
+    @classmethod
+    def output_size(cls, params):
+        try:
+            return len(params[0]) * int(params[1])
+        except (IndexError, ValueError):
+            return None
+
 
 class _BuiltinReverse(_Builtin):
     """
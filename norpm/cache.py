@@ -0,0 +1,339 @@
+"""
+Content-addressed on-disk cache of the specfile expansion results.
+
+The result of specfile_expand() only depends on the specfile content, on the
+macro registry state, and on the norpm implementation; so these three are
+hashed into the cache key.  Only the macros the specfile actually read (or
+changed) are considered, see ParserHooks.track_reads; the sets of their names
+are stored per specfile content ("variants"), and tried on lookup.  So an
+unrelated registry change (e.g., a new macro file) doesn't invalidate the
+cached results.  The cached value contains the tag hook calls,
+the registry changes done by the specfile (e.g., %name, or %global
+definitions), the expansion error (NorpmError, except for the budget errors),
+and optionally the expanded text.  On a cache hit, all of them are
+replayed.
+
+The entries are stored in an SQLite database, and the least recently used
+entries are evicted when the database grows over `max_size` bytes.  Note
+that the %(shell) expansions are assumed to be deterministic.
+"""
+
+import hashlib
+from importlib.metadata import version, PackageNotFoundError
+import os
+import pickle
+import sqlite3
+import time
+import zlib
+
+from norpm.exceptions import NorpmBudgetError, NorpmError
+from norpm.specfile import ParserHooks, _reports_conditions, specfile_expand
+
+# Environment variable with the default cache database path.
+CACHE_ENV = "NORPM_CACHE"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    atime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime);
+CREATE TABLE IF NOT EXISTS variants (
+    content TEXT NOT NULL,
+    names TEXT NOT NULL,
+    atime REAL NOT NULL,
+    PRIMARY KEY (content, names)
+);
+"""
+
+# The macro names of variants matching the whole registry.
+_ALL_NAMES = "*"
+
+_CODE_VERSION = None
+
+
+def code_version():
+    """
+    Identify the norpm implementation; the package version plus the digest of
+    its Python sources (so the development trees are covered, too).
+    """
+    global _CODE_VERSION  # pylint: disable=global-statement
+    if _CODE_VERSION is None:
+        digest = hashlib.sha256()
+        topdir = os.path.dirname(os.path.abspath(__file__))
+        for subdir, _, files in sorted(os.walk(topdir)):
+            for filename in sorted(files):
+                if not filename.endswith(".py"):
+                    continue
+                digest.update(filename.encode("utf-8"))
+                with open(os.path.join(subdir, filename), "rb") as fd:
+                    digest.update(fd.read())
+        try:
+            package = version("norpm")
+        except PackageNotFoundError:
+            package = "devel"
+        _CODE_VERSION = f"{package}+{digest.hexdigest()[:16]}"
+    return _CODE_VERSION
+
+
+class _RecordingHooks(ParserHooks):
+    """Pass the tag hook calls to HOOKS, and record them for the cache."""
+    track_reads = True
+
+    def __init__(self, hooks):
+        self.hooks = hooks
+        self.calls = []
+        self.reads = None
+
+    def tag_found(self, name, value, tag_raw):
+        self.calls.append(("tag_found", (name, value, tag_raw)))
+        self.hooks.tag_found(name, value, tag_raw)
+
+    def tag_conditions(self, name, condition_strings):
+        self.calls.append(("tag_conditions", (name, list(condition_strings))))
+        self.hooks.tag_conditions(name, condition_strings)
+
+    def tag_predicates(self, name, value, conditions):
+        self.calls.append(("tag_predicates", (name, value, list(conditions))))
+        self.hooks.tag_predicates(name, value, conditions)
+
+    def tag_reads(self, name, value, reads):
+        self.calls.append(("tag_reads", (name, value, reads)))
+        if self.hooks.track_reads:
+            self.hooks.tag_reads(name, value, reads)
+
+    def spec_reads(self, reads):
+        self.calls.append(("spec_reads", (reads,)))
+        self.reads = reads
+        if self.hooks.track_reads:
+            self.hooks.spec_reads(reads)
+
+
+def _replay(hooks, calls):
+    for method, args in calls:
+        if method in ("tag_reads", "spec_reads") and not hooks.track_reads:
+            continue
+        getattr(hooks, method)(*args)
+
+
+def _registry_changes(macros, journal):
+    """The final definitions of the macros changed in the JOURNAL."""
+    changes = {}
+    for _, name, _ in journal:
+        if name in changes:
+            continue
+        if name in macros.db:
+            changes[name] = [(d.value, d.params, sorted(d.modifiers or ()))
+                             for d in macros.db[name].stack]
+        else:
+            changes[name] = None
+    return changes
+
+
+def _apply_changes(macros, changes):
+    for name, stack in changes.items():
+        macros.clear(name)
+        for value, params, modifiers in stack or ():
+            macros.define(name, (value, params, set(modifiers)), special=True)
+
+
+class ResultCache:
+    """
+    The cache database in PATH, see the module docstring.  MAX_SIZE limits
+    the size of the stored values (in bytes).  STORE_TEXT=False is suitable
+    for the users interested only in tags (like norpm-batch); the expanded
+    text is not stored then, and specfile_expand() calls always miss.
+
+    The object can be shared by multiple processes (pickled, or inherited
+    by fork), each opens its own database connection.
+    """
+    # The number of the macro name sets kept per specfile content.
+    max_variants = 8
+
+    def __init__(self, path, max_size=512 * 1024 * 1024, store_text=True):
+        self.path = path
+        self.max_size = max_size
+        self.store_text = store_text
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = state["_pid"] = None
+        return state
+
+    def _connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60,
+                                         isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+            self._pid = os.getpid()
+        return self._conn
+
+    def close(self):
+        """Close the database connection (re-opened when needed)."""
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+    @staticmethod
+    def content_key(content):
+        """Identify the specfile CONTENT (and the norpm implementation)."""
+        digest = hashlib.sha256()
+        for part in [code_version(), content]:
+            digest.update(part.encode("utf-8", errors="surrogateescape"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    @classmethod
+    def key(cls, content, macros, names=None):
+        """
+        The cache key for the specfile CONTENT expanded with MACROS.  Only the
+        NAMES macros are considered, if given.
+        """
+        return cls._key(cls.content_key(content), macros, names)
+
+    @staticmethod
+    def _key(content_key, macros, names):
+        fingerprint = macros.fingerprint(names)
+        return hashlib.sha256(
+            f"{content_key} {fingerprint}".encode("utf-8")).hexdigest()
+
+    def variants(self, content_key):
+        """
+        The macro name sets (sorted tuples, or None for all the macros) the
+        cached results for the CONTENT_KEY are keyed by.
+        """
+        rows = self._connection().execute(
+            "SELECT names FROM variants WHERE content = ? ORDER BY atime DESC",
+            (content_key,)).fetchall()
+        return [None if names == _ALL_NAMES else tuple(names.split())
+                for names, in rows]
+
+    def _add_variant(self, content_key, names):
+        names = _ALL_NAMES if names is None else " ".join(sorted(names))
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT OR REPLACE INTO variants VALUES (?, ?, ?)",
+                         (content_key, names, time.time()))
+            conn.execute(
+                "DELETE FROM variants WHERE content = ? AND names NOT IN ("
+                "SELECT names FROM variants WHERE content = ? "
+                "ORDER BY atime DESC LIMIT ?)",
+                (content_key, content_key, self.max_variants))
+
+    def get(self, key):
+        """Return the cached value for KEY, or None."""
+        conn = self._connection()
+        row = conn.execute("SELECT value FROM entries WHERE key = ?",
+                           (key,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE entries SET atime = ? WHERE key = ?",
+                     (time.time(), key))
+        return pickle.loads(zlib.decompress(row[0]))
+
+    def put(self, key, value):
+        """Store the VALUE under KEY, and evict the old entries if needed."""
+        blob = zlib.compress(pickle.dumps(value))
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                         (key, blob, len(blob), time.time()))
+            total = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total <= self.max_size:
+                return
+            # evict down to 90% of the limit, to not evict on every put()
+            excess = total - self.max_size * 9 // 10
+            for old_key, size in conn.execute(
+                    "SELECT key, size FROM entries ORDER BY atime").fetchall():
+                if excess <= 0:
+                    break
+                conn.execute("DELETE FROM entries WHERE key = ?", (old_key,))
+                excess -= size
+
+    def expand(self, content, macros, hooks=None, budget=None, text=True):
+        """
+        Same as specfile_expand(CONTENT, MACROS, HOOKS, BUDGET), but consult
+        the cache first.  If TEXT is False, the expanded text isn't needed
+        (None may be returned).
+        """
+        hooks = hooks or ParserHooks()
+        if hooks.sniff_mode or _reports_conditions(hooks) or \
+                not macros.cacheable:
+            # condition_found() results or the registry reads can not be
+            # replayed
+            return specfile_expand(content, macros, hooks, budget, cache=False)
+
+        content_key = self.content_key(content)
+        for names in self.variants(content_key):
+            value = self.get(self._key(content_key, macros, names))
+            if value is not None and (value["text"] is not None or not text
+                                      or value["error"]):
+                self.hits += 1
+                _apply_changes(macros, value["changes"])
+                _replay(hooks, value["calls"])
+                if value["error"]:
+                    raise value["error"]
+                return value["text"]
+
+        self.misses += 1
+        recording = _RecordingHooks(hooks)
+        output = error = None
+        token = macros.checkpoint()
+        try:
+            output = specfile_expand(content, macros, recording, budget,
+                                     cache=False)
+        except NorpmBudgetError:
+            macros.commit(token)
+            raise
+        except NorpmError as exc:
+            error = exc
+        except BaseException:
+            macros.commit(token)
+            raise
+        journal = macros._journal[token:]  # pylint: disable=protected-access
+        changes = _registry_changes(macros, journal)
+        names = None
+        if error is None and recording.reads is not None:
+            # the reads are incomplete for the failed expansions
+            names = set(recording.reads) | set(changes)
+        # the key is computed for the original registry state
+        macros.rollback(token)
+        key = self._key(content_key, macros, names)
+        _apply_changes(macros, changes)
+        self._add_variant(content_key, names)
+        self.put(key, {
+            "text": output if self.store_text else None,
+            "error": error,
+            "changes": changes,
+            "calls": recording.calls,
+        })
+        if error:
+            raise error
+        return output
+
+
+_DEFAULT = {}
+
+
+def default_cache():
+    """
+    Return the ResultCache configured by the NORPM_CACHE environment variable
+    (database path), or None.
+    """
+    path = os.environ.get(CACHE_ENV)
+    if not path:
+        return None
+    if path not in _DEFAULT:
+        _DEFAULT[path] = ResultCache(path)
+    return _DEFAULT[path]
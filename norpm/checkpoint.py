@@ -0,0 +1,133 @@
+"""
+Durable progress of the long batch runs, see norpm.batch.
+
+The Checkpoint file is a JSON Lines file with the results of the completed
+specfiles (plus their content digests), appended as the results come, and
+flushed to disk periodically.  When the run is interrupted (crash, kill,
+reboot), it can be resumed; the specfiles with the matching content digest
+are not expanded again, and their recorded results are reported instead.
+The first line records the run settings (see run_settings()); resuming with
+different settings (e.g., another macro registry) is refused.
+"""
+
+from collections import deque
+import json
+import os
+import time
+
+from norpm.batch import content_digest
+
+
+def _load(path):
+    """
+    Read the (settings, {spec: result}) pair from the PATH file, and drop the
+    incomplete last line (if the run was killed while writing it).  The
+    SETTINGS is None if the file is empty (or doesn't exist).
+    """
+    settings = None
+    done = {}
+    try:
+        with open(path, "rb+") as fd:
+            valid = 0
+            for line in fd:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    break
+                valid += len(line)
+                if valid == len(line):
+                    settings = result.get("settings")
+                    continue
+                done[result["spec"]] = result
+            fd.truncate(valid)
+    except FileNotFoundError:
+        pass
+    return settings, done
+
+
+class Checkpoint:
+    """
+    The checkpoint file in PATH, see the module docstring.  The SETTINGS is
+    the run_settings() dictionary.  With RESUME, the results already recorded
+    in PATH are re-used (ValueError is raised if they were recorded with
+    different SETTINGS), otherwise the file is truncated.  The file is flushed
+    (and fsync()ed) after FLUSH_EVERY results, or after FLUSH_INTERVAL
+    seconds.
+
+    Use pending() to filter the specfiles, and record() for the results.
+    """
+    def __init__(self, path, settings, resume=False, flush_every=100,
+                 flush_interval=10.0):
+        # compare in the JSON form (lists instead of tuples, etc.)
+        settings = json.loads(json.dumps(settings))
+        recorded, self.done = _load(path) if resume else (None, {})
+        if self.done and recorded != settings:
+            raise ValueError(f"The checkpoint {path} was recorded with "
+                             "different settings (macro registry, target, "
+                             "tags, budget or norpm version)")
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.resumed = deque()
+        self._fd = open(path, "a" if resume else "w",  # pylint: disable=consider-using-with
+                        encoding="utf-8")
+        if not self.done:
+            # nothing to resume, (re)start with the current settings
+            self._fd.seek(0)
+            self._fd.truncate()
+            self._fd.write(json.dumps({"settings": settings}) + "\n")
+        self._digests = {}
+        self._unflushed = 0
+        self._flushed = time.monotonic()
+
+    def pending(self, specs):
+        """
+        Filter the SPECS, (name, content) pairs, and yield only those not
+        completed yet.  The results of the completed ones are queued for
+        record().
+        """
+        for name, content in specs:
+            digest = content_digest(content)
+            result = self.done.get(name)
+            if result is not None and result.get("digest") == digest:
+                del result["digest"]
+                self.resumed.append(result)
+                continue
+            self._digests[name] = digest
+            yield name, content
+
+    def record(self, results):
+        """
+        Pass through the RESULTS of the pending() specfiles, and record them.
+        The queued results of the already completed specfiles are yielded,
+        too.
+        """
+        for result in results:
+            yield from self._drain()
+            line = dict(result, digest=self._digests.pop(result["spec"]))
+            self._fd.write(json.dumps(line) + "\n")
+            self._unflushed += 1
+            if self._unflushed >= self.flush_every or \
+                    time.monotonic() - self._flushed >= self.flush_interval:
+                self.flush()
+            yield result
+        yield from self._drain()
+        self.flush()
+
+    def _drain(self):
+        while self.resumed:
+            yield self.resumed.popleft()
+
+    def flush(self):
+        """Make sure the recorded results are on the disk."""
+        self._fd.flush()
+        os.fsync(self._fd.fileno())
+        self._unflushed = 0
+        self._flushed = time.monotonic()
+
+    def close(self):
+        """Flush, and close the checkpoint file."""
+        if not self._fd.closed:
+            self.flush()
+            self._fd.close()
@@ -0,0 +1,240 @@
+"""
+Expand many specfiles in parallel, and print the gathered tags as JSON Lines.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from norpm.batch import (
+    RegistryConfig,
+    ResourceLimits,
+    batch_expand,
+    forkserver_expand,
+    list_specfiles,
+    read_specfile,
+    run_settings,
+)
+from norpm.budget import ExpansionBudget
+from norpm.cache import ResultCache
+from norpm.checkpoint import Checkpoint
+from norpm.corpus import READ_AHEAD, is_archive, open_corpus
+from norpm.results import ResultsStore, digesting
+from norpm.scheduling import TimingHistory
+from norpm.sharding import WorkQueue, in_shard, parse_shard
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description=(
+        "Expand the given specfiles (or directories with *.spec files, or "
+        "tar/zip archives), and print one JSON object per specfile, with the "
+        "gathered tags, expansion error and time."))
+    parser.add_argument("specs", nargs="+", metavar="SPEC_OR_DIR",
+                        help=("Specfile, directory with specfiles, or tar/zip "
+                              "archive (possibly compressed) with *.spec "
+                              "members"))
+    parser.add_argument("--jobs", "-j", type=int, default=None,
+                        help="Number of worker processes, defaults to CPUs")
+    parser.add_argument("--ordered", action="store_true",
+                        help="Print results in the input order, not in the "
+                             "order of completion")
+    parser.add_argument("--fork-server", action="store_true",
+                        help="Load the macros only once, and fork a new "
+                             "process for each --batch-size specfiles")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="Number of specfiles expanded by one forked "
+                             "process, defaults to 1")
+    parser.add_argument("--tag", action="append", dest="tags",
+                        help="Gather only the given tag (lowercase), may be "
+                             "used multiple times")
+    parser.add_argument("--arch", help="Target architecture")
+    parser.add_argument("--prefix", help="Root directory with macro files")
+    parser.add_argument("--macro-overrides", nargs=2,
+                        metavar=("DATABASE.JSON", "TAG"),
+                        help="Override macros per given database and tag.")
+    parser.add_argument("--define", nargs=2, action="append", default=[],
+                        metavar=("NAME", "VALUE"),
+                        help="Define additional macro")
+    parser.add_argument("--cache", default=os.environ.get("NORPM_CACHE"),
+                        metavar="DATABASE",
+                        help=("Cache the gathered tags in the given database "
+                              "file (defaults to $NORPM_CACHE), so unchanged "
+                              "specfiles are not expanded again"))
+    parser.add_argument("--store", metavar="DATABASE",
+                        help=("Record the results into the given SQLite "
+                              "database, see norpm-results"))
+    parser.add_argument("--label", help="Label of the run in --store")
+    parser.add_argument("--timings", metavar="FILE",
+                        help=("Expand the specfiles that took the longest in "
+                              "the previous runs first; the timings are "
+                              "kept in FILE (JSON)"))
+    parser.add_argument("--shard", metavar="I/N",
+                        help=("Expand only the I-th (counting from 0) of N "
+                              "deterministic parts of the specfiles"))
+    parser.add_argument("--queue", metavar="DIR",
+                        help=("Claim the specfiles from the work queue in "
+                              "the shared DIR (populated by the first "
+                              "worker), and write the results also to "
+                              "DIR/results/; see norpm-merge-results"))
+    parser.add_argument("--worker", metavar="NAME",
+                        help=("Unique name of this --queue worker, defaults "
+                              "to hostname-pid; restarting a crashed worker "
+                              "with the same name re-claims its unfinished "
+                              "specfiles"))
+    parser.add_argument("--claim-timeout", type=float, metavar="SECONDS",
+                        help=("Re-claim the --queue specfiles claimed longer "
+                              "ago (by crashed workers) once there's no "
+                              "other work left"))
+    parser.add_argument("--checkpoint", metavar="FILE",
+                        help=("Record the progress into FILE (JSON Lines), "
+                              "see --resume"))
+    parser.add_argument("--resume", action="store_true",
+                        help=("Continue the interrupted run, don't expand the "
+                              "specfiles already completed in --checkpoint "
+                              "(if their content didn't change); not needed "
+                              "with --queue"))
+    budget = parser.add_argument_group("expansion budget (per specfile)")
+    budget.add_argument("--max-steps", type=int)
+    budget.add_argument("--max-output", type=int)
+    budget.add_argument("--max-depth", type=int)
+    budget.add_argument("--max-time", type=float)
+    limits = parser.add_argument_group(
+        "resource limits (per worker process, implies --fork-server); the "
+        "specfile exceeding them is reported as NorpmResourceError")
+    limits.add_argument("--memory-limit", type=int, metavar="MIB",
+                        help="Address space limit in MiB")
+    limits.add_argument("--cpu-limit", type=float, metavar="SECONDS",
+                        help="CPU time limit per specfile")
+    limits.add_argument("--wall-limit", type=float, metavar="SECONDS",
+                        help="Kill the worker stuck on one specfile longer")
+    return parser
+
+
+def _main():
+    parser = _get_parser()
+    opts = parser.parse_args()
+    if opts.fork_server and opts.ordered:
+        parser.error("--ordered can not be used with --fork-server")
+    if opts.timings and opts.ordered:
+        parser.error("--ordered can not be used with --timings")
+    if opts.resume and not opts.checkpoint:
+        parser.error("--resume requires --checkpoint")
+    if opts.queue and (opts.timings or opts.shard):
+        parser.error("--queue can not be used with --timings or --shard")
+    if opts.queue and opts.resume:
+        # the queue keeps the progress itself (the done items are not
+        # claimed again), and the resumed specfiles would stay claimed
+        parser.error("--queue can not be used with --resume")
+    if opts.queue and any(is_archive(path) for path in opts.specs):
+        parser.error("--queue can not be used with archives")
+    shard = None
+    if opts.shard:
+        try:
+            shard = parse_shard(opts.shard)
+        except ValueError as exc:
+            parser.error(str(exc))
+    config = RegistryConfig(
+        arch=opts.arch,
+        prefix=opts.prefix,
+        overrides=tuple(opts.macro_overrides) if opts.macro_overrides else None,
+        defines=tuple(tuple(d) for d in opts.define),
+    )
+    budget = None
+    if any(x is not None for x in [opts.max_steps, opts.max_output,
+                                   opts.max_depth, opts.max_time]):
+        budget = ExpansionBudget(opts.max_steps, opts.max_output,
+                                 opts.max_depth, opts.max_time)
+
+    limits = None
+    if any(x is not None for x in [opts.memory_limit, opts.cpu_limit,
+                                   opts.wall_limit]):
+        limits = ResourceLimits(
+            opts.memory_limit << 20 if opts.memory_limit else None,
+            opts.cpu_limit, opts.wall_limit)
+        if opts.ordered:
+            parser.error("--ordered can not be used with the resource limits")
+        opts.fork_server = True
+
+    cache = False
+    if opts.cache:
+        cache = ResultCache(opts.cache, store_text=False)
+
+    registry = None
+    if opts.store or opts.checkpoint:
+        registry = config.build()
+
+    checkpoint = None
+    if opts.checkpoint:
+        try:
+            checkpoint = Checkpoint(
+                opts.checkpoint, run_settings(registry, opts.tags, budget),
+                opts.resume)
+        except ValueError as exc:
+            parser.error(str(exc))
+
+    queue = None
+    if opts.queue:
+        queue = WorkQueue(opts.queue, opts.worker, opts.claim_timeout)
+        queue.populate(list_specfiles(opts.specs))
+        # the fork server holds whole batches (claimed) till they finish
+        batch = opts.batch_size if opts.fork_server else 1
+        window = 2 * (opts.jobs or os.cpu_count()) * batch
+        specs, finish = queue.claims(read_specfile, window)
+    else:
+        # the fork server must not fork while the read-ahead thread runs
+        specs = open_corpus(opts.specs, depth=0 if opts.fork_server else
+                            READ_AHEAD)
+    if shard:
+        specs = in_shard(specs, *shard)
+
+    store = None
+    if opts.store:
+        store = ResultsStore(opts.store)
+        run = store.start_run(registry, opts.label, opts.tags, budget)
+        digests = {}
+        specs = digesting(specs, digests)
+
+    if checkpoint:
+        specs = checkpoint.pending(specs)
+
+    timings = TimingHistory(opts.timings) if opts.timings else None
+    if opts.fork_server:
+        results = forkserver_expand(specs, config, processes=opts.jobs,
+                                    tags=opts.tags, budget=budget,
+                                    batch_size=opts.batch_size, cache=cache,
+                                    timings=timings, limits=limits)
+    else:
+        results = batch_expand(specs, config, processes=opts.jobs,
+                               ordered=opts.ordered, tags=opts.tags,
+                               budget=budget, cache=cache, timings=timings)
+    if queue:
+        results = finish(results)
+    if checkpoint:
+        results = checkpoint.record(results)
+    if store:
+        results = store.record(run, results, digests)
+    output = None
+    if queue:
+        output = open(queue.results_file(), "a",  # pylint: disable=consider-using-with
+                      encoding="utf-8")
+    try:
+        for result in results:
+            line = json.dumps(result) + "\n"
+            sys.stdout.write(line)
+            sys.stdout.flush()
+            if output:
+                output.write(line)
+                output.flush()
+    finally:
+        if output:
+            output.close()
+        if checkpoint:
+            checkpoint.close()
+        if timings:
+            timings.save()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
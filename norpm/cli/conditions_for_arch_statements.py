@@ -4,11 +4,11 @@ leading to ExcludeArch, ExclusiveArch and BuildArch.
 """
 
 import argparse
-import copy
 import glob
 import json
 import os
 import sys
+from norpm.corpus import open_corpus
 from norpm.exceptions import NorpmSyntaxError, NorpmRecursionError
 from norpm.macrofile import system_macro_registry
 from norpm.specfile import (
@@ -23,6 +23,9 @@ def _get_parser():
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--specfile-dir", help="Directory with specfiles")
     group.add_argument("--specfile", help="RPM Spec file name")
+    group.add_argument("--corpus", nargs="+", metavar="PATH",
+                       help=("Directory with specfiles, or tar/zip archive "
+                             "(possibly compressed) with *.spec members"))
     return parser
 
 
@@ -69,11 +72,21 @@ def macro_names_needed(specfile, original_registry):
     Return a set of macros needed to correctly expand the SPECFILE parts with
     arch-specific statements.
     """
-    hooks = Hooks()
-    registry = copy.deepcopy(original_registry)
     with open(specfile, "r", encoding="utf8") as fd:
+        return macro_names_needed_in_content(fd.read(), original_registry)
+
+
+def macro_names_needed_in_content(content, original_registry):
+    """
+    Like macro_names_needed(), but for the specfile CONTENT.
+    """
+    hooks = Hooks()
+    # the changes done by the specfile are reverted at the end
+    registry = original_registry
+    token = registry.checkpoint()
+    try:
         try:
-            specfile_expand(fd.read(), registry, hooks)
+            specfile_expand(content, registry, hooks)
         except NorpmRecursionError:
             sys.stderr.write("Recursion Error.\n")
         except NorpmSyntaxError:
@@ -81,18 +94,19 @@ def macro_names_needed(specfile, original_registry):
         except AttributeError:
             sys.stderr.write("Attribute Error.\n")
 
-    strings = hooks.strings
+        strings = hooks.strings
 
-    with open(specfile, "r", encoding="utf8") as fd:
-        for line in fd.readlines():
+        for line in content.splitlines():
             line = line.strip()
             if not any(line.lower().startswith(s + ":") for s in STATEMENTS):
                 continue
             strings.add(line.split(":", 1)[1])
 
-    macro_calls = set()
-    for s in strings:
-        macro_calls |= specfile_detect_macro_calls_in_string(s, registry)
+        macro_calls = set()
+        for s in strings:
+            macro_calls |= specfile_detect_macro_calls_in_string(s, registry)
+    finally:
+        registry.rollback(token)
 
     return {x for x in macro_calls if _is_wanted_macro(x)}
 
@@ -120,6 +134,15 @@ def _main():
             sys.stderr.write(f"found: {items}\n")
             fullset |= items
 
+    elif opts.corpus:
+        for spec, content in open_corpus(opts.corpus):
+            sys.stderr.write(f"parsing {spec}\n")
+            items = macro_names_needed_in_content(content, registry)
+            if not items:
+                continue
+            sys.stderr.write(f"found: {items}\n")
+            fullset |= items
+
     else:
         assert False
 
@@ -0,0 +1,42 @@
+"""
+Run the long-lived expansion daemon, see norpm.daemon.  Use
+norpm-expand-specfile --socket as the client.
+"""
+
+import argparse
+import sys
+
+from norpm.daemon import ExpansionServer
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description=(
+        "Serve norpm-expand-specfile requests on a Unix domain socket, "
+        "keeping the macro registries loaded."))
+    parser.add_argument("--socket", required=True,
+                        help="Path to the Unix socket to listen on")
+    parser.add_argument("--arch", help="Default target architecture")
+    parser.add_argument("--prefix", help="Default root directory with macro "
+                                         "files")
+    parser.add_argument("--max-configs", type=int, default=8,
+                        help=("Keep the warm registries for at most the "
+                              "given number of (arch, prefix, overrides) "
+                              "combinations, defaults to 8"))
+    return parser
+
+
+def _main():
+    opts = _get_parser().parse_args()
+    server = ExpansionServer(opts.socket, opts.arch, opts.prefix,
+                             opts.max_configs)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
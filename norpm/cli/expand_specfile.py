@@ -2,24 +2,15 @@
 Expand rpm specfile, using the system macro definitions.
 """
 
+# The heavy imports (expression parser, etc.) are done lazily, so the
+# --socket client mode starts fast.
+# pylint: disable=import-outside-toplevel
+
 import argparse
+import json
+import os
+import socket
 import sys
-from norpm.macrofile import system_macro_registry
-from norpm.specfile import specfile_expand, specfile_expand_string
-from norpm.specfile import ParserHooks
-from norpm.exceptions import NorpmError
-from norpm.overrides import override_macro_registry
-
-
-class Hooks(ParserHooks):
-    """ Gather access to spec tags """
-    def __init__(self):
-        self.tags = {}
-    def tag_found(self, name, value, _tag_raw):
-        """ Gather EclusiveArch, ExcludeArch, BuildArch... """
-        if name == "source":
-            name = "source0"
-        self.tags[name] = value
 
 
 def _get_parser():
@@ -35,44 +26,73 @@ def _get_parser():
     parser.add_argument("--macro-overrides", nargs=2,
                         metavar=("DATABASE.JSON", "TAG"),
                         help="Override macros per given database and tag.")
+    parser.add_argument("--socket", default=os.environ.get("NORPM_SOCKET"),
+                        help=("Ask the norpm-daemon listening on the given "
+                              "Unix socket to do the work (defaults to "
+                              "$NORPM_SOCKET)."))
+    parser.add_argument("--cache", default=os.environ.get("NORPM_CACHE"),
+                        metavar="DATABASE",
+                        help=("Cache the expansion results in the given "
+                              "database file (defaults to $NORPM_CACHE)."))
     return parser
 
 
+def _ask_daemon(socket_path, request):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with sock.makefile("r", encoding="utf-8") as fd:
+            return json.loads(fd.readline())
+
+
 def _main():
     parser = _get_parser()
     opts = parser.parse_args()
-    registry = system_macro_registry()
-    registry["dist"] = ""
-    registry.known_norpm_hacks()
-
-    if opts.macro_overrides:
-        registry = override_macro_registry(registry,
-                                           opts.macro_overrides[0],
-                                           opts.macro_overrides[1])
 
+    with open(opts.specfile, "r", encoding="utf8") as fd:
+        content = fd.read()
 
-    try:
-        hooks = Hooks()
-        with open(opts.specfile, "r", encoding="utf8") as fd:
-            expanded_specfile = specfile_expand(fd.read(), registry, hooks)
+    if opts.socket:
+        request = {"op": "expand", "content": content}
         if opts.expand_string:
-            if opts.expand_string[-1] != "\n":
-                opts.expand_string += "\n"
-            sys.stdout.write(specfile_expand_string(opts.expand_string, registry))
-            return 0
-        if opts.get_tag:
-            tag = opts.get_tag.lower()
-            try:
-                sys.stdout.write(hooks.tags[tag] + "\n")
-                return 0
-            except KeyError:
-                sys.stderr.write(f"Tag {tag} not found\n")
-                return 1
-        sys.stdout.write(expanded_specfile)
-        return 0
-    except NorpmError as exc:
-        sys.stderr.write(str(exc))
-    return 1
+            request = {"op": "expand-string", "content": content,
+                       "string": opts.expand_string}
+        elif opts.get_tag:
+            request = {"op": "get-tag", "content": content,
+                       "tag": opts.get_tag}
+        if opts.macro_overrides:
+            # the daemon runs in a different working directory
+            request["macro_overrides"] = [
+                os.path.abspath(opts.macro_overrides[0]),
+                opts.macro_overrides[1]]
+        response = _ask_daemon(opts.socket, request)
+        status, stdout, stderr = (response["status"], response["stdout"],
+                                  response["stderr"])
+    else:
+        from norpm.macrofile import system_macro_registry
+        from norpm.overrides import override_macro_registry
+        from norpm.specfile import specfile_expand_command
+
+        registry = system_macro_registry()
+        registry["dist"] = ""
+        registry.known_norpm_hacks()
+
+        if opts.macro_overrides:
+            registry = override_macro_registry(registry,
+                                               opts.macro_overrides[0],
+                                               opts.macro_overrides[1])
+
+        cache = False
+        if opts.cache:
+            from norpm.cache import ResultCache
+            cache = ResultCache(opts.cache)
+
+        status, stdout, stderr = specfile_expand_command(
+            content, registry, opts.expand_string, opts.get_tag, cache)
+
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    return status
 
 
 if __name__ == "__main__":
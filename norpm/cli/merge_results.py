@@ -0,0 +1,30 @@
+"""
+Merge the JSON Lines result files written by the norpm-batch nodes.
+"""
+
+import argparse
+import json
+import sys
+
+from norpm.sharding import merge_results
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description=(
+        "Merge the norpm-batch result files (e.g., from --shard runs, or the "
+        "--queue DIR/results directory), and print the results sorted by "
+        "the specfile name."))
+    parser.add_argument("paths", nargs="+", metavar="FILE_OR_DIR",
+                        help="Result file, or directory with *.jsonl files")
+    return parser
+
+
+def _main():
+    opts = _get_parser().parse_args()
+    for result in merge_results(opts.paths):
+        sys.stdout.write(json.dumps(result) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
@@ -0,0 +1,52 @@
+"""
+Query the results database recorded by norpm-batch --store.
+"""
+
+import argparse
+import json
+import sys
+import time
+
+from norpm.results import ResultsStore
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description=(
+        "List the runs recorded by 'norpm-batch --store', or compare two "
+        "of them."))
+    parser.add_argument("database", help="The results database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("runs", help="List the recorded runs")
+    changed = subparsers.add_parser("changed", help=(
+        "Print the specfiles with different results (JSON Lines)"))
+    changed.add_argument("old", type=int, help="The old run id")
+    changed.add_argument("new", type=int, help="The new run id")
+    changed.add_argument("--tag", action="append", dest="tags",
+                         help="Compare the given tag (lowercase), may be used "
+                              "multiple times; the errors are compared by "
+                              "default")
+    return parser
+
+
+def _main():
+    opts = _get_parser().parse_args()
+    store = ResultsStore(opts.database)
+    try:
+        if opts.command == "runs":
+            for run, label, fingerprint, target, started in store.runs():
+                started = time.strftime("%Y-%m-%d %H:%M:%S",
+                                        time.localtime(started))
+                print(f"{run}\t{started}\t{target}\t{fingerprint[:16]}\t"
+                      f"{label or ''}")
+            return 0
+        for tag in opts.tags or [None]:
+            for spec, old, new in store.changed(opts.old, opts.new, tag):
+                sys.stdout.write(json.dumps({"spec": spec, "tag": tag,
+                                             "old": old, "new": new}) + "\n")
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
@@ -0,0 +1,88 @@
+"""
+Build the corpus-wide macro usage index, and re-expand only the specfiles
+affected by a macro registry change.  See norpm.usage.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from norpm.batch import RegistryConfig
+from norpm.corpus import open_corpus
+from norpm.usage import UsageIndex, reevaluate, update_index
+
+
+def _add_registry_options(parser, prefix="", what=""):
+    parser.add_argument(f"--{prefix}arch", help=f"Target architecture{what}")
+    parser.add_argument(f"--{prefix}prefix",
+                        help=f"Root directory with macro files{what}")
+    parser.add_argument(f"--{prefix}define", nargs=2, action="append",
+                        default=[], metavar=("NAME", "VALUE"),
+                        help=f"Define additional macro{what}")
+
+
+def _config(opts, prefix=""):
+    return RegistryConfig(
+        arch=getattr(opts, f"{prefix}arch"),
+        prefix=getattr(opts, f"{prefix}prefix"),
+        defines=tuple(tuple(d) for d in getattr(opts, f"{prefix}define")),
+    )
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description=(
+        "Record the macros read by each specfile into an index, and after a "
+        "macro registry change, expand again only the affected specfiles."))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help=(
+        "Expand the specfiles, and (re)create the index"))
+    diff = subparsers.add_parser("diff", help=(
+        "Compare the old and new registries, expand the specfiles reading "
+        "the changed macros (or changed since indexed) with the new one, "
+        "and update the index"))
+    for subparser in [build, diff]:
+        subparser.add_argument("specs", nargs="+", metavar="SPEC_OR_DIR",
+                               help=("Specfile, directory with specfiles, "
+                                     "or tar/zip archive"))
+        subparser.add_argument("--index", required=True, metavar="FILE",
+                               help="The index file")
+        subparser.add_argument("--jobs", "-j", type=int, default=None,
+                               help="Number of worker processes, defaults "
+                                    "to CPUs")
+        subparser.add_argument("--tag", action="append", dest="tags",
+                               help="Print only the given tag (lowercase), "
+                                    "may be used multiple times")
+    _add_registry_options(build)
+    _add_registry_options(diff, "old-", " (the old registry)")
+    _add_registry_options(diff, "", " (the new registry)")
+    return parser
+
+
+def _main():
+    opts = _get_parser().parse_args()
+    specs = open_corpus(opts.specs)
+    if opts.command == "build":
+        index = UsageIndex()
+        results = update_index(index, specs, _config(opts),
+                               processes=opts.jobs, tags=opts.tags)
+    else:
+        if not os.path.exists(opts.index):
+            sys.stderr.write(f"Index {opts.index} doesn't exist, use the "
+                             "'build' command first\n")
+            return 1
+        index = UsageIndex.load(opts.index)
+        results = reevaluate(index, specs, _config(opts, "old_"),
+                             _config(opts), processes=opts.jobs,
+                             tags=opts.tags)
+    for result in results:
+        result.pop("reads", None)
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
+    index.save(opts.index)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
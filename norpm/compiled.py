@@ -0,0 +1,199 @@
+"""
+Compile-once specfile representation, reusable across many registries.
+
+Splitting the specfile text into snippets (macro calls and text parts) is
+a considerable part of the expansion cost, and it is repeated for each
+registry the specfile is expanded against.  The compile_spec() does the
+splitting (and snippet classification) once, and execute() only evaluates the
+snippets.
+
+The top-level split is not fully independent of the expansion though.  Bare
+'%foo args' calls consume the rest of the line only if %foo is a parametric
+macro, and the comment state (context.in_comment) may be changed by the
+expansion of the preceding snippets.  So every snippet in the IR remembers the
+assumptions (guards) it was split under.  If they don't hold during
+execute(), the split continues from that point on the fly, exactly as
+specfile_expand() would do it.  The IR itself is never modified by
+execute(), so it can be shared by threads; compile the specfile with the
+registry it is going to be executed with most often (see compile_spec()).
+"""
+
+from dataclasses import dataclass
+import hashlib
+
+from norpm.exceptions import NorpmError
+from norpm.macro import MacroRegistry
+from norpm.specfile import (
+    _SpecContext,
+    _classify_snippet,
+    _specfile_expand_generator,
+    _specfile_split_generator,
+)
+
+
+@dataclass(frozen=True)
+class _Entry:
+    """
+    One top-level snippet, its classification (_ClassifiedSnippet, or None if
+    the snippet is text or it failed to classify), and the guards it was split
+    under.
+    """
+    snippet: object
+    classified: object
+    comment_before: bool
+    decisions: tuple
+    comment_after: object
+
+
+class _ParametricOracle:
+    """
+    Stands for the MacroRegistry in the split generator, which only asks
+    whether '%foo' is a parametric macro.  The answers are either replayed
+    from the REPLAY list of (name, answer) pairs, or taken from MACROS and
+    recorded into the `decisions` list.
+    """
+    # the read sets are recorded from the decisions, see replay_entries()
+    records_decisions = True
+
+    class _Parametric:
+        parametric = True
+
+    def __init__(self, macros, replay=()):
+        self.macros = macros
+        self.replay = list(reversed(replay))
+        self.decisions = []
+
+    def __contains__(self, name):
+        if self.replay:
+            _, answer = self.replay.pop()
+            return answer
+        answer = name in self.macros and self.macros[name].parametric
+        self.decisions.append((name, answer))
+        return answer
+
+    def __getitem__(self, _name):
+        return self._Parametric
+
+
+def _is_parametric(macros, name):
+    return name in macros and macros[name].parametric
+
+
+def _record(context, generator, oracle):
+    """
+    Drive the split GENERATOR, and yield (entry, snippet) pairs.
+    """
+    while True:
+        comment_before = bool(context.in_comment)
+        oracle.decisions = []
+        try:
+            snippet = next(generator)
+        except StopIteration:
+            return
+        classified = None
+        if snippet.text.startswith("%"):
+            try:
+                classified = _classify_snippet(snippet.text,
+                                               snippet.macro_starts_line)
+            except NorpmError:
+                pass  # raised again during execute()
+            # pickled with the IR, execute() doesn't classify it again
+            snippet.classified = classified
+        yield _Entry(snippet, classified, comment_before, tuple(oracle.decisions),
+                     context.in_comment), snippet
+
+
+class SpecIR:
+    """
+    The compiled specfile, see compile_spec().  Can be pickled, e.g., to be
+    cached on disk under the `digest` key.
+    """
+    def __init__(self, text, entries):
+        self.text = text
+        self.digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _resume(self, context, macros, index):
+        """
+        The guards of entries[INDEX] don't hold, split the rest of the text
+        on the fly.  The split generator is fast-forwarded to the INDEX
+        position by replaying the recorded guards.  The IR is not modified.
+        """
+        entries = self.entries
+        live_comment = context.in_comment
+        oracle = _ParametricOracle(
+            macros, [d for e in entries[:index] for d in e.decisions])
+        generator = _specfile_split_generator(context, self.text, oracle)
+        for entry in entries[:index]:
+            context.in_comment = entry.comment_before
+            next(generator)
+        context.in_comment = live_comment
+
+        for entry, _ in _record(context, generator, oracle):
+            yield entry
+
+    def replay(self, context, macros):
+        """Generator of the top-level snippets, for CONTEXT and MACROS."""
+        for entry in self.replay_entries(context, macros):
+            yield entry.snippet
+
+    def replay_entries(self, context, macros):
+        """Same as replay(), but yield the whole IR entries."""
+        for entry in self._replay_entries(context, macros):
+            if context.reads is not None:
+                for name, _ in entry.decisions:
+                    context.reads.read_macro(name, macros)
+            yield entry
+
+    def _replay_entries(self, context, macros):
+        for index, entry in enumerate(self.entries):
+            if bool(context.in_comment) != entry.comment_before or any(
+                    _is_parametric(macros, name) != answer
+                    for name, answer in entry.decisions):
+                yield from self._resume(context, macros, index)
+                return
+            context.in_comment = entry.comment_after
+            yield entry
+
+
+class _Splitter:
+    """Iterator used instead of SpecfileSplitGenerator"""
+    quoted = False
+
+    def __init__(self, generator):
+        self.gen = generator
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.gen)
+
+
+def compile_spec(text, macros=None):
+    """
+    Split and classify the specfile TEXT, and return SpecIR for execute().
+    The MACROS registry (optional) answers which '%foo args' calls are
+    parametric; it is only a hint, execute() verifies it against the actual
+    registry.
+    """
+    context = _SpecContext()
+    oracle = _ParametricOracle(macros if macros is not None
+                               else MacroRegistry())
+    generator = _specfile_split_generator(context, text, oracle)
+    return SpecIR(text, [entry for entry, _
+                         in _record(context, generator, oracle)])
+
+
+def execute(ir, macros, hooks=None, budget=None):
+    """
+    Expand the compiled specfile IR using the MACROS registry, the same way
+    specfile_expand(text, macros, hooks, budget) would do.
+    """
+    context = _SpecContext(hooks, budget).start()
+    splitter = _Splitter(ir.replay(context, macros))
+    return "".join(_specfile_expand_generator(context, ir.text, macros,
+                                              splitter=splitter))
@@ -0,0 +1,140 @@
+"""
+Reading the specfile corpora, see norpm.batch.
+
+The spec snapshots are often distributed as one tarball with tens of
+thousands of specfiles.  Instead of extracting it to disk first, the
+*.spec members are streamed directly out of the tar (optionally gzip, bzip2
+or xz compressed) or zip archive, in the archive order.  The directories (and
+plain specfiles) are read as before, see list_specfiles().
+
+The reading (and decompression) runs in a separate thread, a few specfiles
+ahead of the consumer, so it overlaps with the expansion (not with the fork
+server, which must not fork while other threads run).
+"""
+
+import os
+import queue
+import tarfile
+import threading
+import zipfile
+
+from norpm.batch import read_specfiles
+
+# The number of specfiles read ahead by default.
+READ_AHEAD = 64
+
+_DONE = object()
+
+
+def _decode(data):
+    return data.decode("utf8", errors="replace")
+
+
+def is_archive(path):
+    """True if PATH is a tar or zip archive file (by content)."""
+    if os.path.isdir(path) or path.endswith(".spec"):
+        return False
+    return tarfile.is_tarfile(path) or zipfile.is_zipfile(path)
+
+
+def _tar_members(path):
+    # the "r|*" stream mode never seeks back, and handles the compression
+    with tarfile.open(path, "r|*") as archive:
+        for member in archive:
+            if not member.isfile() or not member.name.endswith(".spec"):
+                continue
+            with archive.extractfile(member) as fd:
+                yield f"{path}/{member.name}", _decode(fd.read())
+
+
+def _zip_members(path):
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not info.filename.endswith(".spec"):
+                continue
+            yield f"{path}/{info.filename}", _decode(archive.read(info))
+
+
+def archive_specfiles(path):
+    """
+    Generator yielding the (name, content) pairs for the *.spec members of
+    the archive PATH.  The NAME is the member path prefixed with PATH, e.g.,
+    "specs.tar.xz/rpm-specs/foo.spec".
+    """
+    if zipfile.is_zipfile(path):
+        yield from _zip_members(path)
+    else:
+        yield from _tar_members(path)
+
+
+def corpus_specfiles(paths):
+    """
+    Generator yielding (name, content) pairs for the given PATHS.  Each path
+    is a specfile, a directory with *.spec files, or an archive, see
+    archive_specfiles().
+    """
+    for path in paths:
+        if is_archive(path):
+            yield from archive_specfiles(path)
+        else:
+            yield from read_specfiles([path])
+
+
+def read_ahead(items, depth=READ_AHEAD):
+    """
+    Pass through the ITEMS iterable, consumed by a separate thread at most
+    DEPTH items ahead.  The exceptions raised by ITEMS are re-raised here.
+    """
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _reader():
+        try:
+            for item in items:
+                if not _put((item, None)):
+                    return
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            _put((_DONE, exc))
+            return
+        finally:
+            if hasattr(items, "close"):
+                items.close()  # e.g., close the archive
+        _put((_DONE, None))
+
+    thread = threading.Thread(target=_reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, exc = buffer.get()
+            if exc is not None:
+                raise exc
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        # the consumer stopped early, let the reader finish
+        stop.set()
+        thread.join()
+
+
+def open_corpus(paths, depth=READ_AHEAD):
+    """
+    The (name, content) pairs for the PATHS, see corpus_specfiles(), read
+    DEPTH specfiles ahead in a separate thread (unless DEPTH is 0).
+
+    Use DEPTH=0 with forkserver_expand(); forking while the reader thread
+    holds a lock (e.g., the decompressor's) would deadlock the child.
+    """
+    specs = corpus_specfiles(paths)
+    if not depth:
+        return specs
+    return read_ahead(specs, depth)
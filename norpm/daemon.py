@@ -0,0 +1,204 @@
+"""
+Long-lived expansion daemon, serving JSON requests on a Unix domain socket.
+
+The daemon keeps warm macro registries per (arch, prefix, macro overrides)
+key, so the requests don't pay for the system_macro_registry() load.  Only
+the registries of the recently used keys are kept, see RegistryPool.  Each
+request is one JSON object on a single line, and the response is again one
+JSON line.  Requests are served concurrently, each of them gets its own
+registry (changes done by the specfile are reverted by rollback()).
+
+Requests::
+
+    {"op": "expand", "content": "<specfile>"}
+    {"op": "get-tag", "content": "<specfile>", "tag": "version"}
+    {"op": "expand-string", "content": "<specfile>", "string": "%name"}
+    {"op": "stats"}
+
+The expand* requests optionally accept "arch", "prefix" and
+"macro_overrides" (a [DATABASE.JSON, TAG] pair).  Responses to the expand*
+requests are {"status": <exit status>, "stdout": ..., "stderr": ...}, the same
+thing norpm-expand-specfile would print.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import copy
+import json
+import os
+import socketserver
+import threading
+import time
+
+from norpm.batch import RegistryConfig
+from norpm.specfile import specfile_expand_command
+
+
+class RegistryPool:
+    """
+    Warm MacroRegistry objects, per RegistryConfig.  There's one pristine
+    template registry per config, and a list of idle registries handed out to
+    the requests (more of them exist if requests run concurrently).  At most
+    MAX_CONFIGS configs are kept, the least recently used are dropped.
+    """
+    def __init__(self, max_configs=8):
+        self._lock = threading.Lock()
+        self._templates = OrderedDict()
+        self._idle = {}
+        self.max_configs = max_configs
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _new_registry(self, config):
+        with self._lock:
+            template = self._templates.get(config)
+        if template is None:
+            template = config.build()
+            with self._lock:
+                template = self._templates.setdefault(config, template)
+                self._evict()
+        return copy.deepcopy(template)
+
+    def _evict(self):
+        while len(self._templates) > self.max_configs:
+            config, _ = self._templates.popitem(last=False)
+            self._idle.pop(config, None)
+            self.evictions += 1
+
+    @contextmanager
+    def registry(self, config):
+        """
+        Context manager providing a MacroRegistry for the given CONFIG, for
+        exclusive use.  Changes done to the registry are reverted on exit.
+        """
+        with self._lock:
+            if config in self._templates:
+                self._templates.move_to_end(config)
+            idle = self._idle.get(config)
+            registry = idle.pop() if idle else None
+            if registry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if registry is None:
+            registry = self._new_registry(config)
+        token = registry.checkpoint()
+        try:
+            yield registry
+        finally:
+            registry.rollback(token)
+            with self._lock:
+                # unless the config was dropped meanwhile
+                if config in self._templates:
+                    self._idle.setdefault(config, []).append(registry)
+
+    def stats(self):
+        """Cache statistics, serializable dictionary."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "configs": len(self._templates),
+                "registries": sum(len(x) for x in self._idle.values()),
+            }
+
+
+class _Latency:
+    """Request latency counters, per request type."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def add(self, op, seconds):
+        """Account one OP request that took SECONDS."""
+        with self._lock:
+            data = self._data.setdefault(op, {"count": 0, "total": 0.0,
+                                              "max": 0.0})
+            data["count"] += 1
+            data["total"] += seconds
+            data["max"] = max(data["max"], seconds)
+
+    def stats(self):
+        """Latency statistics, serializable dictionary."""
+        with self._lock:
+            return {op: dict(data, avg=data["total"] / data["count"])
+                    for op, data in self._data.items()}
+
+
+class ExpansionServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+    """
+    The daemon, listening on SOCKET_PATH.  Use serve_forever() and
+    shutdown() as with any other socketserver.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, default_arch=None, default_prefix=None,
+                 max_configs=8):
+        self.socket_path = socket_path
+        self.default_arch = default_arch
+        self.default_prefix = default_prefix
+        self.pool = RegistryPool(max_configs)
+        self.latency = _Latency()
+        self.started = time.monotonic()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, _RequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def _config(self, request):
+        overrides = request.get("macro_overrides")
+        return RegistryConfig(
+            arch=request.get("arch", self.default_arch),
+            prefix=request.get("prefix", self.default_prefix),
+            overrides=tuple(overrides) if overrides else None,
+        )
+
+    def stats(self):
+        """Statistics returned by the "stats" request."""
+        return {
+            "uptime": time.monotonic() - self.started,
+            "latency": self.latency.stats(),
+            "cache": self.pool.stats(),
+        }
+
+    def process(self, request):
+        """Process one REQUEST dictionary, and return the response."""
+        start = time.monotonic()
+        op = request.get("op")
+        if op == "stats":
+            return self.stats()
+
+        if op not in ["expand", "get-tag", "expand-string"]:
+            return {"status": 1, "stdout": "",
+                    "stderr": f"Unknown request {op!r}\n"}
+
+        with self.pool.registry(self._config(request)) as registry:
+            status, stdout, stderr = specfile_expand_command(
+                request.get("content", ""), registry,
+                expand_string=request.get("string") if op == "expand-string"
+                else None,
+                get_tag=request.get("tag") if op == "get-tag" else None,
+            )
+        self.latency.add(op, time.monotonic() - start)
+        return {"status": status, "stdout": stdout, "stderr": stderr}
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Handle JSON Lines requests, until the client closes the connection."""
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                response = self.server.process(request)
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                response = {"status": 1, "stdout": "",
+                            "stderr": f"{type(exc).__name__}: {exc}\n"}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
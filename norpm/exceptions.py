@@ -9,7 +9,22 @@ class NorpmSyntaxError(NorpmError):
     """RPM syntax error detected"""
 
 class NorpmRecursionError(NorpmError):
-    """Too deep macro expansion hierarchy"""
+    """Too deep macro expansion hierarchy, or a macro expanding itself.  The
+    CYCLE attribute is the list of macro names forming the loop (if known)."""
+    def __init__(self, message, cycle=None):
+        super().__init__(message)
+        self.cycle = cycle
 
 class NorpmInvalidMacroName(NorpmError):
     """Trying to define macro with a wrong name"""
+
+class NorpmBudgetError(NorpmError):
+    """Expansion exceeded the configured ExpansionBudget.  The STATS attribute
+    contains the statistics gathered so far."""
+    def __init__(self, message, stats=None):
+        super().__init__(message)
+        self.stats = stats
+
+class NorpmResourceError(NorpmError):
+    """The worker process exceeded the batch ResourceLimits (memory, CPU or
+    wall-clock time)."""
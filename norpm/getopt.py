@@ -1,13 +1,162 @@
 """
-Call getopt() directly.  The Python variant doesn't support
-the %foo(:-:) syntax.
+Glibc compatible getopt().  The Python getopt module doesn't support
+the %foo(:-:) syntax, and doesn't permute the arguments.
+
+The getopt() below is a pure Python port of the glibc implementation (short
+options only), so it has no global state and is thread-safe.  The
+libc_getopt() calls the libc function directly through ctypes; it is kept as
+the reference implementation for testing.
 """
 
 import os
 import ctypes
+import threading
+
+# Argument ordering, see glibc's posix/getopt.c
+_PERMUTE = 0
+_REQUIRE_ORDER = 1
+_RETURN_IN_ORDER = 2
+
+
+class _GetoptState:
+    """
+    The glibc getopt() state (optind, optarg, etc.), normally kept in global
+    variables.
+    """
+    def __init__(self, argv, optstring):
+        self.argv = argv
+        self.optind = 1
+        self.optarg = None
+        self.nextchar = b""
+        self.first_nonopt = self.last_nonopt = 1
+
+        if optstring[:1] == b"-":
+            self.ordering = _RETURN_IN_ORDER
+            optstring = optstring[1:]
+        elif optstring[:1] == b"+":
+            self.ordering = _REQUIRE_ORDER
+            optstring = optstring[1:]
+        elif os.environ.get("POSIXLY_CORRECT") is not None:
+            self.ordering = _REQUIRE_ORDER
+        else:
+            self.ordering = _PERMUTE
+        self.optstring = optstring
+
+    def _exchange(self):
+        """Move the non-options [first_nonopt, last_nonopt) after the options
+        [last_nonopt, optind)."""
+        argv, first, last = self.argv, self.first_nonopt, self.last_nonopt
+        argv[first:self.optind] = argv[last:self.optind] + argv[first:last]
+        self.first_nonopt += self.optind - last
+        self.last_nonopt = self.optind
+
+    def _nonoption(self):
+        arg = self.argv[self.optind]
+        return arg[:1] != b"-" or len(arg) == 1
+
+    def _advance(self):
+        """Advance to the next ARGV element, return None if it is an option,
+        or the getopt() return value otherwise."""
+        argc = len(self.argv)
+        self.last_nonopt = min(self.last_nonopt, self.optind)
+        self.first_nonopt = min(self.first_nonopt, self.optind)
+
+        if self.ordering == _PERMUTE:
+            if self.first_nonopt != self.last_nonopt \
+                    and self.last_nonopt != self.optind:
+                self._exchange()
+            elif self.last_nonopt != self.optind:
+                self.first_nonopt = self.optind
+            while self.optind < argc and self._nonoption():
+                self.optind += 1
+            self.last_nonopt = self.optind
+
+        if self.optind != argc and self.argv[self.optind] == b"--":
+            self.optind += 1
+            if self.first_nonopt != self.last_nonopt \
+                    and self.last_nonopt != self.optind:
+                self._exchange()
+            elif self.first_nonopt == self.last_nonopt:
+                self.first_nonopt = self.optind
+            self.last_nonopt = argc
+            self.optind = argc
+
+        if self.optind == argc:
+            if self.first_nonopt != self.last_nonopt:
+                self.optind = self.first_nonopt
+            return -1
+
+        if self._nonoption():
+            if self.ordering == _REQUIRE_ORDER:
+                return -1
+            self.optarg = self.argv[self.optind]
+            self.optind += 1
+            return 1
+
+        self.nextchar = self.argv[self.optind][1:]
+        return None
+
+    def getopt(self):
+        """One getopt() call, return the option character code, -1 or 1."""
+        self.optarg = None
+        if not self.nextchar:
+            retval = self._advance()
+            if retval is not None:
+                return retval
+
+        char = self.nextchar[0]
+        self.nextchar = self.nextchar[1:]
+        index = self.optstring.find(bytes([char]))
+        if not self.nextchar:
+            self.optind += 1
+
+        if index == -1 or char in b":;":
+            return ord("?")
+
+        spec = self.optstring[index+1:index+3]
+        if spec[:1] == b":":
+            if spec == b"::":
+                # optional argument
+                if self.nextchar:
+                    self.optarg = self.nextchar
+                    self.optind += 1
+            elif self.nextchar:
+                self.optarg = self.nextchar
+                self.optind += 1
+            elif self.optind == len(self.argv):
+                return ord(":") if self.optstring[:1] == b":" else ord("?")
+            else:
+                self.optarg = self.argv[self.optind]
+                self.optind += 1
+            self.nextchar = b""
+        return char
+
+
+def getopt(params, optstring):
+    """
+    Parse PARAMS per OPTSTRING the same way Glibc's getopt() does, return
+    (options, arguments) pair, where options is a list of ("-o", "arg")
+    pairs.
+    """
+    argv = [b"norpm-macro-parser"] + [s.encode() for s in params]
+    state = _GetoptState(argv, optstring.encode())
+    output = []
+
+    while True:
+        opt = state.getopt()
+        if opt in (-1, 1):
+            break
+        optarg = state.optarg.decode() if state.optarg else ""
+        output.append(("-" + chr(opt), optarg))
+
+    return output, [arg.decode() for arg in argv[state.optind:]]
+
+
+# The libc getopt() state (optind, optarg) is global, as well as the stderr
+# redirection done below.
+_LIBC_LOCK = threading.Lock()
+_LIBC = []
 
-# Load libc
-libc = ctypes.CDLL("libc.so.6")
 
 def suppress_stderr(func, *args):
     """ avoid stderr polluting by glibc's getopt """
@@ -21,10 +170,19 @@ def suppress_stderr(func, *args):
         os.dup2(original_stderr_fd, 2)
         os.close(original_stderr_fd)
 
-def getopt(params, optstring):
+
+def libc_getopt(params, optstring):
     """
-    Call getops directly from Glibc
+    Call getops directly from Glibc.  Serialized, and not thread-safe
+    anyway as the stderr file descriptor is redirected (process-wide).
     """
+    with _LIBC_LOCK:
+        if not _LIBC:
+            _LIBC.append(ctypes.CDLL("libc.so.6"))
+        return _libc_getopt(_LIBC[0], params, optstring)
+
+
+def _libc_getopt(libc, params, optstring):
     libc.getopt.argtypes = [ctypes.c_int,
                             ctypes.POINTER(ctypes.c_char_p),
                             ctypes.c_char_p]
@@ -5,7 +5,10 @@ Logging configuration for norpm project.
 import logging
 
 def get_logger(name='norpm'):
-    """Allocate configured logger."""
+    """Allocate configured logger.  The DEBUG level is set only if the level
+    wasn't configured yet, so we don't override the level set by the caller
+    (e.g., from other thread)."""
     log = logging.getLogger(name)
-    log.setLevel(logging.DEBUG)
+    if log.level == logging.NOTSET:
+        log.setLevel(logging.DEBUG)
     return log
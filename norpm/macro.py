@@ -3,6 +3,10 @@ RPM macro & macro stack representation
 """
 
 # pylint: disable=too-few-public-methods
+from functools import lru_cache
+import hashlib
+import re
+
 from norpm.arch import detect_host_arch
 from norpm.exceptions import NorpmInvalidMacroName
 
@@ -58,12 +62,49 @@ class Macro:
         return self.stack[-1].modifiers
 
 
+def _macro_digest(name, macro):
+    stack = [(d.value, d.params, sorted(d.modifiers or ()))
+             for d in macro.stack]
+    digest = hashlib.sha256(repr((name, stack)).encode("utf-8")).digest()
+    return int.from_bytes(digest, "big")
+
+
+class _Fingerprints:
+    """
+    Per-macro digests, and their XOR (the digest of the whole registry),
+    for MacroRegistry.fingerprint().  The DIRTY macros need to be
+    re-hashed.  Shared by the registry views sharing the macro database.
+    """
+    def __init__(self):
+        self.digests = {}
+        self.total = 0
+        self.dirty = set()
+
+    def update(self, db):
+        """Re-hash the dirty macros from the DB."""
+        while self.dirty:
+            name = self.dirty.pop()
+            self.total ^= self.digests.pop(name, 0)
+            if name in db:
+                digest = _macro_digest(name, db[name])
+                self.digests[name] = digest
+                self.total ^= digest
+
+
 class MacroRegistry:
     """Registry of macro definitions."""
 
+    # The expansion results may be cached (see norpm.cache), i.e., the
+    # expansion is not observed by the registry methods.
+    cacheable = True
+
     def __init__(self):
         self.db = {}
         self.target = detect_host_arch()
+        # list of changes since the oldest checkpoint(), see rollback()
+        self._journal = None
+        self._checkpoints = 0
+        self._fingerprints = _Fingerprints()
 
     def known_norpm_hacks(self):
         """
@@ -99,10 +140,17 @@ class MacroRegistry:
         except KeyError:
             macro = self.db[name] = Macro()
         macro.define(value, params, modifiers)
+        self._fingerprints.dirty.add(name)
+        if self._journal is not None:
+            self._journal.append(("define", name, None))
 
     def __contains__(self, name):
         return name in self.db
 
+    def target_matches(self, arches):
+        """True if the target architecture is one of ARCHES (%ifarch)."""
+        return self.target in arches
+
     def to_dict(self):
         """Return a serializable object, used for testing."""
         output = {}
@@ -116,12 +164,94 @@ class MacroRegistry:
             return
 
         macro = self.db[name]
-        macro.stack.pop()
+        definition = macro.stack.pop()
+        self._fingerprints.dirty.add(name)
+        if self._journal is not None:
+            self._journal.append(("undefine", name, definition))
         if macro.stack:
             return
 
         del self.db[name]
 
+    def replace(self, name, value):
+        """
+        Replace the latest definition of macro NAME in-place (with
+        non-parametric VALUE), instead of pushing a new definition.
+        """
+        macro = self.db[name]
+        if self._journal is not None:
+            self._journal.append(("replace", name, macro.stack[-1]))
+        macro.stack[-1] = MacroDefinition(value, None)
+        self._fingerprints.dirty.add(name)
+
+    def checkpoint(self):
+        """
+        Start recording changes in the registry, and return a token for
+        rollback() or commit().  Checkpoints may be nested.  This is much
+        cheaper than copy.deepcopy() when the registry needs to be reused
+        for multiple specfiles.
+        """
+        if self._journal is None:
+            self._journal = []
+        self._checkpoints += 1
+        return len(self._journal)
+
+    def rollback(self, token):
+        """Revert all the changes done since checkpoint() returned TOKEN."""
+        journal = self._journal
+        while len(journal) > token:
+            action, name, definition = journal.pop()
+            self._fingerprints.dirty.add(name)
+            if action == "define":
+                macro = self.db[name]
+                macro.stack.pop()
+                if not macro.stack:
+                    del self.db[name]
+            elif action == "undefine":
+                if name not in self.db:
+                    self.db[name] = Macro()
+                self.db[name].stack.append(definition)
+            else:
+                self.db[name].stack[-1] = definition
+        self.commit(token)
+
+    def commit(self, _token):
+        """Keep the changes done since checkpoint() returned TOKEN."""
+        self._checkpoints -= 1
+        if not self._checkpoints:
+            self._journal = None
+
+    def fingerprint(self, names=None):
+        """
+        Return a hex digest identifying the current state of the registry,
+        i.e., all the macro definitions (including the stacked ones) and the
+        target architecture.  If NAMES is given, only the definitions of
+        these macros (defined or not) and the target are considered.
+
+        The per-macro digests are kept, and only the macros changed since the
+        last call are re-hashed.
+        """
+        state = self._fingerprints
+        state.update(self.db)
+        if names is None:
+            combined = f"{state.total:064x}"
+        else:
+            combined = " ".join(f"{state.digests.get(name, 0):064x}"
+                                for name in sorted(set(names)))
+        return hashlib.sha256(
+            f"{combined} {self.target}".encode("utf-8")).hexdigest()
+
+    def changed_macros(self, other):
+        """
+        Return the set of the macro names defined differently (including the
+        stacked definitions) in the OTHER registry.
+        """
+        mine, theirs = self._fingerprints, other._fingerprints  # pylint: disable=protected-access
+        mine.update(self.db)
+        theirs.update(other.db)
+        return {name for name in mine.digests.keys() | theirs.digests.keys()
+                if mine.digests.get(name) != theirs.digests.get(name)}
+
     def clear(self, name):
         """
         Remove the macro from database, not just "pop once".
@@ -177,9 +307,60 @@ def drop_curly_brackets(call):
     return call[1:]
 
 
+# Successfully parsed macro call, see _parse_macro_call_statemachine().
+_MACRO_CALL_RE = re.compile(
+    r'(?P<cond>[?!]*)(?P<name>[\w*#-]+)'
+    r'(?:(?P<colon>:)(?P<after>.*)|\s(?P<params>.*))?\Z',
+    re.DOTALL,
+)
+
+
+@lru_cache(maxsize=16384)
+def _parse_macro_call_cached(call):
+    stripped = drop_curly_brackets(call)
+    match = _MACRO_CALL_RE.match(stripped)
+    if not match:
+        success, name, conditionals, params, alt = \
+            _parse_macro_call_statemachine(call)
+        if isinstance(params, list):
+            params = tuple(params)
+        return success, name, frozenset(conditionals), params, alt
+
+    cond = match["cond"]
+    conditionals = set()
+    if '?' in cond:
+        conditionals.add('?')
+    if cond.count('!') % 2:
+        conditionals.add('!')
+
+    params = ()
+    alt = None
+    if match["colon"]:
+        if '?' in conditionals:
+            alt = match["after"]
+        else:
+            params = match["after"]
+    elif match["params"] is not None:
+        params = (match["params"],)
+
+    return True, match["name"], frozenset(conditionals), params, alt
+
+
 def parse_macro_call(call):
-    """Given a macro call, return 4-ary
-        (success, name, conditionals, params)
+    """Given a macro call, return 5-ary
+        (success, name, conditionals, params, alt)
+    See _parse_macro_call_statemachine() for the details.  The parsed results
+    are cached, as the same calls (e.g., '%{?dist}') are very frequent.
+    """
+    success, name, conditionals, params, alt = _parse_macro_call_cached(call)
+    if isinstance(params, tuple):
+        params = list(params)
+    return success, name, set(conditionals), params, alt
+
+
+def _parse_macro_call_statemachine(call):
+    """Given a macro call, return 5-ary
+        (success, name, conditionals, params, alt)
     Where SUCCESS is True/False, depending if the parsing was done correctly.
     NAME is the macro name being called.
     CONDITIONALS is a set of '?' or '!' characters.
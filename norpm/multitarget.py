@@ -0,0 +1,132 @@
+"""
+Expand one specfile for multiple target architectures.
+
+Specfiles typically differ only in a few %ifarch branches, if at all, so
+most of the targets lead to exactly the same expansion.  While expanding for
+one target, we record every arch-dependent decision: %ifarch/%ifnarch results,
+and reads of the macros that are defined differently for different targets
+(e.g., %_arch from the per-arch macro files).  Any other target leading to the
+same decisions would produce the same output, so we reuse the results, and
+the specfile is expanded only once per distinct "arch path".
+"""
+
+from norpm.batch import expand_spec
+from norpm.macro import MacroRegistry
+
+
+def _stack_signature(macro):
+    if macro is None:
+        return None
+    return tuple((d.value, d.params, frozenset(d.modifiers or ()))
+                 for d in macro.stack)
+
+
+def arch_dependent_macros(registries):
+    """
+    Return the names of macros that are defined differently (or not defined
+    at all) in some of the REGISTRIES (a list of MacroRegistry objects).
+    """
+    registries = list(registries)
+    names = set()
+    for registry in registries:
+        names.update(registry.db)
+    dependent = set()
+    for name in names:
+        signatures = {_stack_signature(r.db.get(name)) for r in registries}
+        if len(signatures) > 1:
+            dependent.add(name)
+    return dependent
+
+
+class _TracingRegistry(MacroRegistry):
+    """
+    A view of REGISTRY (shares the macro database), expanding for TARGET,
+    and recording the arch-dependent decisions.  Reads of the WATCHED macros
+    are recorded even if the specfile redefined them, which may only lead to
+    a needless additional expansion, never to a wrong result.
+    """
+    cacheable = False
+
+    def __init__(self, registry, target, watched):
+        super().__init__()
+        self.db = registry.db
+        self._fingerprints = registry._fingerprints  # pylint: disable=protected-access
+        self.target = target
+        self.watched = watched
+        self.conditions = {}
+        self.reads = set()
+
+    def __getitem__(self, name):
+        if name in self.watched:
+            self.reads.add(name)
+        return self.db[name]
+
+    def __contains__(self, name):
+        if name in self.watched:
+            self.reads.add(name)
+        return name in self.db
+
+    def undefine(self, name):
+        # the result depends on what was defined
+        if name in self.watched:
+            self.reads.add(name)
+        super().undefine(name)
+
+    def target_matches(self, arches):
+        result = self.target in arches
+        self.conditions[tuple(arches)] = result
+        return result
+
+
+class _Path:
+    """Arch-dependent decisions done by one expansion, and its result."""
+    def __init__(self, tracer, signatures, result):
+        self.conditions = tracer.conditions
+        self.signatures = {name: signatures[name] for name in tracer.reads}
+        self.result = result
+
+    def matches(self, target, signatures):
+        """True if TARGET with the macro SIGNATURES takes the same path."""
+        for arches, result in self.conditions.items():
+            if (target in arches) != result:
+                return False
+        for name, signature in self.signatures.items():
+            if signatures[name] != signature:
+                return False
+        return True
+
+
+def expand_spec_multitarget(name, content, registry, targets, tags=None,
+                            budget=None):
+    """
+    Expand the specfile CONTENT for each of the TARGETS architectures, and
+    return {target: result} dictionary, see norpm.batch.expand_spec() for the
+    result format.  Results of targets that take the same path through the
+    specfile are the same object.
+
+    REGISTRY is either a single MacroRegistry (only the target architecture
+    differs then), or a {target: MacroRegistry} dictionary, e.g., created by
+    system_macro_registry(target) calls.  The registries are left unchanged.
+    """
+    if isinstance(registry, MacroRegistry):
+        registries = {target: registry for target in targets}
+        watched = set()
+    else:
+        registries = registry
+        watched = arch_dependent_macros(registries[t] for t in targets)
+
+    paths = []
+    results = {}
+    for target in targets:
+        signatures = {name: _stack_signature(registries[target].db.get(name))
+                      for name in watched}
+        for path in paths:
+            if path.matches(target, signatures):
+                results[target] = path.result
+                break
+        else:
+            tracer = _TracingRegistry(registries[target], target, watched)
+            result = expand_spec(name, content, tracer, tags, budget)
+            paths.append(_Path(tracer, signatures, result))
+            results[target] = result
+    return results
@@ -29,12 +29,7 @@ def override_macro_registry(original_registry, overrides_filename, tag):
     registry.known_norpm_hacks()
     overrides = _get_overrides_from_file(overrides_filename)
 
-    def _warn_once(message):
-        if hasattr(_warn_once, "warned"):
-            return
-        setattr(_warn_once, "warned", True)
-        log.warning(message)
-
+    warned = False
     for macroname in overrides.keys():
         # No matter if defined for given TAG, we undefine the macro.
         # Think of `%fc43` macro for F44 TAG on F43 host.
@@ -52,9 +47,10 @@ def override_macro_registry(original_registry, overrides_filename, tag):
                     registry.define(macroname, (definition["value"],
                                                 definition["params"],
                                                 set()))
-        if not found:
-            _warn_once(f"Tag \"{tag}\" is not defined in "
-                       f"\"{overrides_filename}\" database, macros "
-                       "have unexpected values!")
+        if not found and not warned:
+            warned = True
+            log.warning("Tag \"%s\" is not defined in \"%s\" database, "
+                        "macros have unexpected values!", tag,
+                        overrides_filename)
 
     return registry
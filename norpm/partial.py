@@ -0,0 +1,350 @@
+"""
+Partial evaluation of specfiles.
+
+Some macros are known only later, per target or per distribution (e.g.,
+%dist, %_arch, %fedora), while the rest of the macro registry is shared.
+The partial_evaluate() call expands the specfile with the shared registry,
+keeping the parts that depend on the "dynamic" macros (or on the target
+architecture, %ifarch) unevaluated.  The result is a ResidualSpec, usually
+much smaller than the original specfile IR: the static %if blocks are folded
+away, and the static macro calls are replaced with their expansion.  The
+finish() call then completes the expansion for one concrete registry,
+cheaply.
+
+The "taint" propagates; macros (re)defined by the dynamic parts of the
+specfile (e.g., '%global dist_tag %{?dist}') are dynamic from that point on,
+and so are the tag macros like %release.  The top-level split is guarded
+similarly to norpm.compiled, and if the dynamic parts change it (e.g.,
+%{dynamic} expands to '#'), finish() falls back to the full execution of the
+original IR.
+"""
+
+import re
+
+from norpm.compiled import SpecIR, _Splitter, _is_parametric, compile_spec, \
+                           execute
+from norpm.multitarget import _TracingRegistry
+from norpm.specfile import (
+    TAG_MACROS,
+    ParserHooks,
+    _ParsingSnippet,
+    _SpecContext,
+    _classify_snippet,
+    _expand_tag_lines,
+    _reports_conditions,
+    _specfile_expand_generator,
+    _specfile_expand_string_generator,
+    line_ends_preamble,
+)
+
+_TAGS_TAINTED = set(TAG_MACROS) | {tag.upper() for tag in TAG_MACROS}
+_DEFINITION_RE = re.compile(r"%\{?(?:define|global|undefine)\s+([\w-]+)")
+
+
+class _Diverged(Exception):
+    """The residual guards don't hold, see finish()."""
+
+
+def _literal(text):
+    """Snippets yielding TEXT as is, when expanded."""
+    if text.startswith("%"):
+        # '%%' expands to a single '%'
+        return [_ParsingSnippet("%%"), _ParsingSnippet(text[1:])]
+    return [_ParsingSnippet(text)]
+
+
+class ResidualSpec:
+    """
+    Result of partial_evaluate().  The `ops` is a list of (op, argument)
+    pairs, where op is one of:
+
+    - "entry": the argument is (IR entry, depth, names) triple; the entry
+      is evaluated by finish(), and if it is dynamic (NAMES is not None),
+      it must only change the NAMES macros, and keep the number of unfolded
+      conditions at DEPTH (guard)
+    - "text": list of snippets with the already expanded text
+    - "comment": the expected comment state (guard)
+    - "parametric": tuple of (name, parametric) pairs (guard)
+
+    The `ops` is None if the partial evaluation failed; finish() then
+    executes the whole `ir`.
+    """
+    def __init__(self, ir, ops, dynamic):
+        self.ir = ir
+        self.ops = ops
+        self.dynamic = dynamic
+
+    @property
+    def entries(self):
+        """Number of snippets left for the evaluation in finish()."""
+        if self.ops is None:
+            return len(self.ir)
+        return sum(1 for op, _ in self.ops if op == "entry")
+
+    def replay(self, context, macros):
+        """Generator of the top-level snippets, for finish()."""
+        journal = macros._journal  # pylint: disable=protected-access
+        for op, argument in self.ops:
+            if op == "entry":
+                entry, depth, names = argument
+                context.in_comment = entry.comment_after
+                start = len(journal)
+                yield entry.snippet
+                if names is None:
+                    continue
+                if len(context.condition_stack) != depth or any(
+                        name not in names for _, name, _ in journal[start:]):
+                    raise _Diverged
+            elif op == "text":
+                yield from argument
+            elif op == "comment":
+                if bool(context.in_comment) != argument:
+                    raise _Diverged
+            elif any(_is_parametric(macros, name) != answer
+                     for name, answer in argument):
+                raise _Diverged
+
+
+class _PartialEvaluator:
+    """
+    Drives the expansion of one IR, top-level snippet by top-level snippet
+    ("window"), and decides what is left in the residual.
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, ir, context, tracer, dynamic_target):
+        self.ir = ir
+        self.context = context
+        self.tracer = tracer
+        self.dynamic_target = dynamic_target
+        self.ops = []
+        # dynamic flags, one for each context.condition_stack item
+        self.levels = []
+        self.preamble_done = False
+        self.needs_comment_guard = False
+        self.window = None
+        self.watched = frozenset(tracer.watched)
+
+    def snippets(self):
+        """The top-level snippets, see _specfile_expand_string_generator."""
+        entries = self.ir.replay_entries(self.context, self.tracer)
+        while True:
+            self._close_window()
+            try:
+                entry = next(entries)
+            except StopIteration:
+                return
+            self._open_window(entry)
+            yield entry.snippet
+
+    def tap(self, strings):
+        """Record the output of the current window."""
+        for string in strings:
+            self.window["output"].append(string)
+            yield string
+
+    def lines(self, strings):
+        """Track the end of preamble in the expanded output."""
+        for string in strings:
+            if not self.preamble_done:
+                self.preamble_done = line_ends_preamble(string)
+            yield string
+
+    def _open_window(self, entry):
+        tracer = self.tracer
+        tainted = tuple(d for d in entry.decisions if d[0] in tracer.watched)
+        if tainted:
+            self.ops.append(("parametric", tainted))
+        if self.needs_comment_guard:
+            self.ops.append(("comment", entry.comment_before))
+            self.needs_comment_guard = False
+        tracer.reads.clear()
+        tracer.conditions.clear()
+        self.window = {
+            "entry": entry,
+            "output": [],
+            "journal": len(tracer._journal),  # pylint: disable=protected-access
+            "stack": list(self.context.condition_stack),
+            "expanding": self.context.expanding,
+            "preamble_done": self.preamble_done,
+        }
+
+    def _close_window(self):
+        window, self.window = self.window, None
+        if window is None:
+            return
+        tracer = self.tracer
+        stack = self.context.condition_stack
+        before = window["stack"]
+        changes = tracer._journal[window["journal"]:]  # pylint: disable=protected-access
+        dynamic = bool(tracer.reads) or \
+            bool(self.dynamic_target and tracer.conditions)
+        if window["expanding"] and self.watched.intersection(
+                _DEFINITION_RE.findall(window["entry"].snippet.text)):
+            # (un)defining a dynamic macro, even if the static registry
+            # didn't change (e.g., %undefine of a macro not defined yet)
+            dynamic = True
+
+        static = self.levels.count(False)
+        if any(self.levels):
+            op = "entry"
+        elif not window["expanding"]:
+            op = None  # statically skipped block
+            dynamic = False
+        elif dynamic:
+            op = "entry"
+        elif stack != before:
+            # Statically decided %if/%else/%endif.  Anything more complicated
+            # (like conditions in macro expansions) is left to finish().
+            snippet = window["entry"].snippet
+            kind = _classify_snippet(snippet.text,
+                                     snippet.macro_starts_line).kind
+            op = None if kind in ("condition", "else", "endif") else "entry"
+            dynamic = op is not None
+        elif changes:
+            op = "entry"
+        else:
+            op = "text"
+
+        if op == "entry":
+            if len(stack) < static or any(
+                    old[:2] != new[:2]
+                    for old, new in zip(before[:static], stack[:static])):
+                # the folded conditions were changed by the finish() code
+                raise _Diverged
+            dynamic = dynamic or any(self.levels)
+            if dynamic:
+                self._taint(window, changes)
+
+        if len(stack) < len(before):
+            del self.levels[len(stack):]
+        else:
+            self.levels += [dynamic] * (len(stack) - len(before))
+
+        if op == "entry":
+            names = None
+            if dynamic:
+                names = self.watched
+            depth = len(stack) - static
+            self.ops.append(("entry", (window["entry"], depth, names)))
+            self.needs_comment_guard = True
+        elif op == "text":
+            text = "".join(window["output"])
+            if not text:
+                return
+            if self.ops and self.ops[-1][0] == "text":
+                text = self.ops.pop()[1] + text
+            self.ops.append(("text", text))
+
+    def _taint(self, window, changes):
+        """Macros possibly changed by the dynamic WINDOW are dynamic, too."""
+        names = {name for _, name, _ in changes}
+        if not window["expanding"]:
+            # not evaluated now, guess from the text (guarded in finish())
+            names.update(_DEFINITION_RE.findall(window["entry"].snippet.text))
+        if not window["preamble_done"]:
+            # the tags might be defined differently by finish()
+            names.update(_TAGS_TAINTED)
+        if not names <= self.watched:
+            self.watched = frozenset(self.watched | names)
+            self.tracer.watched.update(names)
+
+
+def partial_evaluate(spec, macros, dynamic, dynamic_target=True,
+                     budget=None):
+    """
+    Expand the SPEC (text, or SpecIR from compile_spec()) using the MACROS
+    registry, leaving the parts depending on the DYNAMIC macro names
+    unexpanded.  If DYNAMIC_TARGET is set, the %ifarch/%ifnarch conditions
+    are kept unevaluated, too.  Return ResidualSpec for finish().  The
+    MACROS registry is left unchanged.  The expansion errors (including the
+    exceeded BUDGET) are not raised; the whole specfile is left to finish()
+    then.
+    """
+    ir = spec if isinstance(spec, SpecIR) else compile_spec(spec, macros)
+    dynamic = frozenset(dynamic)
+    tracer = _TracingRegistry(macros, macros.target, set(dynamic))
+    context = _SpecContext(budget=budget).start()
+    evaluator = _PartialEvaluator(ir, context, tracer, dynamic_target)
+    splitter = _Splitter(evaluator.snippets())
+    token = tracer.checkpoint()
+    try:
+        strings = _specfile_expand_string_generator(context, ir.text, tracer,
+                                                    splitter=splitter)
+        for _ in evaluator.lines(_expand_tag_lines(
+                context, evaluator.tap(strings), tracer)):
+            pass
+    except Exception:  # pylint: disable=broad-exception-caught
+        # raised again by finish()
+        return ResidualSpec(ir, None, dynamic)
+    finally:
+        tracer.rollback(token)
+    ops = [(op, _literal(argument) if op == "text" else argument)
+           for op, argument in evaluator.ops]
+    return ResidualSpec(ir, ops, dynamic)
+
+
+def _needs_full_expansion(hooks):
+    """
+    The HOOKS can not be served from the residual; the folded static parts
+    would be missing in the read sets and conditions, and the sniff mode
+    expands all the branches.
+    """
+    return hooks.sniff_mode or hooks.track_reads or _reports_conditions(hooks)
+
+
+class _BufferedHooks(ParserHooks):
+    """
+    Delay the tag hook calls till finish() knows the result is valid.  Only
+    the tag_found(), tag_conditions() and tag_predicates() calls are
+    supported, see _needs_full_expansion().
+    """
+    def __init__(self, hooks):
+        self.hooks = hooks
+        self.calls = []
+
+    def tag_found(self, name, value, tag_raw):
+        self.calls.append(("tag_found", (name, value, tag_raw)))
+
+    def tag_conditions(self, name, condition_strings):
+        self.calls.append(("tag_conditions", (name, condition_strings)))
+
+    def tag_predicates(self, name, value, conditions):
+        self.calls.append(("tag_predicates", (name, value, conditions)))
+
+    def flush(self):
+        """Pass the recorded calls to the wrapped hooks."""
+        for method, args in self.calls:
+            getattr(self.hooks, method)(*args)
+
+
+def finish(residual, macros, hooks=None, budget=None):
+    """
+    Complete the expansion of the RESIDUAL specfile using the MACROS registry
+    (with the dynamic macros defined), and return the expanded specfile.  The
+    result is the same as the specfile_expand() of the original specfile
+    would give, except that the HOOKS.tag_conditions() calls only see the
+    dynamic conditions; the static ones are already folded.  The HOOKS
+    tracking the reads, in the sniff mode, or implementing condition_found()
+    get the full execution of the original IR.
+    """
+    hooks = hooks or ParserHooks()
+    if residual.ops is None or _needs_full_expansion(hooks):
+        return execute(residual.ir, macros, hooks, budget)
+
+    buffered = _BufferedHooks(hooks)
+    context = _SpecContext(buffered, budget).start()
+    splitter = _Splitter(residual.replay(context, macros))
+    token = macros.checkpoint()
+    try:
+        output = "".join(_specfile_expand_generator(
+            context, residual.ir.text, macros, splitter=splitter))
+    except _Diverged:
+        macros.rollback(token)
+        return execute(residual.ir, macros, hooks, budget)
+    except BaseException:
+        macros.commit(token)
+        buffered.flush()
+        raise
+    macros.commit(token)
+    buffered.flush()
+    return output
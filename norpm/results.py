@@ -0,0 +1,196 @@
+"""
+SQLite store of the corpus expansion results.
+
+Each batch run (see norpm.batch) is recorded as a row in the `runs` table,
+and each specfile result as one row in `results`, identified by the specfile
+name, its content digest, the registry fingerprint, the target
+architecture and the digest of the other run settings (the gathered tags,
+budget and norpm version, see run_settings()).  Re-running an unchanged
+specfile against an unchanged registry (with the same settings) re-uses the
+existing row, so the runs only reference it (the `run_results` table).  The tag values have their own indexed table, so the queries like
+"all specfiles with changed ExclusiveArch between two runs" are cheap; see
+changed().
+"""
+
+import json
+import sqlite3
+import time
+
+from norpm.batch import content_digest, run_settings
+
+# Bumped on incompatible schema changes.
+_SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    label TEXT,
+    fingerprint TEXT NOT NULL,
+    target TEXT,
+    settings TEXT NOT NULL,
+    started REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    spec TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    target TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    error TEXT,
+    time REAL,
+    UNIQUE (spec, digest, fingerprint, target, settings)
+);
+CREATE TABLE IF NOT EXISTS tags (
+    result INTEGER NOT NULL REFERENCES results (id),
+    tag TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (result, tag)
+);
+CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag, result);
+CREATE TABLE IF NOT EXISTS run_results (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    spec TEXT NOT NULL,
+    result INTEGER NOT NULL REFERENCES results (id),
+    PRIMARY KEY (run, spec)
+);
+"""
+
+# The results are inserted in transactions of this size.
+BATCH_SIZE = 500
+
+
+class ResultsStore:
+    """
+    The results database in PATH.  Use start_run() and record() (or add()) to
+    store the results, and changed() to compare the runs.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        schema = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        tables = self.conn.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE name = 'runs'"
+        ).fetchone()[0]
+        if tables and schema != _SCHEMA_VERSION:
+            raise ValueError(f"The results database {path} was created by "
+                             "an incompatible norpm version")
+        self.conn.executescript(_SCHEMA)
+        self.conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+
+    def close(self):
+        """Close the database connection."""
+        self.conn.close()
+
+    def start_run(self, registry, label=None, tags=None, budget=None):
+        """
+        Record a new run expanding the specfiles with REGISTRY (MacroRegistry,
+        only its fingerprint and target are stored), gathering the TAGS with
+        BUDGET (see expand_spec()), and return its id.
+        """
+        settings = run_settings(registry, tags, budget)
+        cursor = self.conn.execute(
+            "INSERT INTO runs (label, fingerprint, target, settings, started) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (label, settings["fingerprint"], settings["target"],
+             content_digest(json.dumps(settings, sort_keys=True)),
+             time.time()))
+        return cursor.lastrowid
+
+    def runs(self):
+        """List of the (id, label, fingerprint, target, started) tuples."""
+        return self.conn.execute(
+            "SELECT id, label, fingerprint, target, started FROM runs "
+            "ORDER BY id").fetchall()
+
+    def add(self, run, results, digests):
+        """
+        Store the RESULTS (list of the expand_spec() dictionaries) in one
+        transaction.  DIGESTS maps the specfile names to their content
+        digests, see content_digest().
+        """
+        conn = self.conn
+        fingerprint, target, settings = conn.execute(
+            "SELECT fingerprint, target, settings FROM runs WHERE id = ?",
+            (run,)).fetchone()
+        target = target or ""
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for result in results:
+                spec = result["spec"]
+                key = (spec, digests[spec], fingerprint, target, settings)
+                row = conn.execute(
+                    "SELECT id FROM results WHERE spec = ? AND digest = ? "
+                    "AND fingerprint = ? AND target = ? AND settings = ?",
+                    key).fetchone()
+                if row is None:
+                    result_id = conn.execute(
+                        "INSERT INTO results (spec, digest, fingerprint, "
+                        "target, settings, error, time) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        key + (result["error"], result["time"])).lastrowid
+                    conn.executemany(
+                        "INSERT INTO tags VALUES (?, ?, ?)",
+                        [(result_id, tag, json.dumps(values))
+                         for tag, values in result["tags"].items()])
+                else:
+                    result_id = row[0]
+                conn.execute("INSERT OR REPLACE INTO run_results "
+                             "VALUES (?, ?, ?)", (run, spec, result_id))
+
+    def record(self, run, results, digests, batch_size=BATCH_SIZE):
+        """
+        Pass through the RESULTS iterable, storing them by BATCH_SIZE
+        transactions, see add().
+        """
+        pending = []
+        for result in results:
+            pending.append(result)
+            if len(pending) >= batch_size:
+                self.add(run, pending, digests)
+                pending = []
+            yield result
+        if pending:
+            self.add(run, pending, digests)
+
+    def changed(self, old_run, new_run, tag=None):
+        """
+        Return the list of (spec, old, new) triples for the specfiles in both
+        runs, where the TAG values differ.  The OLD and NEW are the lists of
+        the tag values (None if not found).  Without TAG, compare the
+        expansion errors (OLD and NEW are error strings, or None).
+        """
+        if tag is None:
+            rows = self.conn.execute("""
+                SELECT o.spec, ro.error, rn.error
+                FROM run_results o
+                JOIN run_results n ON n.run = ? AND n.spec = o.spec
+                JOIN results ro ON ro.id = o.result
+                JOIN results rn ON rn.id = n.result
+                WHERE o.run = ? AND o.result != n.result
+                  AND ro.error IS NOT rn.error
+                ORDER BY o.spec""", (new_run, old_run)).fetchall()
+            return rows
+        rows = self.conn.execute("""
+            SELECT o.spec, tgo.value, tgn.value
+            FROM run_results o
+            JOIN run_results n ON n.run = ? AND n.spec = o.spec
+            LEFT JOIN tags tgo ON tgo.result = o.result AND tgo.tag = ?
+            LEFT JOIN tags tgn ON tgn.result = n.result AND tgn.tag = ?
+            WHERE o.run = ? AND o.result != n.result
+              AND tgo.value IS NOT tgn.value
+            ORDER BY o.spec""", (new_run, tag, tag, old_run)).fetchall()
+        return [(spec, None if old is None else json.loads(old),
+                 None if new is None else json.loads(new))
+                for spec, old, new in rows]
+
+
+def digesting(specs, digests):
+    """
+    Pass through the SPECS, (name, content) pairs, and remember their
+    content digests in the DIGESTS dictionary (for ResultsStore.record()).
+    """
+    for name, content in specs:
+        digests[name] = content_digest(content)
+        yield name, content
@@ -0,0 +1,90 @@
+"""
+Timing-aware scheduling of the batch expansion, see norpm.batch.
+
+Most of the specfiles expand in milliseconds, but a few (huge Go or texlive
+specfiles) take seconds.  If such a specfile is picked up last, the whole run
+waits for it.  The TimingHistory remembers how long each specfile took in
+the previous runs, and schedule() orders the work longest first, so the
+expensive specfiles start early and the cheap ones fill the gaps.
+
+The workers pull the work from one shared queue whenever they are idle (so
+an idle worker "steals" the remaining work), and to keep the queue overhead
+low, the cheap specfiles are grouped into batches of roughly the same
+estimated time.
+"""
+
+import json
+import os
+
+# The cheap specfiles are grouped into batches of this fraction of the total
+# estimated time per process.
+_BATCH_FRACTION = 1 / 16
+
+
+class TimingHistory:
+    """
+    The expansion times of the specfiles from the previous runs, keyed by the
+    specfile name, with the content digest and size they were measured for,
+    loaded from (and saved to) PATH, a JSON file.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.timings = {}
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as fd:
+                self.timings = json.load(fd)
+
+    def estimate(self, name, digest, size=None):
+        """
+        The estimated time of the specfile with the content DIGEST and SIZE,
+        or None if unknown.  If the specfile changed (different digest), the
+        old timing is scaled by the size ratio.
+        """
+        known = self.timings.get(name)
+        if known is None:
+            return None
+        old_digest, seconds, old_size = (known + [None])[:3]
+        if old_digest == digest or not size or not old_size:
+            return seconds
+        return seconds * size / old_size
+
+    def record(self, name, digest, seconds, size=None):
+        """Remember the specfile expansion time."""
+        if seconds is not None:
+            self.timings[name] = [digest, seconds, size]
+
+    def save(self, path=None):
+        """Write the history to PATH (or the file it was loaded from)."""
+        path = path or self.path
+        tmp = f"{path}.tmp{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as fd:
+            json.dump(self.timings, fd, separators=(",", ":"))
+        os.replace(tmp, path)
+
+
+def schedule(specs, estimates, processes, max_batch=None):
+    """
+    Return the list of batches (lists of the SPECS items), in the order they
+    should be dispatched to PROCESSES workers.  The ESTIMATES is the list of
+    the estimated times (or None if unknown) for the SPECS items.  The unknown
+    specfiles are assumed to take the median time of the known ones.  The
+    MAX_BATCH limits the number of specfiles in one batch.
+    """
+    known = sorted(e for e in estimates if e is not None)
+    median = known[len(known) // 2] if known else 0.0
+    estimates = [median if e is None else e for e in estimates]
+    # longest first, stable for the ties (e.g., all unknown)
+    order = sorted(range(len(specs)), key=lambda i: -estimates[i])
+
+    target = sum(estimates) / max(processes, 1) * _BATCH_FRACTION
+    batches = []
+    batch, batch_time = [], 0.0
+    for i in order:
+        batch.append(specs[i])
+        batch_time += estimates[i]
+        if batch_time >= target or len(batch) == max_batch:
+            batches.append(batch)
+            batch, batch_time = [], 0.0
+    if batch:
+        batches.append(batch)
+    return batches
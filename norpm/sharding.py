@@ -0,0 +1,214 @@
+"""
+Splitting the batch expansion across multiple nodes, see norpm.batch.
+
+There are two options, neither needs a running service:
+
+- Deterministic sharding, in_shard(); each of the N nodes expands the
+  specfiles with hash(basename) % N == its index.
+- The WorkQueue in a shared directory (e.g., NFS).  The specfile paths are
+  put into the `todo` subdirectory (one file per specfile), and the workers
+  claim them by renaming them into `claimed`; the atomic rename(2) guarantees
+  that each item is claimed exactly once.  Faster nodes simply claim more.
+  The claims of crashed workers are put back into `todo` after a timeout,
+  or when the worker is restarted under the same name, see reclaim().
+
+Each node writes its own JSON Lines result file, and merge_results()
+combines them.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+
+
+def _hash(name):
+    return int(hashlib.sha256(name.encode("utf-8")).hexdigest()[:16], 16)
+
+
+def parse_shard(string):
+    """Parse the 'I/N' STRING, return the (I, N) pair (I counts from 0)."""
+    try:
+        index, count = (int(x) for x in string.split("/"))
+    except ValueError as exc:
+        raise ValueError(f"Invalid shard '{string}', expected I/N") from exc
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard '{string}', I must be in [0, N)")
+    return index, count
+
+
+def in_shard(specs, index, count):
+    """
+    Filter the SPECS, (name, content) pairs, and yield those belonging to the
+    INDEX-th of COUNT shards.  The specfile basenames are hashed, so the
+    corpus may be mounted at different paths on the nodes.
+    """
+    for name, content in specs:
+        if _hash(os.path.basename(name)) % count == index:
+            yield name, content
+
+
+class WorkQueue:
+    """
+    The work queue in DIRECTORY, see the module docstring.  Every node calls
+    populate() with the same list of specfiles (only the first call takes
+    effect), and then claims the work with claims().  The WORKER name
+    defaults to "hostname-pid", and must be unique.  The items claimed for
+    longer than STALE_AFTER seconds are considered abandoned (by a crashed
+    worker), and are claimed again when there's no other work left.
+    """
+    def __init__(self, directory, worker=None, stale_after=None):
+        self.directory = directory
+        self.todo = os.path.join(directory, "todo")
+        self.claimed = os.path.join(directory, "claimed")
+        self.done_dir = os.path.join(directory, "done")
+        self.results = os.path.join(directory, "results")
+        self.worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+        self.stale_after = stale_after
+        for path in [directory, self.claimed, self.done_dir, self.results]:
+            os.makedirs(path, exist_ok=True)
+
+    def populate(self, names, poll=0.5):
+        """
+        Put the specfile NAMES (paths) into the queue, unless already
+        populated by another worker (then wait till it is ready).  Return
+        True if this call populated it.
+        """
+        marker = os.path.join(self.directory, "populated")
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            while not os.path.exists(self.todo):
+                time.sleep(poll)
+            return False
+        tmp = os.path.join(self.directory, f"todo.{self.worker}")
+        os.mkdir(tmp)
+        for name in names:
+            item = hashlib.sha256(name.encode("utf-8")).hexdigest()[:32]
+            with open(os.path.join(tmp, item), "w", encoding="utf-8") as fd:
+                fd.write(name)
+        # the other workers see all the items at once
+        os.rename(tmp, self.todo)
+        return True
+
+    def claim(self):
+        """Claim one item, return the (item, specfile name) pair or None."""
+        while True:
+            try:
+                items = sorted(os.listdir(self.todo))
+            except FileNotFoundError:
+                return None
+            if not items:
+                if self.stale_after is not None and \
+                        self.reclaim(max_age=self.stale_after):
+                    continue
+                return None
+            for item in items:
+                # the claim time is a part of the name, set atomically
+                claim = f"{item}.{int(time.time())}.{self.worker}"
+                claimed = os.path.join(self.claimed, claim)
+                try:
+                    os.rename(os.path.join(self.todo, item), claimed)
+                except FileNotFoundError:
+                    continue  # claimed by somebody else
+                with open(claimed, "r", encoding="utf-8") as fd:
+                    return claim, fd.read()
+
+    def reclaim(self, max_age=None, worker=None):
+        """
+        Put the items claimed more than MAX_AGE seconds ago, or claimed by the
+        WORKER name, back into the queue.  Return their number.
+        """
+        count = 0
+        now = time.time()
+        for claim in os.listdir(self.claimed):
+            item, stamp, owner = claim.split(".", 2)
+            if owner != worker and \
+                    (max_age is None or now - int(stamp) <= max_age):
+                continue
+            try:
+                os.rename(os.path.join(self.claimed, claim),
+                          os.path.join(self.todo, item))
+            except FileNotFoundError:
+                continue  # finished, or reclaimed by somebody else
+            count += 1
+        return count
+
+    def done(self, item):
+        """
+        Mark the claimed ITEM as done (unless it was reclaimed meanwhile; then
+        it is expanded twice, and merge_results() picks one result).
+        """
+        try:
+            os.rename(os.path.join(self.claimed, item),
+                      os.path.join(self.done_dir, item))
+        except FileNotFoundError:
+            pass
+
+    def results_file(self):
+        """The JSON Lines result file path for this worker."""
+        return os.path.join(self.results, f"{self.worker}.jsonl")
+
+    def claims(self, reader, window):
+        """
+        Return the (specs, finish) pair.  The SPECS generator claims the
+        items one by one, and yields the (name, content) pairs; the content
+        is read by READER(name).  The FINISH(results) generator passes the
+        results through, and marks their items done.  At most WINDOW items
+        are claimed ahead of the results, so the (eagerly consuming) worker
+        pools don't claim all the work at once; it must be larger than the
+        number of items the worker pool expands at once (e.g., the number
+        of processes times the fork-server batch size).  The items left
+        claimed by a previous (crashed) run of the same worker are put back
+        first.
+        """
+        self.reclaim(worker=self.worker)
+        slots = threading.Semaphore(window)
+        items = {}
+        lock = threading.Lock()
+
+        def _specs():
+            while True:
+                slots.acquire()  # pylint: disable=consider-using-with
+                claimed = self.claim()
+                if claimed is None:
+                    return
+                item, name = claimed
+                with lock:
+                    items[name] = item
+                yield name, reader(name)
+
+        def _finish(results):
+            for result in results:
+                with lock:
+                    item = items.pop(result["spec"])
+                self.done(item)
+                slots.release()
+                yield result
+
+        return _specs(), _finish
+
+
+def merge_results(paths):
+    """
+    Read the JSON Lines result files (or directories with *.jsonl files) in
+    PATHS, and return the results sorted by the specfile name.  If one
+    specfile has multiple results, the last read is used.
+    """
+    results = {}
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, f) for f in os.listdir(path)
+                           if f.endswith(".jsonl"))
+        else:
+            files = [path]
+        for filename in files:
+            with open(filename, "r", encoding="utf-8") as fd:
+                for line in fd:
+                    if not line.strip():
+                        continue
+                    result = json.loads(line)
+                    results[result["spec"]] = result
+    return [results[name] for name in sorted(results)]
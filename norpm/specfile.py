@@ -15,17 +15,19 @@ specfile_expand                 | entrypoint
 
 from collections import deque
 from operator import xor
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from functools import lru_cache
+import hashlib
+import os
 import re
 
 from norpm.tokenize import tokenize, Special, BRACKET_TYPES, OPENING_BRACKETS
-from norpm.macro import (is_macro_character, parse_macro_call,
-                         drop_curly_brackets, MacroDefinition)
+from norpm.macro import is_macro_character, parse_macro_call, drop_curly_brackets
 from norpm.macrofile import macrofile_parse, macrofile_split_generator
 from norpm.getopt import getopt
 from norpm.logging import get_logger
 from norpm.expression import eval_rpm_expr
-from norpm.exceptions import NorpmSyntaxError, NorpmRecursionError
+from norpm.exceptions import NorpmError, NorpmSyntaxError, NorpmRecursionError
 from norpm.builtins import BUILTINS, QuotedString
 
 
@@ -49,6 +51,137 @@ class ParserHooks:
         """Called when tag is found, brings out a list of condition strings
         evaluated."""
 
+    def condition_found(self, iftype, expression, definitions):
+        """Called for each %if, %ifarch and %ifnarch statement, with the raw
+        (not yet expanded) EXPRESSION.  The return value is remembered, and
+        passed down to tag_predicates()."""
+
+    def tag_predicates(self, name, value, conditions):
+        """Called when tag is found.  The CONDITIONS is a list of
+        (condition_found() return value, negated) pairs, one for each
+        enclosing %if* statement."""
+
+    # Set to True to get the tag_reads() and spec_reads() calls.
+    track_reads = False
+
+    def tag_reads(self, name, value, reads):
+        """Called when tag is found.  READS is the {macro name: frozenset of
+        definition versions} dictionary, see definition_version(); the macros
+        read by the tag line expansion, the enclosing conditions, and
+        (transitively) by the definitions of the specfile macros used."""
+
+    def spec_reads(self, reads):
+        """Called at the end of specfile expansion, with all the macros read
+        (the same format as in tag_reads())."""
+
+
+def _reports_conditions(hooks):
+    """True if HOOKS implement condition_found(); its results (passed down
+    to tag_predicates()) can not be replayed from a cache."""
+    return type(hooks).condition_found is not ParserHooks.condition_found
+
+
+# Key of the target architecture in the read sets (%ifarch), the version is
+# the architecture name.
+READ_TARGET = "<target>"
+
+
+_PARAMETER_RE = re.compile(r"^(\d+|\*\*?|#|-\w\*?)$")
+
+
+def definition_version(definition):
+    """
+    Short digest identifying the MacroDefinition, or None if the macro is
+    not defined.
+    """
+    if definition is None or isinstance(definition, str):
+        return definition
+    data = repr((definition.value, definition.params,
+                 sorted(definition.modifiers or ())))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+def _merge_reads(target, reads):
+    for name, definitions in reads.items():
+        try:
+            target[name].update(definitions)
+        except KeyError:
+            target[name] = set(definitions)
+
+
+class _ReadTracker:
+    """
+    The macro reads done during one specfile expansion, see
+    ParserHooks.track_reads.  Each read set is a {name: set of
+    MacroDefinition, None or target architecture} dictionary.  The reads
+    are recorded into the whole-`spec` set, the current (tag) `line` set, and
+    the additionally pushed scopes.  The specfile definitions (%global, tags
+    like %name) remember the reads they depend on in `deps`.
+    """
+    def __init__(self):
+        self.spec = {}
+        self.line = {}
+        self.scopes = [self.spec, self.line]
+        self.conditions = []
+        self.deps = {}
+        self._hidden = []
+
+    def read(self, name, definition):
+        """Record reading the DEFINITION of NAME."""
+        for scope in self.scopes:
+            try:
+                scope[name].add(definition)
+            except KeyError:
+                scope[name] = {definition}
+        deps = self.deps.get(definition)
+        if deps:
+            for scope in self.scopes:
+                _merge_reads(scope, deps)
+
+    def read_macro(self, name, macros):
+        """Record reading the current definition of NAME from MACROS."""
+        if name in ("define", "global") or _PARAMETER_RE.match(name):
+            # %1, %*, %-f, etc. are derived from the (recorded) call arguments
+            return
+        self.read(name, macros[name].stack[-1] if name in macros else None)
+
+    def push_scope(self, line=True):
+        """Start recording into a new read set, see pop_scope().  If LINE is
+        False, the reads are not recorded into the current line set."""
+        self._hidden.append(None if line else self.scopes[1])
+        if not line:
+            self.scopes[1] = {}
+        self.scopes.append({})
+
+    def pop_scope(self):
+        """Stop recording into the last scope, and return it."""
+        hidden = self._hidden.pop()
+        if hidden is not None:
+            self.scopes[1] = hidden
+        return self.scopes.pop()
+
+    def new_line(self):
+        """The tag line is complete."""
+        self.line = self.scopes[1] = {}
+
+    def with_conditions(self, reads):
+        """Return READS extended with the reads of the current conditions."""
+        result = {}
+        for item in [reads] + self.conditions:
+            _merge_reads(result, item)
+        return result
+
+    def define(self, definition, reads):
+        """The (new) DEFINITION depends on READS."""
+        if reads:
+            self.deps[definition] = reads
+
+    @staticmethod
+    def versions(reads):
+        """The READS set in the form passed to ParserHooks."""
+        return {name: frozenset(definition_version(d) for d in definitions)
+                for name, definitions in reads.items()}
+
 
 SHELL_REGEXP_HACKS = [{
     # many packages use '%(c=%{commit0}; echo ${c:0:7})'
@@ -70,14 +203,25 @@ class _SpecContext:
     Attributes
     ----------
 
-    condition_stack : list of (bool, bool) pairs.
+    condition_stack : list of (bool, bool, str, object) tuples.
         First bool represents original %if value.  Second bool denotes that
-        %else flipped the meaning.
+        %else flipped the meaning.  Then the raw %if expression, and the value
+        returned by the ParserHooks.condition_found() hook.
         The library keeps producing output (and processing nested definitions)
         as long as all the items in stack are True.
     in_expr : None or string
         Expression type, e.g., 'if'.  We can't have '%if 1 %if', e.g., this is
         to note that we are parsing `1 %if` expression.
+    expansion_path : list of (name, MacroDefinition) pairs
+        Non-parametric macros being expanded, outermost first.  Used to detect
+        recursion loops early.
+    entered : None or (name, MacroDefinition) pair
+        Set by _expand_snippet() when it returns the (to be expanded) body of
+        a non-parametric macro.
+    budget : None or ExpansionBudget
+        Limits of the expansion.
+    reads : None or _ReadTracker
+        The macro reads, if ParserHooks.track_reads is set.
     """
 
     condition_stack = None
@@ -86,26 +230,63 @@ class _SpecContext:
     hooks = None
     target = None
     calls = None
+    expansion_path = None
+    entered = None
+    budget = None
+    reads = None
 
-    def __init__(self, hooks=None):
+    def __init__(self, hooks=None, budget=None):
         self.condition_stack = []
+        self.expansion_path = []
         self.hooks = hooks or ParserHooks()
+        self.budget = budget
+        if self.hooks.track_reads:
+            self.reads = _ReadTracker()
+
+    def start(self):
+        """Called by entrypoints, before the expansion starts."""
+        if self.budget:
+            self.budget.start()
+        return self
+
+    def check_recursion(self, entered, pending=()):
+        """
+        Raise NorpmRecursionError if the ENTERED (name, definition) pair is
+        already being expanded, either in the expansion_path, or in the
+        PENDING list.  Macros redefined in the meantime are not a loop.
+        """
+        name, definition = entered
+        path = self.expansion_path + list(pending)
+        for index, (_, other) in enumerate(path):
+            if other is definition:
+                break
+        else:
+            return
+        cycle = [x for x, _ in path[index:]] + [name]
+        raise NorpmRecursionError(
+            f"Macro %{name} causes recursion loop: "
+            + " -> ".join("%" + x for x in cycle), cycle)
 
     @property
     def expanding(self):
         """Return True if we are expanding."""
         if self.hooks.sniff_mode:
             return True
-        for cond, flipped, _ in self.condition_stack:
+        for cond, flipped, _, _ in self.condition_stack:
             if not xor(cond, flipped):
                 return False
         return True
 
-    def condition(self, expanding, raw_expr):
-        """Nest into the stack of conditions."""
+    def condition(self, expanding, raw_expr, iftype=None, definitions=None,
+                  reads=None):
+        """Nest into the stack of conditions.  READS is the read set of the
+        condition expression (if tracked)."""
         if self.in_comment:
             return
-        self.condition_stack.append((expanding, False, raw_expr))
+        symbol = self.hooks.condition_found(iftype, raw_expr, definitions)
+        self.condition_stack.append((expanding, False, raw_expr, symbol))
+        if self.reads is not None:
+            self.reads.conditions.append(reads or {})
 
     def close_condition(self):
         """Emerge from one condition level."""
@@ -114,16 +295,18 @@ class _SpecContext:
         try:
             self.condition_stack.pop()
         except IndexError:
-            pass
+            return
+        if self.reads is not None:
+            self.reads.conditions.pop()
 
     def negate_condition(self):
         """Revert last ondition upon %else."""
         if self.in_comment:
             return
-        cond, flipped, raw_expr = self.condition_stack[-1]
+        cond, flipped, raw_expr, symbol = self.condition_stack[-1]
         if flipped:
             raise NorpmSyntaxError("Double %else")
-        self.condition_stack[-1] = (cond, True, raw_expr)
+        self.condition_stack[-1] = (cond, True, raw_expr, symbol)
 
 
 def specfile_split(file_contents, macros):
@@ -181,6 +364,8 @@ class _ParsingSnippet:
     text: str
     in_comment: bool = False
     macro_starts_line: bool = True
+    # pre-computed _ClassifiedSnippet, see norpm.compiled
+    classified: object = field(default=None, compare=False, repr=False)
     def __str__(self):
         return self.text
     def startswith(self, start):
@@ -310,6 +495,11 @@ def _specfile_split_generator(context, string, macros):
 
             if c in ['\t', ' ']:
                 macroname = buffer[1:]
+                if context.reads is not None and \
+                        not getattr(macros, "records_decisions", False) and \
+                        not _is_special(macroname) and \
+                        not _is_builtin(macroname):
+                    context.reads.read_macro(macroname, macros)
                 if _is_special(macroname) or \
                         _is_builtin(macroname) or \
                         macroname in macros and macros[macroname].parametric:
@@ -412,6 +602,28 @@ def _specfile_split_generator(context, string, macros):
     yield _snippet()
 
 
+def _evaluate_condition(context, iftype, expr, definitions, depth):
+    """Expand and evaluate the %if/%ifarch/%ifnarch EXPR."""
+    context.in_expr = True
+    expr = _specfile_expand_string(context, expr, definitions, depth+1)
+    context.in_expr = False
+    if iftype == "%if":
+        try:
+            return _eval_expression(expr)
+        except NorpmSyntaxError:
+            log.error("Failed to parse 'if' expression: %s", expr)
+            return False
+    if iftype in ["%ifarch", "%ifnarch"]:
+        arches = expr.split()
+        if context.reads is not None:
+            context.reads.read(READ_TARGET, definitions.target)
+        expr = definitions.target_matches(arches)
+        if iftype == "%ifnarch":
+            expr = not expr
+        return expr
+    return True  # todo arch
+
+
 def _expand_internal(context, depth, internal, params, snippet, db):
     """Return None if not internal, otherwise return expanded snippet."""
     try:
@@ -424,45 +636,204 @@ def _expand_internal(context, depth, internal, params, snippet, db):
         # TODO drop the two-type hack from parse_macro_call()
         params = _expand_params(context, params, db, depth+1)
 
+    if context.budget and (size := builtin.output_size(params)):
+        context.budget.reserve(size)
+
+    if internal == "undefine" and params and context.reads is not None:
+        # the result depends on what was defined before
+        context.reads.read_macro(str(params[0]), db)
+
     return builtin.eval(snippet, params, db)
 
 
-def _parse_condition(full_snippet):
-    """The snippet starts with % character.  We want to decide if this is a
-    condition (or return None), and then split into left and right hand side."""
+@dataclass(frozen=True)
+class _ClassifiedSnippet:
+    """
+    Pre-parsed snippet, see _classify_snippet().  The KIND is one of 'percent',
+    'text', 'shell', 'expr', 'condition', 'else', 'endif', 'special', 'define',
+    'global', 'invalid' and 'call'.  For conditions, NAME is the '%if' keyword
+    and PARAMS the expression.  For definitions, PARAMS is the 'name body'
+    string, and DEFINITION the pre-parsed (name, raw body, params, modifiers)
+    tuple; see _parse_definition().
+    """
+    kind: str
+    name: str = None
+    conditionals: frozenset = frozenset()
+    params: object = None
+    alt: str = None
+    definition: tuple = None
 
-    snippet = full_snippet.text
-    terminator = 0
-    keyword = ""
-    for keyword in ["%ifnarch", "%ifarch", "%if"]:
-        if snippet.startswith(keyword):
-            terminator = len(keyword)
-            break
 
-    if snippet == keyword:
-        raise NorpmSyntaxError(f"{keyword} without expression")
+# '%(', '%[', or the optionally curly-bracketed leading word of the snippet
+_SNIPPET_HEAD_RE = re.compile(r'%(?:([(\[])|(\{)?([A-Za-z0-9_]*))')
 
-    if terminator == 0:
-        return None
+
+def _classify_condition(snippet, keyword, macro_starts_line):
+    """The snippet starts with %if-like KEYWORD.  Decide if this is a
+    condition (or return None), and split it to keyword and expression."""
+    terminator = len(keyword) + 1
+    if snippet == "%" + keyword:
+        raise NorpmSyntaxError(f"%{keyword} without expression")
 
     if snippet[terminator] in ["\r", "\n"]:
-        raise NorpmSyntaxError(f"{snippet[:terminator]} without expression")
+        raise NorpmSyntaxError(f"%{keyword} without expression")
 
-    if not full_snippet.macro_starts_line:
+    if not macro_starts_line:
         return None
 
     if snippet[terminator].isspace():
         items = snippet.split(maxsplit=1)
         if len(items) <= 1:
             raise NorpmSyntaxError("%if without expression")
-        return (keyword, snippet[terminator:])
+        return _ClassifiedSnippet("condition", "%" + keyword,
+                                  params=snippet[terminator:])
 
     if snippet[terminator] == "%":
-        return (keyword, snippet[terminator:])
+        return _ClassifiedSnippet("condition", "%" + keyword,
+                                  params=snippet[terminator:])
+    return None
+
 
+def _classify_else_endif(snippet, keyword, _macro_starts_line):
+    terminator = len(keyword) + 1
+    if len(snippet) == terminator or snippet[terminator].isspace():
+        return _ClassifiedSnippet(keyword)
     return None
 
 
+_HEAD_CLASSIFIERS = {
+    "if": _classify_condition,
+    "ifarch": _classify_condition,
+    "ifnarch": _classify_condition,
+    "else": _classify_else_endif,
+    "endif": _classify_else_endif,
+}
+
+
+# The '%define' and '%global' header: name, optional (params) and <modifiers>.
+_DEFINITION_RE = re.compile(
+    r'\s*(?P<name>[^\s\\(<%]+)'
+    r'(?:\((?P<params>[^)\\%]*)\)|\s|(?=<))'
+    r'(?P<modifiers>(?:[^\S\n]|<[^>\\%]*>)*)'
+)
+_MODIFIERS_RE = re.compile(r'<([^>]*)>')
+_BACKSLASH_RE = re.compile(r'\\(.)?', re.DOTALL)
+_LEADING_SPACES_RE = re.compile(r'[^\S\n]*')
+
+
+def _parse_definition(text):
+    """
+    Parse the '%define' or '%global' statement TEXT (without the keyword) into
+    (name, raw_body, params, modifiers) tuple.  Return None if the header is
+    not trivial (escapes, macros, unterminated params, ...), and
+    macrofile_split_generator() needs to parse it.
+    """
+    match = _DEFINITION_RE.match(text)
+    if not match:
+        return None
+    body = text[match.end():]
+    if body[:1] in ["<", "\\"]:
+        return None
+    modifiers = frozenset("".join(_MODIFIERS_RE.findall(match["modifiers"])))
+    return match["name"], body, match["params"], modifiers
+
+
+def _definition_body(body):
+    """
+    Unescape and strip the (possibly expanded) raw definition body, the same
+    way macrofile_split_generator() does.
+    """
+    if '\\' in body:
+        body = _BACKSLASH_RE.sub(
+            lambda m: "" if m[1] in [None, "\n"] else m[1], body)
+    return body[_LEADING_SPACES_RE.match(body).end():].rstrip()
+
+
+def _define_global(context, text, definition, macros, depth):
+    """
+    Handle '%global TEXT'.  The body is expanded at the time of definition,
+    unless the <l> modifier is used.  The outer specfile conditions don't
+    apply to the expansion, so we expand in a separate context.
+    """
+    body_context = _SpecContext(budget=context.budget)
+    tracker = body_context.reads = context.reads
+    if tracker is not None:
+        # the tag lines only depend on the macro if they read it
+        tracker.push_scope(line=False)
+    try:
+        name = _define_global_body(body_context, text, definition, macros,
+                                   depth)
+    finally:
+        if tracker is not None:
+            reads = tracker.with_conditions(tracker.pop_scope())
+    if tracker is not None:
+        tracker.define(macros[name].stack[-1], reads)
+
+
+def _define_global_body(body_context, text, definition, macros, depth):
+    if definition is None:
+        name, body, params, modifiers = next(
+            macrofile_split_generator('%' + text, inspec=True))
+        if 'l' not in modifiers:
+            expanded = _specfile_expand_string(body_context, text, macros,
+                                               depth+1)
+            name, body, params, _ = next(
+                macrofile_split_generator('%' + expanded, inspec=True))
+        macros[name] = (body, params, modifiers)
+        return name
+
+    name, body, params, modifiers = definition
+    if 'l' not in modifiers:
+        # The header is a plain text, copied verbatim to the output.  Expand
+        # it together with the body so the first body line is not considered
+        # a line start.
+        header_length = len(text) - len(body)
+        body = _specfile_expand_string(body_context, text, macros,
+                                       depth+1)[header_length:]
+    macros[name] = (_definition_body(body), params, set(modifiers))
+    return name
+
+
+@lru_cache(maxsize=16384)
+def _classify_snippet(snippet, macro_starts_line):
+    """
+    Classify the snippet text (that is going to be expanded) in a single pass,
+    so _expand_snippet() doesn't need to parse it again.  Results are cached
+    per distinct snippet.
+    """
+    if snippet in ['%', '%%']:
+        return _ClassifiedSnippet("percent")
+
+    if not snippet.startswith("%"):
+        return _ClassifiedSnippet("text")
+
+    head = _SNIPPET_HEAD_RE.match(snippet)
+    bracket, curly, word = head.groups()
+    if bracket == "(":
+        return _ClassifiedSnippet("shell")
+    if bracket == "[":
+        return _ClassifiedSnippet("expr", params=snippet[2:-1])
+
+    rest = snippet[head.end():]
+    if not curly:
+        if classifier := _HEAD_CLASSIFIERS.get(word):
+            if classified := classifier(snippet, word, macro_starts_line):
+                return classified
+        if not rest and _is_special(word):
+            return _ClassifiedSnippet("special")
+
+    if _is_definition(word) and rest[:1] in ["\t", " "]:
+        _, params = drop_curly_brackets(snippet).split(maxsplit=1)
+        return _ClassifiedSnippet(word, params=params,
+                                  definition=_parse_definition(params))
+
+    success, name, conditionals, params, alt = parse_macro_call(snippet)
+    if not success:
+        return _ClassifiedSnippet("invalid")
+    return _ClassifiedSnippet("call", name, frozenset(conditionals), params,
+                              alt)
+
+
 def _eval_expression(snippet):
     if '%' in snippet:
         return False
@@ -505,39 +876,57 @@ class _HideAndSeekMacro:
 def _apply_oneshot(context, retval, name, definitions, modifiers, depth):
     if 'o' not in modifiers:
         return retval
-    expanded = _specfile_expand_string(context, str(retval), definitions, depth+1)
+    entered = (name, definitions[name].stack[-1])
+    context.check_recursion(entered)
+    context.expansion_path.append(entered)
+    try:
+        expanded = _specfile_expand_string(context, str(retval), definitions,
+                                           depth+1)
+    finally:
+        context.expansion_path.pop()
     # Replace the oneshot definition in-place with the cached literal so that
     # %undefine pops this single entry and exposes the previous stack level
     # (e.g. a plain %define).  Pushing a new entry would leave the oneshot
     # definition underneath, causing it to re-trigger after %undefine.
-    macro = definitions[name]
-    macro.stack[-1] = MacroDefinition(expanded, None)
+    definitions.replace(name, expanded)
     return expanded
 
 
+def _snippet_classified(snippet):
+    """
+    The _ClassifiedSnippet for the _ParsingSnippet, either the one stored by
+    norpm.compiled, or from _classify_snippet().
+    """
+    if snippet.classified is not None:
+        return snippet.classified
+    return _classify_snippet(snippet.text, snippet.macro_starts_line)
+
+
 def _expand_snippet(context, snippet, definitions, depth=0):
     full_snippet = snippet
     snippet = full_snippet.text
 
-    if snippet in ['%', '%%']:
+    classified = _snippet_classified(full_snippet)
+    kind = classified.kind
+
+    if kind == "percent":
         return '%'
 
-    if not snippet.startswith("%"):
+    if kind in ["text", "special", "invalid"]:
         return snippet
 
-    if snippet.startswith("%("):
+    if kind == "shell":
         for hack in SHELL_REGEXP_HACKS:
             if m := hack["regexp"].match(snippet):
                 return hack["method"](m)
         return snippet
 
-    if snippet.startswith("%["):
-        stripped = snippet[2:-1]
+    if kind == "expr":
         if context.expanding:
             try:
                 filtered_output = []
                 hasm = _HideAndSeekMacro(context, definitions, depth)
-                for part in SpecfileSplitGenerator(context, stripped,
+                for part in SpecfileSplitGenerator(context, classified.params,
                                                    definitions):
                     if not part.startswith("%"):
                         filtered_output.append(str(part))
@@ -552,66 +941,62 @@ def _expand_snippet(context, snippet, definitions, depth=0):
                 return snippet
         return ""
 
-    if cond := _parse_condition(full_snippet):
+    if kind == "condition":
         if context.in_expr:
             raise NorpmSyntaxError("%if %if")
 
-        iftype, expr = cond
+        iftype, expr = classified.name, classified.params
         # expand the expression content first
         log.debug("Expression: %s", expr)
         raw_expr = expr
 
+        tracker = context.reads
+        reads = None
         if context.expanding:
-            context.in_expr = True
-            expr = _specfile_expand_string(context, expr, definitions, depth+1)
-            context.in_expr = False
-            if iftype == "%if":
-                try:
-                    expr = _eval_expression(expr)
-                except NorpmSyntaxError:
-                    log.error("Failed to parse 'if' expression: %s", expr)
-                    expr = False
-            elif iftype in ["%ifarch", "%ifnarch"]:
-                arches = expr.split()
-                expr = definitions.target in arches
-                if iftype == "%ifnarch":
-                    expr = not expr
-            else:
-                expr = True  # todo arch
+            if tracker is not None:
+                tracker.push_scope()
+            try:
+                expr = _evaluate_condition(context, iftype, expr, definitions,
+                                           depth)
+            finally:
+                if tracker is not None:
+                    reads = tracker.pop_scope()
         else:
             expr = False
 
-        context.condition(expr, raw_expr)
+        context.condition(expr, raw_expr, iftype, definitions, reads)
         return None
 
-    cond_attempt = snippet.split()
-    if cond_attempt[0] == "%else":
+    if kind == "else":
         context.negate_condition()
         if full_snippet.in_comment:
             return snippet
         return None
 
-    if cond_attempt[0] == "%endif":
+    if kind == "endif":
         context.close_condition()
         return None
 
-    if _is_special(snippet[1:]):
-        return snippet
-
-    if _isdef_start(snippet):
+    if kind == "define":
         if not context.expanding:
             return ""
-        call = drop_curly_brackets(snippet)
-        _, params = call.split(maxsplit=1)
-        macrofile_parse("%" + params, definitions, inspec=True)
+        if classified.definition is None:
+            macrofile_parse("%" + classified.params, definitions, inspec=True)
+            return ""
+        name, body, params, modifiers = classified.definition
+        definitions[name] = (_definition_body(body), params, set(modifiers))
+        if context.reads is not None:
+            context.reads.define(definitions[name].stack[-1],
+                                 context.reads.with_conditions({}))
         return ""
 
-    success, name, conditionals, params, alt = parse_macro_call(snippet)
-    if not success:
-        return snippet
+    name, conditionals = classified.name, classified.conditionals
+    params, alt = classified.params, classified.alt
 
     if context.calls is not None:
         context.calls.add(name)
+    if context.reads is not None and not _is_builtin(name):
+        context.reads.read_macro(name, definitions)
 
     defined = name in definitions or _is_builtin(name)
 
@@ -634,7 +1019,12 @@ def _expand_snippet(context, snippet, definitions, depth=0):
         if defined and alt:
             return alt
 
-        return definitions[name].value if defined else ""
+        if not defined:
+            return ""
+        macro = definitions[name]
+        if not macro.parametric:
+            context.entered = (name, macro.stack[-1])
+        return macro.value
 
     if _is_special(name):
         return snippet
@@ -660,7 +1050,11 @@ def _expand_snippet(context, snippet, definitions, depth=0):
     # oneshot ('<o>') macro gets expanded-and-cached on first use even when
     # it is invoked without arguments (e.g. %define foo<o> %bar).
     if not params or macro.params is None:
-        return _apply_oneshot(context, retval, name, definitions, modifiers, depth)
+        retval = _apply_oneshot(context, retval, name, definitions, modifiers,
+                                depth)
+        if macro.params is None:
+            context.entered = (name, macro.stack[-1])
+        return retval
 
     # RPM also first expands the parameters before calling getopt()
     params = _expand_params(context, params, definitions, depth+1)
@@ -698,14 +1092,52 @@ def _expand_snippet(context, snippet, definitions, depth=0):
     return retval
 
 
-def specfile_expand_string(string, macros, depth=0):
+def specfile_expand_string(string, macros, depth=0, budget=None):
     """Split string to snippets, and expand those that are macro calls.  This
-    method returns string again.  Specfile tags are not interpreted.
+    method returns string again.  Specfile tags are not interpreted.  The
+    optional BUDGET is an ExpansionBudget object.
     """
-    context = _SpecContext()
+    context = _SpecContext(budget=budget).start()
     return _specfile_expand_string(context, string, macros, depth)
 
 
+class _CommandHooks(ParserHooks):
+    """Gather the tag values for specfile_expand_command()."""
+    def __init__(self):
+        self.tags = {}
+
+    def tag_found(self, name, value, _tag_raw):
+        if name == "source":
+            name = "source0"
+        self.tags[name] = value
+
+
+def specfile_expand_command(content, registry, expand_string=None,
+                            get_tag=None, cache=None):
+    """
+    Do the norpm-expand-specfile work for the specfile CONTENT, using
+    REGISTRY (and the optional result CACHE, see specfile_expand()).  Return
+    (exit_status, stdout, stderr) triplet.
+    """
+    try:
+        hooks = _CommandHooks()
+        expanded_specfile = specfile_expand(content, registry, hooks,
+                                            cache=cache)
+        if expand_string:
+            if expand_string[-1] != "\n":
+                expand_string += "\n"
+            return 0, specfile_expand_string(expand_string, registry), ""
+        if get_tag:
+            tag = get_tag.lower()
+            try:
+                return 0, hooks.tags[tag] + "\n", ""
+            except KeyError:
+                return 1, "", f"Tag {tag} not found\n"
+        return 0, expanded_specfile, ""
+    except NorpmError as exc:
+        return 1, "", str(exc)
+
+
 def _specfile_expand_string(context, string, macros, depth):
     return "".join(list(_specfile_expand_string_generator(context, string, macros, depth)))
 
@@ -827,6 +1259,10 @@ def _expand_params(context, params, macros, depth):
     return [_specfile_expand_string(context, params, macros, depth+1)]
 
 
+# Tags defining the corresponding macros, like %name from Name:
+TAG_MACROS = ["name", "release", "version", "epoch"]
+
+
 def _define_tags_as_macros(context, line, macros):
     """Define macros from specfile tags, like %name from Name:"""
     try:
@@ -838,21 +1274,35 @@ def _define_tags_as_macros(context, line, macros):
     context.hooks.tag_found(tag, value, tag_raw)
     conditions = [c[2] for c in context.condition_stack]
     context.hooks.tag_conditions(tag, conditions)
-    if tag in [
-        "name",
-        "release",
-        "version",
-        "epoch",
-    ]:
+    context.hooks.tag_predicates(tag, value,
+                                 [(c[3], c[1]) for c in context.condition_stack])
+    tracker = context.reads
+    reads = None
+    if tracker is not None:
+        reads = tracker.with_conditions(tracker.line)
+        context.hooks.tag_reads(tag, value, tracker.versions(reads))
+    if tag in TAG_MACROS:
         macros[tag] = value
         macros[tag.upper()] = definition.strip()
+        if tracker is not None:
+            tracker.define(macros[tag].stack[-1], reads)
+            tracker.define(macros[tag.upper()].stack[-1], reads)
 
 
-def specfile_expand(content, macros, hooks=None):
+def specfile_expand(content, macros, hooks=None, budget=None, cache=None):
     """Expand specfile content (string), return string.  Tags (like Name:) are
-    interpreted.  See specfile_expand_generator().
+    interpreted.  See specfile_expand_generator().  The optional BUDGET is
+    an ExpansionBudget object; NorpmBudgetError is raised when exceeded.
+    The CACHE is norpm.cache.ResultCache, by default configured by the
+    NORPM_CACHE environment variable; False disables caching.
     """
-    context = _SpecContext(hooks)
+    if cache is None and os.environ.get("NORPM_CACHE"):
+        # pylint: disable=import-outside-toplevel,cyclic-import
+        from norpm.cache import default_cache
+        cache = default_cache()
+    if cache:
+        return cache.expand(content, macros, hooks, budget)
+    context = _SpecContext(hooks, budget).start()
     return _specfile_expand(context, content, macros)
 
 
@@ -875,20 +1325,27 @@ def line_ends_preamble(line):
     return False
 
 
-def specfile_expand_generator(content, macros):
+def specfile_expand_generator(content, macros, budget=None):
     """Generator method.  Expand specfile content (string), and yield parts as
     they are interpreted and expanded. The specfile preamble is parsed
     line-by-line, and if tags like Name/Version/Epoch/etc. are observed,
     corresponding (%name, %version, %release, ...) macros are defined.
     """
-    context = _SpecContext()
+    context = _SpecContext(budget=budget).start()
     return _specfile_expand_generator(context, content, macros)
 
 
-def _specfile_expand_generator(context, content, macros):
+def _specfile_expand_generator(context, content, macros, splitter=None):
+    strings = _specfile_expand_string_generator(context, content, macros,
+                                                splitter=splitter)
+    return _expand_tag_lines(context, strings, macros)
+
+
+def _expand_tag_lines(context, strings, macros):
+    """Interpret the tags in expanded STRINGS, line by line."""
     buffer = ""
     done = False
-    for string in _specfile_expand_string_generator(context, content, macros):
+    for string in strings:
         if done:
             yield string
             continue
@@ -902,101 +1359,146 @@ def _specfile_expand_generator(context, content, macros):
             if line_ends_preamble(line):
                 done = True
                 yield ''.join([line]+list(lines))
-                continue
+                break
             if line and line[-1] == "\n":
                 _define_tags_as_macros(context, line, macros)
+                if context.reads is not None:
+                    # one string may carry several (tag) lines
+                    context.reads.new_line()
                 yield line
             else:
                 buffer = line
+    if context.reads is not None:
+        reads = context.reads
+        context.hooks.spec_reads(reads.versions(reads.spec))
     yield buffer
 
 
-def _isdef_start(string, keywords=None):
-    if keywords is None:
-        keywords = ["global", "define"]
-    for mpfx in keywords:
-        for pfx in [f"%{mpfx}", f"%{{{mpfx}"]:
-            if string.startswith(pfx):
-                if string[len(pfx):][0] in ["\t", " "]:
-                    return True
-    return False
-
-
-def specfile_expand_string_generator(string, macros, depth=0):
+def specfile_expand_string_generator(string, macros, depth=0, budget=None):
     """Split the string to snippets, and expand parts that are macro calls."""
-    context = _SpecContext()
+    context = _SpecContext(budget=budget).start()
     return _specfile_expand_string_generator(context, string, macros, depth)
 
 
+# Expansion result consisting of exactly one (simple) macro call.
+_TAIL_CALL_RE = re.compile(r'%(?:\{[^%{}\\#\n]*\}|[A-Za-z_][A-Za-z0-9_]*)\Z')
+
+
+def _is_plain_text(string):
+    """Return True if STRING would be split into a single text snippet, with no
+    tokenizer or comment side effects."""
+    return '%' not in string and '\\' not in string and '#' not in string
+
 
 def _specfile_expand_string_generator(context, string, macros, depth=0,
-                                      handle_quotes=False):
-    string_generator = SpecfileSplitGenerator(context, string, macros)
-    todo = [(depth, string_generator)]
+                                      handle_quotes=False, splitter=None):
+    budget = context.budget
+    # The SPLITTER replaces SpecfileSplitGenerator for STRING, see
+    # norpm.compiled.
+    string_generator = splitter or SpecfileSplitGenerator(context, string,
+                                                          macros)
+    # (depth, generator, number of macros entered by pushing the generator)
+    todo = [(depth, string_generator, 0)]
 
     while todo:
-        depth, generator = todo[-1]
+        depth, generator, entered_count = todo[-1]
         try:
             snippet = next(generator)
-            buffer = str(snippet)
         except StopIteration:
             todo.pop()
+            if entered_count:
+                del context.expansion_path[-entered_count:]
             if handle_quotes and generator.quoted:
                 yield QuoteEnd()
             continue
 
-        if buffer == "":
-            continue
-
-        if not buffer.startswith('%'):
-            if context.expanding:
-                yield buffer
-            continue
+        # Expansion results that are a single macro call (aliases like
+        # %__python3 -> %{python3}) are expanded in place, in this loop, instead
+        # of pushing a new generator to the todo stack.
+        tail_entered = []
+        while True:
+            buffer = str(snippet)
 
-        if _isdef_start(buffer, ["global"]):
-            if not context.expanding:
+            if buffer == "":
+                break
+
+            if budget:
+                budget.step(depth)
+
+            if not buffer.startswith('%'):
+                if context.expanding:
+                    if budget:
+                        budget.produced(len(buffer))
+                    yield buffer
+                break
+
+            classified = _snippet_classified(snippet)
+            if classified.kind == "global":
+                if context.expanding:
+                    _define_global(context, classified.params,
+                                   classified.definition, macros, depth)
+                break
+
+            quoted = False
+            context.entered = None
+            expanded = _expand_snippet(context, snippet, macros, depth)
+            entered, context.entered = context.entered, None
+            if expanded is None:
+                break
+
+            if isinstance(expanded, LiteralString):
+                if context.expanding:
+                    if budget:
+                        budget.produced(len(expanded))
+                    yield str(expanded)
+                break
+
+            if isinstance(expanded, QuotedString):
+                quoted = handle_quotes
+                expanded = str(expanded)
+
+            if expanded == buffer:
+                if context.expanding:
+                    if budget:
+                        budget.produced(len(buffer))
+                    yield buffer
+                break
+
+            if _is_plain_text(expanded):
+                # Splitting would give us the very same string back, only
+                # mimic the comment-state reset done by the split generator.
+                if quoted:
+                    yield QuoteStart()
+                if expanded:
+                    context.in_comment = False
+                    if context.expanding:
+                        if budget:
+                            budget.produced(len(expanded))
+                        yield expanded
+                if quoted:
+                    yield QuoteEnd()
+                break
+
+            if entered:
+                context.check_recursion(entered, tail_entered)
+                tail_entered.append(entered)
+
+            if depth >= 1000:
+                raise NorpmRecursionError(f"Macro {buffer} causes recursion loop")
+
+            if not quoted and _TAIL_CALL_RE.match(expanded):
+                context.in_comment = False
+                snippet = _ParsingSnippet(expanded)
+                depth += 1
                 continue
 
-            definition = drop_curly_brackets(buffer)
-            _, definition = definition.split(maxsplit=1)
-            name, body, params, modifiers = next(  # pylint: disable=stop-iteration-return
-                macrofile_split_generator('%' + definition, inspec=True))
-
-            if 'l' not in modifiers:
-                expanded_def = specfile_expand_string(definition, macros, depth+1)
-                name, body, params, _ = next(  # pylint: disable=stop-iteration-return
-                    macrofile_split_generator('%' + expanded_def, inspec=True))
-
-            macros[name] = (body, params, modifiers)
-            continue
-
-        quoted = False
-        expanded = _expand_snippet(context, snippet, macros, depth)
-        if expanded is None:
-            continue
-
-        if isinstance(expanded, LiteralString):
-            if context.expanding:
-                yield str(expanded)
-            continue
-
-        if isinstance(expanded, QuotedString):
-            quoted = True
-            expanded = str(expanded)
-
-        if expanded == buffer:
-            if context.expanding:
-                yield buffer
-            continue
-
-        if depth >= 1000:
-            raise NorpmRecursionError(f"Macro {buffer} causes recursion loop")
-
-        new_generator = SpecfileSplitGenerator(context, expanded, macros)
-        if handle_quotes and quoted:
-            yield QuoteStart()
-            new_generator.quoted = True
-        todo.append((depth+1, new_generator))
+            new_generator = SpecfileSplitGenerator(context, expanded, macros)
+            if quoted:
+                yield QuoteStart()
+                new_generator.quoted = True
+            context.expansion_path.extend(tail_entered)
+            todo.append((depth+1, new_generator, len(tail_entered)))
+            break
 
 
 def specfile_detect_macro_calls_in_string(string, macros):
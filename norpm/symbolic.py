@@ -0,0 +1,265 @@
+"""
+Symbolic evaluation of the specfile conditions.
+
+Selected macros (e.g., %fedora, %rhel) and the target architecture are
+treated as variables, each with a finite list of possible values (None means
+"undefined").  Every %if, %ifarch and %ifnarch statement is evaluated to a
+Predicate, i.e., the set of variable assignments ("worlds") where it holds,
+and each specfile tag is reported together with the Predicate under which it
+applies.  One (sniff mode) pass through the specfile answers questions like
+"which targets get ExclusiveArch X".
+
+Each condition is evaluated only for the variables it actually reads, so the
+cost is typically a few expansions of the condition expression.  Note that
+the %global bodies are expanded at the time of definition, using the values
+from the registry (not the variables).
+"""
+
+from itertools import product
+
+from norpm.exceptions import NorpmSyntaxError
+from norpm.multitarget import _TracingRegistry
+from norpm.specfile import (
+    ParserHooks,
+    _eval_expression,
+    specfile_expand,
+    specfile_expand_string,
+)
+
+# Name of the target architecture variable.
+TARGET = "target"
+
+
+def _format_value(value):
+    return "undefined" if value is None else value
+
+
+class Predicate:
+    """
+    Set of worlds (variable assignments) from VariableSpace, stored as
+    a bit mask.  Equal predicates have equal masks, so the representation is
+    canonical.
+    """
+    __slots__ = ("space", "mask")
+
+    def __init__(self, space, mask):
+        self.space = space
+        self.mask = mask
+
+    def __and__(self, other):
+        return Predicate(self.space, self.mask & other.mask)
+
+    def __or__(self, other):
+        return Predicate(self.space, self.mask | other.mask)
+
+    def __invert__(self):
+        return Predicate(self.space, self.space.universe ^ self.mask)
+
+    def __eq__(self, other):
+        return isinstance(other, Predicate) and self.mask == other.mask
+
+    def __hash__(self):
+        return hash(self.mask)
+
+    @property
+    def always(self):
+        """True if the predicate holds in all the worlds."""
+        return self.mask == self.space.universe
+
+    @property
+    def never(self):
+        """True if the predicate holds in no world."""
+        return not self.mask
+
+    def worlds(self):
+        """Generator of {variable: value} dictionaries where this holds."""
+        for index, world in enumerate(self.space.worlds):
+            if self.mask >> index & 1:
+                yield dict(zip(self.space.names, world))
+
+    def holds(self, assignment):
+        """True if this holds in the world given by the complete ASSIGNMENT
+        ({variable: value} dictionary)."""
+        world = tuple(assignment[name] for name in self.space.names)
+        return bool(self.mask >> self.space.worlds.index(world) & 1)
+
+    def values(self, name):
+        """Values of the variable NAME for which this may hold."""
+        return {world[name] for world in self.worlds()}
+
+    def terms(self):
+        """
+        Return the predicate in disjunctive normal form, as a list of
+        {variable: tuple of values} dictionaries.  Variables that may have any
+        value are omitted.
+        """
+        space = self.space
+        terms = {tuple(frozenset([value]) for value in world)
+                 for index, world in enumerate(space.worlds)
+                 if self.mask >> index & 1}
+        for index in reversed(range(len(space.names))):
+            merged = {}
+            for term in terms:
+                rest = term[:index] + term[index+1:]
+                merged[rest] = merged.get(rest, frozenset()) | term[index]
+            terms = {rest[:index] + (values,) + rest[index:]
+                     for rest, values in merged.items()}
+
+        output = []
+        for term in terms:
+            output.append({
+                name: tuple(v for v in domain if v in values)
+                for name, domain, values in zip(space.names, space.domains,
+                                                term)
+                if len(values) != len(domain)
+            })
+        return sorted(output, key=str)
+
+    def __str__(self):
+        if self.never:
+            return "false"
+        disjuncts = []
+        for term in self.terms():
+            conjuncts = []
+            for name, values in term.items():
+                if len(values) == 1:
+                    conjuncts.append(f"{name} == {_format_value(values[0])}")
+                else:
+                    formatted = ", ".join(_format_value(v) for v in values)
+                    conjuncts.append(f"{name} in {{{formatted}}}")
+            disjuncts.append(" && ".join(conjuncts) or "true")
+        return " || ".join(disjuncts)
+
+    def __repr__(self):
+        return f"<Predicate {self}>"
+
+
+class VariableSpace:
+    """
+    The symbolic variables.  VARIABLES is a {macro name: list of values}
+    dictionary, TARGETS is a list of target architectures.  The
+    TARGET_MACROS are defined to the target architecture in each world.
+    Variables are named "%macro", and "target".
+    """
+    def __init__(self, variables, targets=None, target_macros=("_arch",)):
+        self.names = []
+        self.domains = []
+        self.macros = {}
+        if targets:
+            self.names.append(TARGET)
+            self.domains.append(tuple(targets))
+            for name in target_macros:
+                self.macros[name] = TARGET
+        for name, values in variables.items():
+            self.macros[name] = "%" + name
+            self.names.append("%" + name)
+            self.domains.append(tuple(values))
+        self.worlds = list(product(*self.domains))
+        self.universe = (1 << len(self.worlds)) - 1
+
+    @property
+    def true(self):
+        """Predicate holding in all the worlds."""
+        return Predicate(self, self.universe)
+
+    def _evaluate_once(self, iftype, expression, registry, assignment):
+        """
+        Evaluate the condition in the (partial) ASSIGNMENT, return the result
+        and the set of variables read.
+        """
+        target = assignment.get(TARGET, registry.target)
+        tracer = _TracingRegistry(registry, target, set(self.macros))
+        token = tracer.checkpoint()
+        try:
+            for macro, variable in self.macros.items():
+                if variable not in assignment:
+                    continue
+                value = assignment[variable]
+                tracer.clear(macro)
+                if value is not None:
+                    tracer.define(macro, value)
+            tracer.reads.clear()
+
+            expanded = specfile_expand_string(expression, tracer)
+            if iftype == "%if":
+                try:
+                    result = _eval_expression(expanded)
+                except NorpmSyntaxError:
+                    result = False
+            else:
+                result = tracer.target_matches(expanded.split())
+                if iftype == "%ifnarch":
+                    result = not result
+        finally:
+            tracer.rollback(token)
+
+        read = {self.macros[name] for name in tracer.reads}
+        if tracer.conditions:
+            read.add(TARGET)
+        return result, {x for x in read if x in self.names}
+
+    def evaluate(self, iftype, expression, registry):
+        """
+        Evaluate the %if/%ifarch/%ifnarch (IFTYPE) EXPRESSION, using the
+        macros in REGISTRY, and return the Predicate.
+        """
+        relevant = []
+        while True:
+            results = {}
+            domains = [self.domains[self.names.index(x)] for x in relevant]
+            for values in product(*domains):
+                assignment = dict(zip(relevant, values))
+                result, read = self._evaluate_once(iftype, expression,
+                                                   registry, assignment)
+                new = [x for x in self.names if x in read - set(relevant)]
+                if new:
+                    relevant += new
+                    break
+                results[values] = result
+            else:
+                break
+
+        indexes = [self.names.index(x) for x in relevant]
+        mask = 0
+        for position, world in enumerate(self.worlds):
+            if results[tuple(world[i] for i in indexes)]:
+                mask |= 1 << position
+        return Predicate(self, mask)
+
+
+class SymbolicHooks(ParserHooks):
+    """
+    Sniff through all the specfile branches, and gather the tags.  The
+    `tags` attribute is a {tag: [(value, Predicate), ...]} dictionary.
+    """
+    sniff_mode = True
+
+    def __init__(self, space):
+        self.space = space
+        self.tags = {}
+
+    def condition_found(self, iftype, expression, definitions):
+        return self.space.evaluate(iftype, expression, definitions)
+
+    def tag_predicates(self, name, value, conditions):
+        predicate = self.space.true
+        for symbol, negated in conditions:
+            predicate &= ~symbol if negated else symbol
+        self.tags.setdefault(name, []).append((value, predicate))
+
+
+def specfile_expand_symbolic(content, registry, variables, targets=None,
+                             target_macros=("_arch",)):
+    """
+    Evaluate the specfile CONTENT symbolically, see VariableSpace for the
+    VARIABLES, TARGETS and TARGET_MACROS arguments.  Return the
+    {tag: [(value, Predicate), ...]} dictionary.  The REGISTRY is left
+    unchanged.
+    """
+    hooks = SymbolicHooks(VariableSpace(variables, targets, target_macros))
+    token = registry.checkpoint()
+    try:
+        specfile_expand(content, registry, hooks)
+    finally:
+        registry.rollback(token)
+    return hooks.tags
@@ -0,0 +1,169 @@
+"""
+Corpus-wide index of the macros read by the specfiles.
+
+When the macro registry changes (e.g., a redhat-rpm-config update changes
+%_hardened_ldflags), only the specfiles that read the changed macros need to
+be expanded again.  The UsageIndex maps the macro names to the specfiles
+reading them (directly, or through other macros, conditions and %global
+definitions; see ParserHooks.track_reads), and remembers the specfile content
+digests, so the changed specfiles are re-expanded, too.  The specfiles that
+failed to expand have no read-set, and are always re-expanded.
+
+The index is stored as a gzip-compressed JSON file.
+"""
+
+import gzip
+import json
+import os
+
+from norpm.batch import batch_expand, content_digest, forkserver_expand
+from norpm.specfile import READ_TARGET
+
+_FORMAT = 1
+
+
+class UsageIndex:
+    """
+    The inverted index; `specs` maps the specfile name to its content digest,
+    `macros` maps the macro name to the set of specfile names reading it.
+    The specfile names in `failed` have no read-set.
+    """
+    def __init__(self):
+        self.specs = {}
+        self.macros = {}
+        self.failed = set()
+
+    def add(self, name, content, reads):
+        """
+        Index the specfile NAME with CONTENT, and READS (the macro names read,
+        or None if the expansion failed).
+        """
+        self.remove(name)
+        self.specs[name] = content_digest(content)
+        if reads is None:
+            self.failed.add(name)
+            return
+        for macro in reads:
+            self.macros.setdefault(macro, set()).add(name)
+
+    def remove(self, name):
+        """Drop the specfile NAME from the index."""
+        if self.specs.pop(name, None) is None:
+            return
+        self.failed.discard(name)
+        for macro in [m for m, names in self.macros.items() if name in names]:
+            self.macros[macro].discard(name)
+            if not self.macros[macro]:
+                del self.macros[macro]
+
+    def readers(self, macros):
+        """The set of the specfile names reading any of the MACROS names."""
+        result = set()
+        for macro in macros:
+            result.update(self.macros.get(macro, ()))
+        return result
+
+    def affected(self, specs, changed):
+        """
+        Filter the SPECS, (name, content) pairs, and yield those that need to
+        be expanded again after the CHANGED macros (set of names, with
+        READ_TARGET for the target architecture change) changed; because they
+        read some of them, failed before, are not indexed, or have a different
+        content.
+        """
+        readers = self.readers(changed) | self.failed
+        for name, content in specs:
+            if name in readers or \
+                    self.specs.get(name) != content_digest(content):
+                yield name, content
+
+    def to_dict(self):
+        """The JSON-serializable form of the index."""
+        names = sorted(self.specs)
+        ids = {name: i for i, name in enumerate(names)}
+        return {
+            "format": _FORMAT,
+            "specs": [[name, self.specs[name], name in self.failed]
+                      for name in names],
+            "macros": {macro: sorted(ids[n] for n in readers)
+                       for macro, readers in sorted(self.macros.items())},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Inverse of to_dict()."""
+        if data.get("format") != _FORMAT:
+            raise ValueError(f"Unsupported index format {data.get('format')}")
+        index = cls()
+        names = []
+        for name, digest, failed in data["specs"]:
+            names.append(name)
+            index.specs[name] = digest
+            if failed:
+                index.failed.add(name)
+        for macro, ids in data["macros"].items():
+            index.macros[macro] = {names[i] for i in ids}
+        return index
+
+    def save(self, path):
+        """Write the index to PATH (atomically)."""
+        tmp = f"{path}.tmp{os.getpid()}"
+        with gzip.open(tmp, "wt", encoding="utf-8") as fd:
+            json.dump(self.to_dict(), fd, separators=(",", ":"))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read the index saved by save()."""
+        with gzip.open(path, "rt", encoding="utf-8") as fd:
+            return cls.from_dict(json.load(fd))
+
+
+def registry_changes(old, new):
+    """
+    The macro names defined differently in the OLD and NEW registries, plus
+    READ_TARGET if the target architectures differ.
+    """
+    changed = old.changed_macros(new)
+    if old.target != new.target:
+        changed.add(READ_TARGET)
+    return changed
+
+
+def _expand(specs, config, fork_server, **kwargs):
+    if fork_server:
+        kwargs.pop("ordered", None)
+        return forkserver_expand(specs, config, reads=True, **kwargs)
+    return batch_expand(specs, config, reads=True, **kwargs)
+
+
+def update_index(index, specs, config=None, fork_server=False, **kwargs):
+    """
+    Expand the SPECS, (name, content) pairs, with the registry built from the
+    CONFIG (RegistryConfig), and record the reads into the INDEX.  The other
+    KWARGS are passed down to batch_expand() (or forkserver_expand()).  Yield
+    the results, see expand_spec().
+    """
+    contents = {}
+
+    def _remember():
+        for name, content in specs:
+            contents[name] = content
+            yield name, content
+
+    for result in _expand(_remember(), config, fork_server, **kwargs):
+        name = result["spec"]
+        reads = result.get("reads")
+        index.add(name, contents.pop(name), reads and list(reads))
+        yield result
+
+
+def reevaluate(index, specs, old_config, new_config, **kwargs):
+    """
+    Expand (and re-index) only those SPECS that are affected by the
+    difference between the registries built from OLD_CONFIG and NEW_CONFIG.
+    Yield the results, see update_index().
+    """
+    changed = registry_changes(old_config.build(), new_config.build())
+    yield from update_index(index, index.affected(specs, changed), new_config,
+                            **kwargs)
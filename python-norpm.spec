@@ -43,6 +43,11 @@ setup(
         'console_scripts': [
             'norpm-expand-specfile = norpm.cli.expand_specfile:_main',
             'norpm-conditions-for-arch-statements = norpm.cli.conditions_for_arch_statements:_main',
+            'norpm-batch = norpm.cli.batch:_main',
+            'norpm-daemon = norpm.cli.daemon:_main',
+            'norpm-merge-results = norpm.cli.merge_results:_main',
+            'norpm-results = norpm.cli.results:_main',
+            'norpm-usage-index = norpm.cli.usage_index:_main',
         ],
     },
 )
@@ -70,8 +75,13 @@ EOF
 
 %files -n python3-norpm -f %pyproject_files
 %doc README.md
+%_bindir/norpm-batch
 %_bindir/norpm-conditions-for-arch-statements
+%_bindir/norpm-daemon
 %_bindir/norpm-expand-specfile
+%_bindir/norpm-merge-results
+%_bindir/norpm-results
+%_bindir/norpm-usage-index
 
 
 %changelog
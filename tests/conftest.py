@@ -0,0 +1,57 @@
+"""
+Setup shared by the batch expansion tests.
+"""
+
+import os
+from unittest import mock
+
+import pytest
+
+from norpm.batch import RegistryConfig
+from norpm.cache import ResultCache
+
+
+@pytest.fixture
+def config():
+    """RegistryConfig with no system macro files."""
+    return RegistryConfig(prefix="/nonexistent")
+
+
+@pytest.fixture
+def result_cache(tmp_path):
+    """Create a ResultCache (with the given options) in tmp_path."""
+    def _create(**kwargs):
+        return ResultCache(str(tmp_path / "cache.db"), **kwargs)
+    return _create
+
+
+@pytest.fixture
+def write_specs(tmp_path):
+    """
+    Write the (name, content) pairs into DIRECTORY (defaults to tmp_path) as
+    *.spec files, and return their paths.
+    """
+    def _write(specs, directory=None):
+        directory = str(directory or tmp_path)
+        paths = []
+        for name, content in specs:
+            if not name.endswith(".spec"):
+                name += ".spec"
+            paths.append(os.path.join(directory, name))
+            with open(paths[-1], "w", encoding="utf8") as fd:
+                fd.write(content)
+        return paths
+    return _write
+
+
+@pytest.fixture
+def run_cli(capsys):
+    """
+    Run the MAIN function of a norpm.cli module with ARGV, check it succeeds,
+    and return its standard output lines.
+    """
+    def _run(main, argv):
+        with mock.patch("sys.argv", argv):
+            assert main() == 0
+        return capsys.readouterr().out.splitlines()
+    return _run
@@ -6,7 +6,10 @@ import os
 import tempfile
 
 from norpm.macro import MacroRegistry
-from norpm.cli.conditions_for_arch_statements import macro_names_needed
+from norpm.cli.conditions_for_arch_statements import (
+    macro_names_needed,
+    macro_names_needed_in_content,
+)
 
 
 def test_arch_detector():
@@ -38,3 +41,15 @@ Name: bar
 """)
         assert macro_names_needed(spec_file_path, db) == \
                 {'a_foo', 'blah', 'go_arches', 'java_arches', 'myarch'}
+        assert db.empty
+
+
+def test_arch_detector_content():
+    """
+    The specfile content read, e.g., from an archive.
+    """
+    db = MacroRegistry()
+    content = "%if 0%{?rhel}\nExclusiveArch: %java_arches\n%endif\n"
+    assert macro_names_needed_in_content(content, db) == \
+            {'rhel', 'java_arches'}
+    assert db.empty
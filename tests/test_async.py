@@ -0,0 +1,104 @@
+"""
+Test the asyncio entry points.
+"""
+
+# pylint: disable=missing-function-docstring
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from norpm.asynchronous import (
+    specfile_expand_async,
+    specfile_expand_async_generator,
+)
+from norpm.budget import ExpansionBudget
+from norpm.exceptions import NorpmBudgetError
+from norpm.macro import MacroRegistry
+from norpm.specfile import specfile_expand
+
+
+SPEC = "".join(f"%global m{i} {i}\nName{i}: %m{i}\n" for i in range(200))
+
+
+def _db():
+    db = MacroRegistry()
+    db["fedora"] = "43"
+    return db
+
+
+def test_async_matches_sync():
+    expected_db = _db()
+    expected = specfile_expand(SPEC, expected_db)
+
+    for executor in [None, True]:
+        db = _db()
+        out = asyncio.run(specfile_expand_async(SPEC, db, executor=executor))
+        assert out == expected
+        assert db.to_dict() == expected_db.to_dict()
+
+
+def test_async_generator_yields_control():
+    ticks = []
+
+    async def _ticker():
+        while True:
+            ticks.append(1)
+            await asyncio.sleep(0)
+
+    async def _run():
+        ticker = asyncio.ensure_future(_ticker())
+        parts = [p async for p in specfile_expand_async_generator(
+            SPEC, _db(), yield_every=10)]
+        ticker.cancel()
+        return parts
+
+    parts = asyncio.run(_run())
+    assert "".join(parts) == specfile_expand(SPEC, _db())
+    assert len(ticks) >= len(parts) // 10
+
+
+def test_async_cancel_rolls_back():
+    async def _cancel_generator(db):
+        async def _consume():
+            async for _ in specfile_expand_async_generator(SPEC, db,
+                                                           yield_every=1):
+                await asyncio.sleep(0)
+        task = asyncio.ensure_future(_consume())
+        for _ in range(20):
+            await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    db = _db()
+    asyncio.run(_cancel_generator(db))
+    assert db.to_dict() == _db().to_dict()
+
+    async def _cancel_executor(db):
+        # exponential, practically never ends
+        spec = "%define m0 x\n" + "".join(
+            f"%define m{i} %m{i-1}%m{i-1}\n" for i in range(1, 40)) + "%m39\n"
+        with ThreadPoolExecutor(1) as executor:
+            task = asyncio.ensure_future(
+                specfile_expand_async("%global foo 1\n" + spec, db,
+                                      executor=executor))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+    db = _db()
+    asyncio.run(_cancel_executor(db))
+    assert db.to_dict() == _db().to_dict()
+
+
+def test_async_error_rolls_back():
+    db = _db()
+    budget = ExpansionBudget(max_steps=50)
+    with pytest.raises(NorpmBudgetError):
+        asyncio.run(specfile_expand_async(SPEC, db, budget=budget,
+                                          executor=True))
+    assert budget.steps == 51
+    assert db.to_dict() == _db().to_dict()
@@ -0,0 +1,180 @@
+"""
+Test the batch expansion.
+"""
+
+# pylint: disable=missing-function-docstring
+
+import json
+import os
+import tempfile
+import time
+from unittest import mock
+
+from norpm import batch
+from norpm.batch import (
+    RegistryConfig,
+    batch_expand,
+    expand_spec,
+    forkserver_expand,
+    read_specfiles,
+)
+from norpm.cli import batch as batch_cli
+from norpm.macro import MacroRegistry
+
+
+SPECS = {
+    "foo.spec": "Name: foo\n%global ver 1.%{?fedora}\nVersion: %ver\n"
+                "%ifarch x86_64\nExclusiveArch: x86_64\n%endif\n",
+    "bar.spec": "Name: bar\nVersion: 2\nBuildArch: noarch\n",
+    "broken.spec": "%define foo %bar\n%define bar %foo\nName: %foo\n",
+}
+
+
+def _write_specs(directory):
+    for name, content in SPECS.items():
+        with open(os.path.join(directory, name), "w", encoding="utf8") as fd:
+            fd.write(content)
+
+
+def test_expand_spec_keeps_registry():
+    db = MacroRegistry()
+    db.target = "x86_64"
+    db["fedora"] = "43"
+    result = expand_spec("foo", SPECS["foo.spec"], db)
+    assert result["tags"] == {"name": ["foo"], "version": ["1.43"],
+                              "exclusivearch": ["x86_64"]}
+    assert result["error"] is None
+    assert db.to_dict() == {"fedora": ("43", None, set())}
+
+    result = expand_spec("broken", SPECS["broken.spec"], db, tags=["name"])
+    assert result["error"].startswith("NorpmRecursionError: ")
+    assert db.to_dict() == {"fedora": ("43", None, set())}
+
+
+def test_batch_expand():
+    config = RegistryConfig(arch="x86_64", prefix="/nonexistent",
+                            defines=(("fedora", "42"),))
+    with tempfile.TemporaryDirectory() as tmp:
+        _write_specs(tmp)
+        specs = list(read_specfiles([tmp]))
+        assert [os.path.basename(name) for name, _ in specs] == \
+            ["bar.spec", "broken.spec", "foo.spec"]
+        serial = list(batch_expand(specs, config, processes=1,
+                                   tags=["version"]))
+        parallel = list(batch_expand(specs, config, processes=2,
+                                     ordered=True, tags=["version"]))
+        unordered = list(batch_expand(specs, config, processes=2,
+                                      tags=["version"]))
+        forked = list(forkserver_expand(specs, config, processes=2,
+                                        tags=["version"]))
+        forked_batches = list(forkserver_expand(specs, config, processes=2,
+                                                tags=["version"],
+                                                batch_size=2))
+
+    def _strip(results):
+        return [(r["spec"], r["tags"], r["error"]) for r in results]
+
+    assert _strip(serial) == _strip(parallel)
+    assert sorted(_strip(unordered)) == sorted(_strip(serial))
+    assert sorted(_strip(forked)) == sorted(_strip(serial))
+    assert sorted(_strip(forked_batches)) == sorted(_strip(serial))
+    assert serial[2]["tags"] == {"version": ["1.42"]}
+
+
+def test_batch_cli(capsys):
+    with tempfile.TemporaryDirectory() as tmp:
+        _write_specs(tmp)
+        argv = ["norpm-batch", "-j1", "--ordered", "--prefix", tmp,
+                "--tag", "buildarch", os.path.join(tmp, "bar.spec")]
+        with mock.patch("sys.argv", argv):
+            assert batch_cli._main() == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+    result = json.loads(lines[0])
+    assert result["tags"] == {"buildarch": ["noarch"]}
+
+
+def test_forkserver_isolation():
+    """ Children don't modify the parent registry, crashes are reported """
+    config = RegistryConfig(prefix="/nonexistent")
+    specs = [("a", "%global foo 1\nName: %foo\n"),
+             ("b", "Name: %{?foo}%{!?foo:none}\n"),
+             ("c", "crash\n")]
+    expand = batch.specfile_expand
+
+    def _crashing_expand(content, *args, **kwargs):
+        if content == "crash\n":
+            os._exit(3)  # pylint: disable=protected-access
+        return expand(content, *args, **kwargs)
+
+    for batch_size in [1, 2]:
+        with mock.patch("norpm.batch.specfile_expand", _crashing_expand):
+            results = {r["spec"]: r for r in forkserver_expand(
+                specs, config, processes=1, batch_size=batch_size)}
+        assert results["a"]["tags"] == {"name": ["1"]}
+        assert results["b"]["tags"] == {"name": ["none"]}
+        assert results["c"]["error"] == \
+            "Worker process failed with exit status 3"
+
+
+def test_limits_isolation():
+    """ The specfiles in one limited child don't see each other """
+    config = RegistryConfig(prefix="/nonexistent")
+    specs = [("a", "%global foo 1\nName: %foo\n"),
+             ("b", "Name: %{?foo}%{!?foo:none}\n")]
+    results = {r["spec"]: r for r in batch_expand(
+        specs, config, processes=1, chunksize=2,
+        limits=batch.ResourceLimits(wall=30))}
+    assert results["a"]["tags"] == {"name": ["1"]}
+    assert results["b"]["tags"] == {"name": ["none"]}
+
+
+def _address_space():
+    with open("/proc/self/status", "r", encoding="utf-8") as fd:
+        for line in fd:
+            if line.startswith("VmSize:"):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def test_resource_limits():
+    """ The workers exceeding the limits are replaced """
+    config = RegistryConfig(prefix="/nonexistent")
+    specs = [("a", "Name: a\n"), ("wall", "wall\n"), ("b", "Name: b\n"),
+             ("cpu", "cpu\n"), ("memory", "memory\n"), ("c", "Name: c\n")]
+    expand = batch.specfile_expand
+
+    def _runaway_expand(content, *args, **kwargs):
+        if content == "wall\n":
+            time.sleep(60)
+        elif content == "cpu\n":
+            while True:
+                pass
+        elif content == "memory\n":
+            return "x" * (1 << 30)
+        return expand(content, *args, **kwargs)
+
+    limits = batch.ResourceLimits(memory=_address_space() + (256 << 20),
+                                  cpu=1, wall=3)
+    with mock.patch("norpm.batch.specfile_expand", _runaway_expand):
+        results = {r["spec"]: r for r in batch_expand(
+            specs, config, processes=1, chunksize=6, limits=limits)}
+    assert len(results) == 6
+    for name in "abc":
+        assert results[name]["tags"] == {"name": [name]}
+        assert results[name]["cpu"] >= 0
+        assert results[name]["max_rss"] > 0
+    for limit, error in [("wall", "wall time"), ("cpu", "CPU time"),
+                         ("memory", "memory")]:
+        assert results[limit]["error"] == \
+            f"NorpmResourceError: {error} limit exceeded"
+
+
+def test_max_rss_per_spec():
+    """ The peak RSS is measured per specfile, not per worker """
+    specs = [("big", "Name: big\n%{rep x 50000000}\n"),
+             ("small", "Name: small\n")]
+    results = [r["max_rss"] for r in batch_expand(
+        specs, RegistryConfig(prefix="/nonexistent"), processes=1,
+        ordered=True)]
+    assert results[1] < results[0] - (32 << 10)
@@ -0,0 +1,69 @@
+"""
+Test expansion budgets.
+"""
+
+# pylint: disable=missing-function-docstring
+
+import pytest
+
+from norpm.budget import ExpansionBudget
+from norpm.exceptions import NorpmBudgetError
+from norpm.macro import MacroRegistry
+from norpm.specfile import specfile_expand, specfile_expand_string
+
+
+def _exponential_registry(levels=30):
+    db = MacroRegistry()
+    db["l0"] = "x"
+    for i in range(1, levels):
+        db[f"l{i}"] = f"%{{l{i-1}}}%{{l{i-1}}}"
+    return db
+
+
+def test_unlimited_budget():
+    budget = ExpansionBudget()
+    db = _exponential_registry(5)
+    assert specfile_expand("%l4\n", db, budget=budget) == 16 * "x" + "\n"
+    stats = budget.stats()
+    assert stats["output"] == 17
+    assert stats["steps"] > 16
+    assert stats["depth"] >= 4
+
+
+def test_steps_budget():
+    budget = ExpansionBudget(max_steps=1000)
+    with pytest.raises(NorpmBudgetError) as err:
+        specfile_expand("%l29", _exponential_registry(), budget=budget)
+    assert err.value.stats["steps"] == 1001
+
+
+def test_output_budget():
+    budget = ExpansionBudget(max_output=100)
+    with pytest.raises(NorpmBudgetError) as err:
+        specfile_expand_string("%l29", _exponential_registry(), budget=budget)
+    assert err.value.stats["output"] == 100
+
+
+def test_rep_respects_output_budget():
+    budget = ExpansionBudget(max_output=1000)
+    db = MacroRegistry()
+    assert specfile_expand_string("%{rep ab 3}", db, budget=budget) == "ababab"
+    with pytest.raises(NorpmBudgetError) as err:
+        specfile_expand_string("%{rep ab 1000000000}", db, budget=budget)
+    assert err.value.stats["output"] < 100
+
+
+def test_depth_budget():
+    db = MacroRegistry()
+    db["deep"] = ("x%{deep %1}", "", set())
+    budget = ExpansionBudget(max_depth=50)
+    with pytest.raises(NorpmBudgetError) as err:
+        specfile_expand_string("%{deep 1}", db, budget=budget)
+    assert err.value.stats["depth"] == 51
+
+
+def test_time_budget():
+    budget = ExpansionBudget(max_time=0)
+    with pytest.raises(NorpmBudgetError) as err:
+        specfile_expand("%l29", _exponential_registry(), budget=budget)
+    assert err.value.stats["steps"] == ExpansionBudget.TIME_CHECK_INTERVAL
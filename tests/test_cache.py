@@ -0,0 +1,152 @@
+"""
+Test the on-disk cache of the expansion results.
+"""
+
+# pylint: disable=missing-function-docstring
+
+import pytest
+
+from norpm.batch import _TagHooks, batch_expand, RegistryConfig
+from norpm.exceptions import NorpmRecursionError
+from norpm.macro import MacroRegistry
+from norpm.multitarget import expand_spec_multitarget
+from norpm.specfile import ParserHooks, specfile_expand
+
+SPEC = """\
+%global common %{?fedora}
+Name: foo
+Version: 1.%common
+%ifarch x86_64
+Release: 1
+%endif
+"""
+
+
+def _registry(target="x86_64"):
+    db = MacroRegistry()
+    db.target = target
+    db["fedora"] = "43"
+    return db
+
+
+def _expand(cache, spec=SPEC, db=None):
+    db = db or _registry()
+    hooks = _TagHooks()
+    output = specfile_expand(spec, db, hooks, cache=cache)
+    return output, hooks.tags, db.to_dict()
+
+
+def test_cache_hit(result_cache):
+    cache = result_cache()
+    expected = _expand(False)
+    assert _expand(cache) == expected
+    assert _expand(cache) == expected
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # the registry is part of the key
+    expected = _expand(False, db=_registry("s390x"))
+    assert _expand(cache, db=_registry("s390x")) == expected
+    assert cache.misses == 2
+
+
+def test_cache_error(result_cache):
+    cache = result_cache()
+    spec = "Name: foo\n%global optflags --foo %optflags\n%optflags\n"
+    for _ in range(2):
+        db = _registry()
+        with pytest.raises(NorpmRecursionError) as err:
+            specfile_expand(spec, db, cache=cache)
+        assert err.value.cycle == ["optflags", "optflags"]
+        assert db["name"].value == "foo"
+    assert cache.hits == 1
+
+
+def test_cache_eviction(result_cache):
+    cache = result_cache(max_size=1500)
+    for index in range(50):
+        _expand(cache, f"Name: foo{index}\n" + "x" * 1000)
+    conn = cache._connection()  # pylint: disable=protected-access
+    size, count = conn.execute(
+        "SELECT SUM(size), COUNT(*) FROM entries").fetchone()
+    assert size <= 1500
+    assert 0 < count < 50
+    # the latest is kept
+    _expand(cache, "Name: foo49\n" + "x" * 1000)
+    assert cache.hits == 1
+
+
+def test_cache_from_environment(tmp_path, monkeypatch):
+    monkeypatch.setenv("NORPM_CACHE", str(tmp_path / "cache.db"))
+    expected = _expand(False)
+    assert _expand(None) == expected
+    assert _expand(None) == expected
+    # the tracing registries are not cached
+    results = expand_spec_multitarget("foo", SPEC, _registry(),
+                                      ["x86_64", "s390x"])
+    assert results["x86_64"]["tags"]["release"] == ["1"]
+    assert "release" not in results["s390x"]["tags"]
+
+
+def test_cache_batch(result_cache):
+    cache = result_cache(store_text=False)
+    config = RegistryConfig(defines=(("fedora", "43"),))
+    specs = [("a", SPEC), ("b", "Name: b\n")]
+    first = list(batch_expand(specs, config, processes=1, cache=cache))
+    second = list(batch_expand(specs, config, processes=1, cache=cache))
+    assert [r["tags"] for r in first] == [r["tags"] for r in second]
+    assert first[0]["tags"]["version"] == ["1.43"]
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_cache_read_set(result_cache):
+    cache = result_cache()
+    expected = _expand(False)
+    assert _expand(cache) == expected
+    # unrelated macros are not part of the key
+    db = _registry()
+    db["unrelated"] = "1"
+    expected = _expand(False, db=_registry())
+    expected[2]["unrelated"] = db["unrelated"].to_dict()
+    assert _expand(cache, db=db) == expected
+    assert (cache.hits, cache.misses) == (1, 1)
+    # but the macros read by the specfile are
+    db = _registry()
+    db["fedora"] = "44"
+    assert _expand(cache, db=db)[1]["version"] == ["1.44"]
+    assert cache.misses == 2
+
+
+def test_cache_undefine(result_cache):
+    cache = result_cache()
+    spec = "%undefine dist\nName: foo\n"
+    assert _expand(cache, spec, MacroRegistry()) == \
+        _expand(False, spec, MacroRegistry())
+    # %undefine reads the macro, a registry defining it is a different variant
+    for cached in [cache, False]:
+        db = MacroRegistry()
+        db["dist"] = ".fc42"
+        _expand(cached, spec, db)
+        assert "dist" not in db
+    assert cache.misses == 2
+
+
+def test_cache_condition_hooks(result_cache):
+    cache = result_cache()
+
+    class _Hooks(ParserHooks):
+        def __init__(self):
+            self.predicates = []
+
+        def condition_found(self, iftype, expression, definitions):
+            return expression
+
+        def tag_predicates(self, name, value, conditions):
+            self.predicates.append((name, conditions))
+
+    spec = "%if 0%{?fedora}\nName: foo\n%endif\n"
+    for _ in range(2):
+        hooks = _Hooks()
+        specfile_expand(spec, _registry(), hooks, cache=cache)
+        assert hooks.predicates == [("name", [(" 0%{?fedora}", False)])]
+    # the hooks' condition_found() results can not be replayed
+    assert (cache.hits, cache.misses) == (0, 0)
@@ -0,0 +1,102 @@
+"""
+Test the checkpoint/resume of the batch runs.
+"""
+
+# pylint: disable=missing-function-docstring
+
+import json
+from unittest import mock
+
+from norpm import batch
+import pytest
+
+from norpm.batch import RegistryConfig, batch_expand, run_settings
+from norpm.checkpoint import Checkpoint
+from norpm.cli import batch as batch_cli
+
+SPECS = [(f"spec{i}", f"Name: spec{i}\n") for i in range(5)]
+
+
+def _run(config, path, specs, resume, limit=None):
+    checkpoint = Checkpoint(path, run_settings(config.build()), resume,
+                            flush_every=1)
+    results = checkpoint.record(batch_expand(checkpoint.pending(specs),
+                                             config, processes=1))
+    names = []
+    try:
+        for result in results:
+            names.append(result["spec"])
+            if len(names) == limit:
+                break  # "killed"
+    finally:
+        checkpoint.close()
+    return names
+
+
+def test_checkpoint_resume(tmp_path, config):
+    path = str(tmp_path / "progress.jsonl")
+    assert _run(config, path, SPECS, False, limit=3) == ["spec0", "spec1", "spec2"]
+    with open(path, "a", encoding="utf-8") as fd:
+        fd.write('{"spec": "spec3", "tags"')
+
+    specs = list(SPECS)
+    specs[1] = ("spec1", "Name: changed\n")
+    with mock.patch("norpm.batch.specfile_expand",
+                    wraps=batch.specfile_expand) as expand:
+        names = _run(config, path, specs, True)
+    assert expand.call_count == 3
+    assert sorted(names) == [name for name, _ in SPECS]
+
+    with open(path, "r", encoding="utf-8") as fd:
+        header, *lines = [json.loads(line) for line in fd]
+    settings = run_settings(config.build())
+    assert header == {"settings": json.loads(json.dumps(settings))}
+    assert [line["spec"] for line in lines] == \
+        ["spec0", "spec1", "spec2", "spec1", "spec3", "spec4"]
+    assert lines[3]["tags"] == {"name": ["changed"]}
+
+    # without --resume, the file is overwritten
+    assert len(_run(config, path, SPECS, False)) == 5
+    assert len(_run(config, path, SPECS, True)) == 5
+
+
+def test_checkpoint_settings(tmp_path, config):
+    path = str(tmp_path / "progress.jsonl")
+    assert len(_run(config, path, SPECS, False, limit=2)) == 2
+    other = RegistryConfig(prefix="/nonexistent", defines=(("fedora", "43"),))
+    for settings in [run_settings(other.build()),
+                     run_settings(config.build(), tags=["name"])]:
+        with pytest.raises(ValueError, match="different settings"):
+            Checkpoint(path, settings, resume=True)
+    # the file is kept intact
+    assert len(_run(config, path, SPECS, True)) == 5
+
+
+def test_checkpoint_header_only(tmp_path, config):
+    """ A checkpoint with no results is restarted with the new settings """
+    path = str(tmp_path / "progress.jsonl")
+    other = run_settings(config.build(), tags=["name"])
+    Checkpoint(path, other).close()
+    assert _run(config, path, SPECS[:1], True) == ["spec0"]
+    with open(path, "r", encoding="utf-8") as fd:
+        header = json.loads(fd.readline())
+    settings = run_settings(config.build())
+    assert header == {"settings": json.loads(json.dumps(settings))}
+    # the results can't be resumed with the original settings
+    with pytest.raises(ValueError, match="different settings"):
+        Checkpoint(path, other, resume=True)
+
+
+def test_checkpoint_cli(tmp_path, write_specs, run_cli):
+    write_specs(SPECS)
+    argv = ["norpm-batch", "-j1", "--prefix", "/nonexistent",
+            "--checkpoint", str(tmp_path / "progress.jsonl"),
+            str(tmp_path), "--resume"]
+    first = run_cli(batch_cli._main, argv)
+    with mock.patch("norpm.batch.specfile_expand") as expand:
+        assert sorted(run_cli(batch_cli._main, argv)) == sorted(first)
+    assert not expand.called
+
+    with mock.patch("sys.argv", argv + ["--tag", "name"]):
+        with pytest.raises(SystemExit):
+            batch_cli._main()
@@ -0,0 +1,95 @@
+"""
+Test the compiled specfile representation.
+"""
+
+# pylint: disable=missing-function-docstring
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import pickle
+from unittest import mock
+
+from norpm.batch import _TagHooks
+from norpm.compiled import compile_spec, execute
+from norpm.macro import MacroRegistry
+from norpm.specfile import specfile_expand
+
+DATADIR = os.path.join(os.path.dirname(__file__), "full_spec_expansion")
+
+SPEC = """\
+Name: foo
+%pm a b
+# %pm x %if 1
+%pm
+%define c #
+%c %if 0
+Release: 1
+%endif
+%ifarch x86_64
+BuildArch: noarch
+%endif
+"""
+
+
+def _registry(parametric, target="x86_64"):
+    db = MacroRegistry()
+    db.target = target
+    db["fedora"] = "43"
+    if parametric:
+        db["pm"] = ("[%*]", "")
+    else:
+        db["pm"] = "plain"
+    return db
+
+
+def _check(ir, text, db_args):
+    expected_db = _registry(*db_args)
+    expected_hooks = _TagHooks()
+    expected = specfile_expand(text, expected_db, expected_hooks)
+    db = _registry(*db_args)
+    hooks = _TagHooks()
+    assert execute(ir, db, hooks) == expected
+    assert hooks.tags == expected_hooks.tags
+    assert db.to_dict() == expected_db.to_dict()
+
+
+def test_compiled_spec():
+    ir = compile_spec(SPEC)
+    for db_args in [(True,), (False,), (True, "aarch64"), (True,), (False,)]:
+        _check(ir, SPEC, db_args)
+
+
+def test_compiled_shared():
+    """ Diverging executions don't modify the IR, it can be shared """
+    ir = compile_spec(SPEC, _registry(False))
+    entries = list(ir.entries)
+    _check(ir, SPEC, (True,))
+    assert ir.entries == entries
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda i: _check(ir, SPEC, (i % 2 == 0,)),
+                          range(32)))
+    assert ir.entries == entries
+
+
+def test_compiled_full_specs():
+    for filename in sorted(os.listdir(DATADIR)):
+        if not filename.endswith(".spec"):
+            continue
+        with open(os.path.join(DATADIR, filename), "r", encoding="utf8") as fd:
+            text = fd.read()
+        ir = pickle.loads(pickle.dumps(compile_spec(text)))
+        assert ir.digest == compile_spec(text).digest
+        for db_args in [(True,), (False, "s390x")]:
+            _check(ir, text, db_args)
+
+
+def test_compiled_classified():
+    """ The pickled IR carries the snippet classification for execute() """
+    text = "%define foo bar\nName: %foo\n%if 1\nVersion: 1\n%endif\n%foo\n"
+    ir = pickle.loads(pickle.dumps(compile_spec(text)))
+    assert [e.classified.kind for e in ir.entries if e.classified] == \
+        ["define", "call", "condition", "endif", "call"]
+    expected = specfile_expand(text, _registry(True))
+    with mock.patch("norpm.specfile._classify_snippet",
+                    side_effect=AssertionError("classified again")):
+        assert execute(ir, _registry(True)) == expected
@@ -0,0 +1,142 @@
+"""
+Test reading the specfile corpora from directories and archives.
+"""
+
+# pylint: disable=missing-function-docstring
+
+import io
+import json
+import os
+import tarfile
+import threading
+import zipfile
+from unittest import mock
+
+import pytest
+
+from norpm.cli import batch as batch_cli
+from norpm.corpus import (
+    READ_AHEAD,
+    archive_specfiles,
+    corpus_specfiles,
+    is_archive,
+    open_corpus,
+    read_ahead,
+)
+
+SPECS = [(f"rpm-specs/spec{i}.spec", f"Name: spec{i}\n") for i in range(5)]
+
+
+def _write_tar(path, mode):
+    with tarfile.open(path, mode) as archive:
+        info = tarfile.TarInfo("rpm-specs")
+        info.type = tarfile.DIRTYPE
+        archive.addfile(info)
+        for name, content in SPECS + [("rpm-specs/README", "ignored")]:
+            data = content.encode("utf8")
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+
+@pytest.mark.parametrize("suffix, mode", [
+    ("tar", "w"),
+    ("tar.gz", "w:gz"),
+    ("tar.bz2", "w:bz2"),
+    ("tar.xz", "w:xz"),
+])
+def test_tar(tmp_path, suffix, mode):
+    path = str(tmp_path / f"specs.{suffix}")
+    _write_tar(path, mode)
+    assert is_archive(path)
+    assert list(archive_specfiles(path)) == \
+        [(f"{path}/{name}", content) for name, content in SPECS]
+
+
+def test_zip(tmp_path):
+    path = str(tmp_path / "specs.zip")
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("rpm-specs/", "")
+        for name, content in SPECS:
+            archive.writestr(name, content)
+    assert is_archive(path)
+    assert list(archive_specfiles(path)) == \
+        [(f"{path}/{name}", content) for name, content in SPECS]
+
+
+def test_corpus_mixed(tmp_path):
+    archive = str(tmp_path / "specs.tar.gz")
+    _write_tar(archive, "w:gz")
+    directory = tmp_path / "dir"
+    directory.mkdir()
+    (directory / "foo.spec").write_text("Name: foo\n", encoding="utf8")
+    assert not is_archive(str(directory))
+    assert not is_archive(str(directory / "foo.spec"))
+    expected = [(str(directory / "foo.spec"), "Name: foo\n")] + \
+        [(f"{archive}/{name}", content) for name, content in SPECS]
+    assert list(corpus_specfiles([str(directory), archive])) == expected
+    assert list(open_corpus([str(directory), archive], depth=2)) == expected
+
+
+def test_read_ahead():
+    assert list(read_ahead(iter(range(100)), depth=3)) == list(range(100))
+
+    def _failing():
+        yield 1
+        raise ValueError("broken archive")
+
+    items = read_ahead(_failing())
+    assert next(items) == 1
+    with pytest.raises(ValueError, match="broken archive"):
+        next(items)
+
+
+def test_read_ahead_stop():
+    closed = threading.Event()
+
+    def _endless():
+        try:
+            i = 0
+            while True:
+                yield i
+                i += 1
+        finally:
+            closed.set()
+
+    items = read_ahead(_endless(), depth=2)
+    assert next(items) == 0
+    items.close()
+    assert closed.is_set()
+
+
+def test_batch_cli_archive(tmp_path, capsys):
+    path = str(tmp_path / "specs.tar.xz")
+    _write_tar(path, "w:xz")
+    argv = ["norpm-batch", "--prefix", "/nonexistent", "--jobs", "1",
+            "--ordered", path]
+    with mock.patch("sys.argv", argv):
+        assert batch_cli._main() == 0  # pylint: disable=protected-access
+    results = [json.loads(line) for line in
+               capsys.readouterr().out.splitlines()]
+    assert [r["spec"] for r in results] == \
+        [f"{path}/{name}" for name, _ in SPECS]
+    assert [r["tags"]["name"] for r in results] == \
+        [[os.path.basename(name)[:-5]] for name, _ in SPECS]
+
+
+@pytest.mark.parametrize("options, depth", [
+    ([], READ_AHEAD),
+    (["--fork-server"], 0),
+    (["--wall-limit", "10"], 0),
+])
+def test_batch_cli_fork_server_no_read_ahead(tmp_path, capsys, options, depth):
+    path = str(tmp_path / "specs.tar")
+    _write_tar(path, "w")
+    argv = ["norpm-batch", "--prefix", "/nonexistent", "--jobs", "1"] + \
+        options + [path]
+    with mock.patch("sys.argv", argv), \
+            mock.patch("norpm.cli.batch.open_corpus",
+                       wraps=open_corpus) as opened:
+        assert batch_cli._main() == 0  # pylint: disable=protected-access
+    opened.assert_called_once_with([path], depth=depth)
+    assert len(capsys.readouterr().out.splitlines()) == len(SPECS)
@@ -0,0 +1,145 @@
+"""
+Test the expansion daemon, and the norpm-expand-specfile --socket client.
+"""
+
+# pylint: disable=missing-function-docstring,redefined-outer-name
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import tempfile
+import threading
+from unittest import mock
+
+import pytest
+
+from norpm.cli import expand_specfile as client
+from norpm.batch import RegistryConfig
+from norpm.daemon import ExpansionServer, RegistryPool
+
+
+SPEC = """\
+Name: foo
+%global ver 1.%{?fedora}%{!?fedora:0}
+Version: %ver
+%ifarch x86_64
+ExclusiveArch: x86_64
+%endif
+"""
+
+
+@pytest.fixture
+def server():
+    with tempfile.TemporaryDirectory() as tmp:
+        srv = ExpansionServer(os.path.join(tmp, "norpm.sock"),
+                              default_arch="x86_64",
+                              default_prefix="/nonexistent")
+        thread = threading.Thread(target=srv.serve_forever)
+        thread.start()
+        try:
+            yield srv
+        finally:
+            srv.shutdown()
+            srv.server_close()
+            thread.join()
+
+
+def _ask(srv, **request):
+    return client._ask_daemon(srv.socket_path, request)
+
+
+def test_daemon_requests(server):
+    out = _ask(server, op="expand", content=SPEC)
+    assert out == {"status": 0, "stdout": SPEC.replace("%ver", "1.0")
+                   .replace("%ifarch x86_64\n", "")
+                   .replace("%endif\n", "")
+                   .replace("%global ver 1.%{?fedora}%{!?fedora:0}\n", ""),
+                   "stderr": ""}
+    out = _ask(server, op="get-tag", content=SPEC, tag="ExclusiveArch")
+    assert out == {"status": 0, "stdout": "x86_64\n", "stderr": ""}
+    out = _ask(server, op="get-tag", content=SPEC, tag="release")
+    assert out == {"status": 1, "stdout": "", "stderr": "Tag release not found\n"}
+    out = _ask(server, op="expand-string", content=SPEC, string="%{name}-%ver")
+    assert out == {"status": 0, "stdout": "foo-1.0\n", "stderr": ""}
+    out = _ask(server, op="get-tag", content=SPEC, tag="exclusivearch",
+               arch="aarch64")
+    assert out["status"] == 1
+    out = _ask(server, op="foo")
+    assert out["status"] == 1
+    assert "Unknown request" in out["stderr"]
+
+
+def test_daemon_isolation(server):
+    """ The specfile definitions don't leak to the following requests """
+    _ask(server, op="expand", content="%global fedora 42\n")
+    out = _ask(server, op="expand-string", content="", string="%{?fedora}")
+    assert out["stdout"] == "\n"
+
+    stats = _ask(server, op="stats")
+    assert stats["cache"]["misses"] == 1
+    assert stats["cache"]["hits"] == 1
+    assert stats["latency"]["expand"]["count"] == 1
+    assert stats["latency"]["expand-string"]["count"] == 1
+
+
+def test_daemon_concurrent(server):
+    def _request(i):
+        content = f"%define num {i}\nName: foo%num\n"
+        return _ask(server, op="get-tag", content=content, tag="name")
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(_request, range(64)))
+    assert [x["stdout"] for x in results] == [f"foo{i}\n" for i in range(64)]
+
+    stats = _ask(server, op="stats")
+    assert stats["cache"]["hits"] + stats["cache"]["misses"] == 64
+    assert stats["cache"]["configs"] == 1
+
+
+def test_client_cli(server, capsys):
+    with tempfile.NamedTemporaryFile("w", suffix=".spec") as spec:
+        spec.write(SPEC)
+        spec.flush()
+        argv = ["norpm-expand-specfile", "--specfile", spec.name,
+                "--socket", server.socket_path, "--get-tag", "version"]
+        with mock.patch("sys.argv", argv):
+            assert client._main() == 0
+        assert capsys.readouterr().out == "1.0\n"
+
+        argv[-2:] = ["--expand-string", "%name"]
+        with mock.patch("sys.argv", argv):
+            assert client._main() == 0
+        assert capsys.readouterr().out == "foo\n"
+
+
+def test_client_overrides_path(tmp_path, monkeypatch):
+    spec = tmp_path / "foo.spec"
+    spec.write_text(SPEC, encoding="utf8")
+    monkeypatch.chdir(tmp_path)
+    requests = []
+
+    def _ask_daemon(_socket_path, request):
+        requests.append(request)
+        return {"status": 0, "stdout": "", "stderr": ""}
+
+    argv = ["norpm-expand-specfile", "--specfile", "foo.spec", "--socket",
+            "norpm.sock", "--macro-overrides", "overrides.json", "f43"]
+    with mock.patch("sys.argv", argv), \
+            mock.patch.object(client, "_ask_daemon", _ask_daemon):
+        assert client._main() == 0
+    # the daemon resolves the path in its own working directory
+    assert requests[0]["macro_overrides"] == \
+        [str(tmp_path / "overrides.json"), "f43"]
+
+
+def test_registry_pool_bounded():
+    pool = RegistryPool(max_configs=2)
+    configs = [RegistryConfig(arch=arch, prefix="/nonexistent")
+               for arch in ["x86_64", "aarch64", "s390x"]]
+    for config in configs + configs[2:] + configs[:1]:
+        with pool.registry(config) as registry:
+            assert registry.target == config.arch
+    stats = pool.stats()
+    assert stats["configs"] == 2
+    assert stats["registries"] == 2
+    assert stats["evictions"] == 2
+    assert (stats["hits"], stats["misses"]) == (1, 4)
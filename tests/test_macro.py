@@ -2,8 +2,11 @@
 Special tests for macro.py
 """
 
+import os
 import unittest
-from norpm.macro import MacroRegistry, parse_macro_call as pc
+from norpm import macro
+from norpm.macro import MacroRegistry, drop_curly_brackets, parse_macro_call as pc
+from norpm.specfile import specfile_split
 from norpm.exceptions import NorpmInvalidMacroName
 
 # pylint: disable=missing-docstring
@@ -34,3 +37,91 @@ def test_known_hacks():
     db.known_norpm_hacks()
     assert db["goname"].value == "NORPM_HACK_NO_GONAME"
     assert db["optflags"].value == "-O2 -g3"
+
+
+def _macro_calls_in_specs():
+    datadir = os.path.join(os.path.dirname(__file__), "full_spec_expansion")
+    todo = []
+    for filename in os.listdir(datadir):
+        with open(os.path.join(datadir, filename), "r", encoding="utf8") as fd:
+            todo.append(fd.read())
+    calls = set()
+    while todo:
+        for snippet in specfile_split(todo.pop(), MacroRegistry()):
+            if not snippet.startswith("%") or snippet in calls:
+                continue
+            calls.add(snippet)
+            # nested calls, like %{?foo:%{bar}}
+            todo.append(drop_curly_brackets(snippet))
+    return calls
+
+
+def test_macro_call_parser_differential():
+    # pylint: disable=protected-access
+    calls = _macro_calls_in_specs()
+    calls |= {"%{ !foo}", "%else%foo", "%{?!foo:%{bar}}", "%{-m}", "%{!?-m:x}",
+              "%{foo:}", "%{?foo:}", "%?!!?foo", "%{foo\tbar\nbaz}", "%##"}
+    assert len(calls) > 100
+    for call in calls:
+        assert pc(call) == macro._parse_macro_call_statemachine(call), call
+
+
+def test_checkpoint_rollback():
+    db = MacroRegistry()
+    db["foo"] = "1"
+    db["bar"] = "2"
+    original = db.to_dict()
+    token = db.checkpoint()
+    db["foo"] = "3"
+    db.undefine("bar")
+    db.undefine("bar")
+    db["new"] = "4"
+    db.replace("foo", "5")
+    inner = db.checkpoint()
+    db.clear("foo")
+    db.rollback(inner)
+    assert db.to_dict() == {"foo": ("5", None, set()), "new": ("4", None, set())}
+    db.rollback(token)
+    assert db.to_dict() == original
+    assert db["foo"].stack[-1].value == "1"
+    db["baz"] = "6"
+    assert "baz" in db
+
+
+def _fresh_copy(db):
+    copy = MacroRegistry()
+    copy.target = db.target
+    for name, macro_stack in db.db.items():
+        for definition in macro_stack.stack:
+            copy.define(name, (definition.value, definition.params,
+                               definition.modifiers), special=True)
+    return copy
+
+
+def test_fingerprint():
+    db = MacroRegistry()
+    db.target = "x86_64"
+    db["foo"] = "1"
+    db["bar"] = "2"
+    original = db.fingerprint()
+    subset = db.fingerprint(names=["foo", "undefined"])
+
+    token = db.checkpoint()
+    db["foo"] = "3"
+    db.undefine("bar")
+    db["new"] = ("4", "", {"o"})
+    db.replace("foo", "5")
+    changed = db.fingerprint()
+    assert changed != original
+    assert changed == _fresh_copy(db).fingerprint()
+    assert db.fingerprint(names=["undefined", "foo"]) != subset
+    assert db.fingerprint(names=["undefined"]) == \
+        _fresh_copy(db).fingerprint(names=["undefined"])
+
+    db.rollback(token)
+    assert db.fingerprint() == original
+    assert db.fingerprint(names=["foo", "undefined"]) == subset
+    db["bar"] = "2"
+    assert db.fingerprint(names=["foo", "undefined"]) == subset
+    db.target = "s390x"
+    assert db.fingerprint(names=["foo", "undefined"]) != subset
@@ -0,0 +1,80 @@
+"""
+Test the multi-target specfile expansion.
+"""
+
+# pylint: disable=missing-function-docstring
+
+from norpm.batch import expand_spec
+from norpm.macro import MacroRegistry
+from norpm.multitarget import arch_dependent_macros, expand_spec_multitarget
+
+TARGETS = ["x86_64", "i686", "aarch64", "ppc64le", "s390x", "riscv64"]
+
+SPEC = """\
+%global common %{?fedora}
+Name: foo
+Version: 1.%common
+%ifarch x86_64 aarch64
+ExclusiveArch: x86_64 aarch64
+%endif
+%ifnarch %{ix86}
+Release: 1
+%else
+Release: 2
+%endif
+"""
+
+
+def _registry(target=None):
+    db = MacroRegistry()
+    db["fedora"] = "43"
+    db["ix86"] = "i386 i486 i586 i686"
+    if target:
+        db.target = target
+        db["_arch"] = target
+    return db
+
+
+def _expected(content, registries):
+    results = {}
+    for target in TARGETS:
+        db = registries[target]
+        db.target = target
+        results[target] = expand_spec("foo", content, db)
+    return results
+
+
+def _strip(results):
+    return {t: (r["tags"], r["error"]) for t, r in results.items()}
+
+
+def test_single_registry():
+    db = _registry()
+    results = expand_spec_multitarget("foo", SPEC, db, TARGETS)
+    expected = _expected(SPEC, {t: _registry() for t in TARGETS})
+    assert _strip(results) == _strip(expected)
+    # x86_64+aarch64, i686, and the rest
+    assert len({id(r) for r in results.values()}) == 3
+    assert results["x86_64"]["tags"]["exclusivearch"] == ["x86_64 aarch64"]
+    assert results["i686"]["tags"]["release"] == ["2"]
+    assert db.to_dict() == _registry().to_dict()
+
+
+def test_arch_registries():
+    registries = {t: _registry(t) for t in TARGETS}
+    assert arch_dependent_macros(registries.values()) == {"_arch"}
+
+    results = expand_spec_multitarget("foo", SPEC, registries, TARGETS)
+    assert len({id(r) for r in results.values()}) == 3
+
+    spec = SPEC + "Summary: built for %_arch\n"
+    results = expand_spec_multitarget("foo", spec, registries, TARGETS)
+    assert len({id(r) for r in results.values()}) == len(TARGETS)
+    assert _strip(results) == _strip(_expected(spec, registries))
+    for target, db in registries.items():
+        assert db.to_dict() == _registry(target).to_dict()
+
+    # redefined by the specfile, the result is still correct
+    spec = "%global _arch noarch\nSummary: %_arch\n%{!?_arch:Name: foo}\n"
+    results = expand_spec_multitarget("foo", spec, registries, TARGETS)
+    assert {r["tags"]["summary"][0] for r in results.values()} == {"noarch"}
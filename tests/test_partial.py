@@ -0,0 +1,129 @@
+"""
+Test the partial evaluation of specfiles.
+"""
+
+# pylint: disable=missing-function-docstring
+
+import os
+
+import norpm.partial
+from norpm.batch import _TagHooks
+from norpm.macro import MacroRegistry
+from norpm.partial import finish, partial_evaluate
+from norpm.specfile import ParserHooks, specfile_expand
+
+DATADIR = os.path.join(os.path.dirname(__file__), "full_spec_expansion")
+DYNAMIC = {"fedora", "dist", "_arch"}
+
+SPEC = """\
+%global static %{?python3_pkgversion}
+%if 0%{?fedora} >= 42
+%global new 1
+%endif
+%if %static
+Name: foo
+%else
+Name: bar
+%endif
+Release: 1%{?dist}
+Summary: %{name} %{release} %{?new:new}
+%ifarch s390x
+BuildArch: noarch
+%endif
+%description
+%{static} %{?new}
+"""
+
+
+def _registry(fedora=None, target="x86_64"):
+    db = MacroRegistry()
+    db.target = target
+    db["_arch"] = target
+    db["python3_pkgversion"] = "3"
+    if fedora:
+        db["fedora"] = fedora
+        db["dist"] = ".fc" + fedora
+    return db
+
+
+def _check(residual, text, db_args):
+    expected_db = _registry(*db_args)
+    expected_hooks = _TagHooks()
+    expected = specfile_expand(text, expected_db, expected_hooks)
+    db = _registry(*db_args)
+    hooks = _TagHooks()
+    assert finish(residual, db, hooks) == expected
+    assert hooks.tags == expected_hooks.tags
+    assert db.to_dict() == expected_db.to_dict()
+
+
+def test_partial_spec():
+    db = _registry()
+    residual = partial_evaluate(SPEC, db, DYNAMIC)
+    assert db.to_dict() == _registry().to_dict()
+    # the %if conditions, %global new, %{?dist}, Summary (reads %release and
+    # %new), %{?new}, and the %ifarch block
+    snippets = [op[1][0].snippet.text for op in residual.ops
+                if op[0] == "entry"]
+    assert "%if %static" not in snippets
+    assert "%{static}" not in snippets
+    assert "%{?new}" in snippets
+    assert residual.entries == len(snippets) < len(residual.ir) / 2
+    for db_args in [(None,), ("42",), ("41", "s390x"), ("43", "aarch64")]:
+        _check(residual, SPEC, db_args)
+
+
+def test_partial_fallback(monkeypatch):
+    calls = []
+    monkeypatch.setattr(norpm.partial, "execute",
+                        lambda *args: calls.append(args) or "")
+    spec = "%{?fedora}%if 1\nfoo\n%endif\n"
+    residual = partial_evaluate(spec, _registry(), DYNAMIC)
+    finish(residual, _registry("42"))
+    assert not calls
+    db = _registry()
+    db["fedora"] = "#"
+    finish(residual, db)
+    assert len(calls) == 1
+
+
+def test_partial_full_specs():
+    for filename in sorted(os.listdir(DATADIR)):
+        if not filename.endswith(".spec"):
+            continue
+        with open(os.path.join(DATADIR, filename), "r", encoding="utf8") as fd:
+            text = fd.read()
+        residual = partial_evaluate(text, _registry(), DYNAMIC)
+        assert residual.ops is not None
+        for db_args in [(None,), ("43",), ("42", "s390x")]:
+            _check(residual, text, db_args)
+
+
+def test_partial_undefine():
+    spec = "%undefine fedora\nRelease: 1%{?fedora}\n"
+    residual = partial_evaluate(spec, _registry(), DYNAMIC)
+    for db_args in [(None,), ("42",)]:
+        _check(residual, spec, db_args)
+
+
+def test_partial_full_hooks(monkeypatch):
+    calls = []
+    monkeypatch.setattr(norpm.partial, "execute",
+                        lambda *args: calls.append(args) or "")
+    residual = partial_evaluate(SPEC, _registry(), DYNAMIC)
+
+    class _ReadHooks(ParserHooks):
+        track_reads = True
+
+    class _SniffHooks(ParserHooks):
+        sniff_mode = True
+
+    class _ConditionHooks(ParserHooks):
+        def condition_found(self, iftype, expression, definitions):
+            return expression
+
+    for hooks in [_ReadHooks(), _SniffHooks(), _ConditionHooks()]:
+        finish(residual, _registry("42"), hooks)
+    assert len(calls) == 3
+    finish(residual, _registry("42"), _TagHooks())
+    assert len(calls) == 3
@@ -0,0 +1,109 @@
+"""
+Test recording the macro read-sets.
+"""
+
+# pylint: disable=missing-function-docstring
+
+from norpm.batch import expand_spec
+from norpm.compiled import compile_spec, execute
+from norpm.macro import MacroRegistry
+from norpm.specfile import (
+    READ_TARGET,
+    ParserHooks,
+    definition_version,
+    specfile_expand,
+)
+
+SPEC = """\
+%global rel %{?dist}1
+Name: foo
+%if 0%{?fedora} > 40
+Version: %{bar 1}
+%endif
+%ifarch x86_64
+Release: %rel
+%endif
+Summary: %name %{expand:%baz}
+%pm a b
+%description
+"""
+
+
+class _Hooks(ParserHooks):
+    track_reads = True
+
+    def __init__(self):
+        self.tags = {}
+        self.spec = None
+
+    def tag_reads(self, name, value, reads):
+        self.tags[name] = reads
+
+    def spec_reads(self, reads):
+        self.spec = reads
+
+
+def _registry():
+    db = MacroRegistry()
+    db.target = "x86_64"
+    db["fedora"] = "43"
+    db["bar"] = ("%1.%z", "")
+    db["pm"] = ("[%*]", "")
+    return db
+
+
+def test_tag_reads():
+    db = _registry()
+    fedora = definition_version(db["fedora"].stack[-1])
+    hooks = _Hooks()
+    specfile_expand(SPEC, db, hooks, cache=False)
+    assert hooks.tags["name"] == {}
+    # the condition reads are included
+    assert set(hooks.tags["version"]) == {"fedora", "bar", "z"}
+    assert hooks.tags["version"]["fedora"] == {fedora}
+    assert hooks.tags["version"]["z"] == {None}
+    # indirectly through %rel
+    assert set(hooks.tags["release"]) == {READ_TARGET, "rel", "dist"}
+    assert hooks.tags["release"][READ_TARGET] == {"x86_64"}
+    assert set(hooks.tags["summary"]) == {"name", "baz"}
+    assert set(hooks.spec) == {READ_TARGET, "bar", "baz", "description",
+                               "dist", "fedora", "name", "pm", "rel", "z"}
+
+
+def test_reads_compiled():
+    expected = _Hooks()
+    specfile_expand(SPEC, _registry(), expected, cache=False)
+    hooks = _Hooks()
+    execute(compile_spec(SPEC), _registry(), hooks)
+    assert hooks.tags == expected.tags
+    assert hooks.spec == expected.spec
+
+
+def test_reads_batch():
+    db = _registry()
+    result = expand_spec("foo", SPEC, db, reads=True)
+    assert result["reads"]["dist"] == [None]
+    assert "reads" not in expand_spec("foo", SPEC, db)
+    result = expand_spec("foo", "%global a -%a\n%a\n", db, reads=True)
+    assert result["error"] and result["reads"] is None
+
+
+def test_reads_undefine():
+    hooks = _Hooks()
+    db = _registry()
+    db["dist"] = ".fc42"
+    specfile_expand("%undefine dist\nName: foo\n", db, hooks)
+    assert "dist" in hooks.spec
+
+
+def test_reads_lines_in_one_piece():
+    """ The tag lines in one expanded piece don't share the read sets """
+    hooks = _Hooks()
+    db = _registry()
+    db["foo"] = "foo"
+    db["bar"] = "bar"
+    specfile_expand("Name: %{foo}\nVersion: 1\nRelease: 2\nSummary: %bar\n"
+                    "License: MIT\n", db, hooks)
+    assert {tag: sorted(reads) for tag, reads in hooks.tags.items()} == {
+        "name": ["foo"], "version": [], "release": [], "summary": ["bar"],
+        "license": []}
@@ -0,0 +1,92 @@
+"""
+Test the SQLite results store.
+"""
+
+# pylint: disable=missing-function-docstring
+
+import json
+import sqlite3
+
+import pytest
+
+from norpm.batch import RegistryConfig, batch_expand
+from norpm.cli import batch as batch_cli
+from norpm.cli import results as results_cli
+from norpm.results import ResultsStore, digesting
+
+SPECS = [
+    ("foo.spec", "Name: foo\n%if 0%{?fedora} > 42\nExclusiveArch: x86_64\n"
+                 "%endif\n"),
+    ("bar.spec", "Name: bar\nExclusiveArch: s390x\n"),
+    ("broken.spec", "Name: broken\n%if 0%{?fedora} > 42\n%global a -%a\n%a\n"
+                    "%endif\n"),
+]
+
+
+def _run(store, fedora, label, tags=None):
+    config = RegistryConfig(arch="x86_64", prefix="/nonexistent",
+                            defines=(("fedora", fedora),))
+    run = store.start_run(config.build(), label, tags)
+    digests = {}
+    results = batch_expand(digesting(SPECS, digests), config, processes=1,
+                           tags=tags)
+    assert len(list(store.record(run, results, digests, batch_size=2))) == 3
+    return run
+
+
+def test_results_store(tmp_path):
+    store = ResultsStore(str(tmp_path / "results.db"))
+    old = _run(store, "42", "f42")
+    new = _run(store, "43", "f43")
+    again = _run(store, "43", None)
+    assert [run[:2] for run in store.runs()] == \
+        [(old, "f42"), (new, "f43"), (again, None)]
+    assert store.changed(old, new, "exclusivearch") == \
+        [("foo.spec", None, ["x86_64"])]
+    assert store.changed(old, new, "name") == []
+    changed = store.changed(old, new)
+    assert [spec for spec, _, _ in changed] == ["broken.spec"]
+    assert changed[0][1] is None
+    # the third run re-uses the rows of the second one
+    count = store.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+    assert count == 6
+    assert store.changed(new, again, "exclusivearch") == []
+    store.close()
+
+
+def test_results_settings(tmp_path):
+    path = str(tmp_path / "results.db")
+    store = ResultsStore(path)
+    # the rows gathering fewer tags are not re-used
+    old = _run(store, "42", "names", tags=["name"])
+    new = _run(store, "42", "all")
+    newer = _run(store, "43", "all")
+    assert store.changed(old, new, "exclusivearch") == \
+        [("bar.spec", None, ["s390x"])]
+    assert store.changed(new, newer, "exclusivearch") == \
+        [("foo.spec", None, ["x86_64"])]
+    store.close()
+
+    # databases with an older schema are refused
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA user_version = 0")
+    conn.close()
+    with pytest.raises(ValueError, match="incompatible"):
+        ResultsStore(path)
+
+
+def test_results_cli(tmp_path, write_specs, run_cli):
+    foo, bar, _ = write_specs(SPECS)
+    database = str(tmp_path / "results.db")
+    for fedora in ["42", "43"]:
+        run_cli(batch_cli._main, [
+            "norpm-batch", "-j1", "--prefix", "/nonexistent", "--arch",
+            "x86_64", "--define", "fedora", fedora, "--store", database,
+            foo, bar])
+    lines = run_cli(results_cli._main, ["norpm-results", database, "changed",
+                                        "1", "2", "--tag", "exclusivearch"])
+    assert [json.loads(line) for line in lines] == [{
+        "spec": foo, "tag": "exclusivearch", "old": None,
+        "new": ["x86_64"]}]
+    assert len(run_cli(results_cli._main,
+                       ["norpm-results", database, "runs"])) == 2
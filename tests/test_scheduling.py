@@ -0,0 +1,104 @@
+"""
+Test the timing-aware scheduling of the batch expansion.
+"""
+
+# pylint: disable=missing-function-docstring
+
+import json
+from unittest import mock
+
+from norpm.batch import batch_expand, forkserver_expand
+from norpm.cli import batch as batch_cli
+from norpm.scheduling import TimingHistory, schedule
+
+SPECS = [(f"spec{i}", f"Name: spec{i}\n") for i in range(6)]
+
+
+def test_schedule():
+    specs = list("abcdef")
+    estimates = [0.01, 2.0, None, 0.01, 1.0, 0.01]
+    batches = schedule(specs, estimates, 2)
+    # longest first, the cheap ones (the unknown "c" is median) grouped
+    assert batches == [["b"], ["e"], ["a", "c", "d", "f"]]
+    assert schedule(specs, estimates, 2, max_batch=3)[2:] == \
+        [["a", "c", "d"], ["f"]]
+    assert schedule(specs, [None] * 6, 4) == [[s] for s in specs]
+
+
+def test_timing_history(tmp_path):
+    path = str(tmp_path / "timings.json")
+    history = TimingHistory(path)
+    history.record("a", "digest", 1.5, 100)
+    history.record("b", "digest", None)
+    history.save()
+    history = TimingHistory(path)
+    assert history.estimate("a", "digest", 100) == 1.5
+    # the changed specfile is scaled by size
+    assert history.estimate("a", "changed", 200) == 3.0
+    assert history.estimate("a", "changed") == 1.5
+    assert history.estimate("b", "digest") is None
+    # the histories without sizes
+    history.timings["c"] = ["digest", 2.0]
+    assert history.estimate("c", "changed", 10) == 2.0
+
+
+def test_timings_skip_cached(config, result_cache):
+    cache = result_cache(store_text=False)
+    history = TimingHistory()
+    list(batch_expand(SPECS, config, processes=1, cache=cache,
+                      timings=history))
+    history.timings = {}
+    results = list(batch_expand(SPECS, config, processes=1, cache=cache,
+                                timings=history))
+    assert all(r["cached"] for r in results)
+    assert not history.timings
+
+
+def test_scheduled_expand(tmp_path, config):
+    history = TimingHistory(str(tmp_path / "timings.json"))
+    history.record("spec4", "old", 10.0)
+    history.record("spec0", "old", 0.001)
+    history.record("spec1", "old", 0.001)
+    for expand in [batch_expand, forkserver_expand]:
+        for processes in [1, 2]:
+            results = list(expand(SPECS, config, processes=processes,
+                                  timings=history))
+            assert sorted(r["spec"] for r in results) == \
+                [name for name, _ in SPECS]
+            if processes == 1 and expand is batch_expand:
+                assert results[0]["spec"] == "spec4"
+    assert set(history.timings) == {name for name, _ in SPECS}
+    assert history.timings["spec4"][1] < 10.0
+
+
+
+def test_scheduled_stream(tmp_path, config):
+    """ The scheduling doesn't read the whole input stream first """
+    history = TimingHistory(str(tmp_path / "timings.json"))
+    history.record("spec3", "old", 10.0)
+    consumed = []
+
+    def _stream():
+        for name, content in SPECS:
+            consumed.append(name)
+            yield name, content
+
+    with mock.patch("norpm.batch.SCHEDULE_WINDOW", 3):
+        results = batch_expand(_stream(), config, processes=1,
+                               timings=history)
+        assert next(results)["spec"] == "spec0"
+        assert consumed == ["spec0", "spec1", "spec2"]
+        # the expensive spec3 goes first within the second window
+        assert [r["spec"] for r in results] == \
+            ["spec1", "spec2", "spec3", "spec4", "spec5"]
+    assert set(history.timings) == {name for name, _ in SPECS}
+
+
+def test_scheduled_cli(tmp_path, write_specs, run_cli):
+    write_specs(SPECS)
+    timings = tmp_path / "timings.json"
+    argv = ["norpm-batch", "-j1", "--prefix", "/nonexistent",
+            "--timings", str(timings), str(tmp_path)]
+    assert len(run_cli(batch_cli._main, argv)) == 6
+    with open(timings, "r", encoding="utf-8") as fd:
+        assert len(json.load(fd)) == 6
@@ -0,0 +1,148 @@
+"""
+Test splitting the batch expansion across nodes.
+"""
+
+# pylint: disable=missing-function-docstring
+
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from unittest import mock
+
+import pytest
+
+from norpm.batch import batch_expand, read_specfile
+from norpm.cli import batch as batch_cli
+from norpm.cli import merge_results as merge_cli
+from norpm.sharding import WorkQueue, in_shard, merge_results, parse_shard
+
+SPECS = [(f"spec{i}.spec", f"Name: spec{i}\n") for i in range(20)]
+
+
+def test_shards():
+    assert parse_shard("1/3") == (1, 3)
+    for invalid in ["3/3", "x", "1/2/3"]:
+        with pytest.raises(ValueError):
+            parse_shard(invalid)
+    shards = [[name for name, _ in in_shard(SPECS, i, 3)] for i in range(3)]
+    assert sorted(sum(shards, [])) == sorted(name for name, _ in SPECS)
+    assert all(shards)
+    # the directory doesn't matter
+    moved = [("/elsewhere/" + name, content) for name, content in SPECS]
+    assert [os.path.basename(name) for name, _ in in_shard(moved, 0, 3)] == \
+        shards[0]
+
+
+def _worker(directory, paths, worker, config):
+    queue = WorkQueue(directory, worker)
+    queue.populate(paths)
+    specs, finish = queue.claims(read_specfile, 2)
+    with open(queue.results_file(), "w", encoding="utf-8") as fd:
+        for result in finish(batch_expand(specs, config, processes=1)):
+            fd.write(json.dumps(result) + "\n")
+
+
+def test_work_queue(tmp_path, config, write_specs):
+    paths = write_specs(SPECS)
+    queue_dir = str(tmp_path / "queue")
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_worker,
+                               args=(queue_dir, paths, f"worker{i}", config))
+               for i in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+
+    results = merge_results([os.path.join(queue_dir, "results")])
+    assert [r["spec"] for r in results] == sorted(paths)
+    # each item was claimed exactly once
+    lines = 0
+    for filename in os.listdir(os.path.join(queue_dir, "results")):
+        with open(os.path.join(queue_dir, "results", filename),
+                  encoding="utf-8") as fd:
+            lines += len(fd.readlines())
+    assert lines == len(paths)
+    assert len(os.listdir(os.path.join(queue_dir, "done"))) == len(paths)
+    assert not os.listdir(os.path.join(queue_dir, "todo"))
+    assert not os.listdir(os.path.join(queue_dir, "claimed"))
+
+
+def test_sharding_cli(tmp_path, write_specs, run_cli):
+    write_specs(SPECS)
+    common = ["norpm-batch", "-j1", "--prefix", "/nonexistent"]
+    outputs = []
+    for shard in ["0/2", "1/2"]:
+        lines = run_cli(batch_cli._main,
+                        common + ["--shard", shard, str(tmp_path)])
+        outputs.append(tmp_path / f"shard{shard[0]}.jsonl")
+        outputs[-1].write_text("".join(line + "\n" for line in lines),
+                               encoding="utf-8")
+
+    queue = str(tmp_path / "queue")
+    queued = []
+    for _ in range(2):
+        queued += run_cli(batch_cli._main,
+                          common + ["--queue", queue, str(tmp_path)])
+    assert len(queued) == len(SPECS)
+
+    sharded = run_cli(merge_cli._main, ["norpm-merge-results"] +
+                      [str(path) for path in outputs])
+    queued = run_cli(merge_cli._main, ["norpm-merge-results",
+                                       os.path.join(queue, "results")])
+    assert len(sharded) == len(queued) == len(SPECS)
+    assert [json.loads(line)["tags"] for line in sharded] == \
+        [json.loads(line)["tags"] for line in queued]
+
+
+def test_queue_resume_rejected(tmp_path):
+    argv = ["norpm-batch", "--queue", str(tmp_path / "queue"),
+            "--checkpoint", str(tmp_path / "cp.jsonl"), "--resume",
+            str(tmp_path)]
+    with mock.patch("sys.argv", argv):
+        with pytest.raises(SystemExit) as exc:
+            batch_cli._main()
+    assert exc.value.code == 2
+    assert not os.path.exists(tmp_path / "queue")
+
+
+def test_queue_fork_server_batches(tmp_path, write_specs):
+    """ The claim window covers the batches held by the fork server """
+    write_specs(SPECS)
+    queue = str(tmp_path / "queue")
+    subprocess.run([sys.executable, "-m", "norpm.cli.batch", "--prefix",
+                    "/nonexistent", "--queue", queue, "--fork-server",
+                    "--batch-size", "4", "-j", "2", str(tmp_path)],
+                   check=True, timeout=120, stdout=subprocess.DEVNULL)
+    assert len(merge_results([os.path.join(queue, "results")])) == len(SPECS)
+
+
+def test_queue_reclaim(tmp_path, write_specs):
+    paths = write_specs(SPECS[:3])
+    directory = str(tmp_path / "queue")
+    crashed = WorkQueue(directory, "crashed")
+    crashed.populate(paths)
+    crashed.claim()
+    crashed.claim()
+
+    # the stale claims are taken over once the todo is empty
+    other = WorkQueue(directory, "other", stale_after=0)
+    time.sleep(1.1)
+    names = []
+    while (claimed := other.claim()) is not None:
+        names.append(claimed[1])
+        other.done(claimed[0])
+    assert sorted(names) == sorted(paths)
+
+    # the restarted worker re-claims its own items immediately
+    crashed = WorkQueue(str(tmp_path / "queue2"), "crashed")
+    crashed.populate(paths)
+    crashed.claim()
+    restarted = WorkQueue(str(tmp_path / "queue2"), "crashed")
+    specs, finish = restarted.claims(read_specfile, 2)
+    assert len(list(finish({"spec": name} for name, _ in specs))) == 3
+    assert not os.listdir(restarted.claimed)
@@ -607,3 +607,71 @@ def test_modifier_parsing_in_macrofile():
 
     parts = list(macrofile_split_generator("%baz(p:)<lo> body\n"))
     assert parts == [("baz", "body", "p:", {'l', 'o'})]
+
+
+def test_alias_chain():
+    """Single-call results are expanded in place, not by pushing generators"""
+    db = MacroRegistry()
+    db["alias0"] = "%{?dist}end"
+    for i in range(1, 900):
+        db[f"alias{i}"] = f"%{{alias{i-1}}}" if i % 2 else f"%alias{i-1}"
+    assert specfile_expand_string("%alias899 %{alias1}", db) == "end end"
+
+
+def test_plain_text_result_quoted():
+    db = MacroRegistry()
+    db["plain"] = "%{quote:a b}"
+    db["args"] = "%{quote:a b} c"
+    db["two"] = "%{quote:%{plain}} %plain"
+    assert specfile_expand_string("%define count() %#\n%count %plain %args %two", db) == "5"
+
+
+def test_recursion_cycle():
+    db = MacroRegistry()
+    db.known_norpm_hacks()
+    db["foo"] = "a %{?bar}"
+    db["bar"] = "b %{baz}"
+    db["baz"] = "c %foo"
+    with pytest.raises(NorpmRecursionError) as err:
+        specfile_expand_string("%foo", db)
+    assert err.value.cycle == ["foo", "bar", "baz", "foo"]
+
+    db.clear("optflags")
+    with pytest.raises(NorpmRecursionError) as err:
+        specfile_expand("%global optflags --foo %optflags\n%optflags\n", db)
+    assert err.value.cycle == ["optflags", "optflags"]
+
+    db["oneshot"] = ("x %oneshot", None, {"o"})
+    with pytest.raises(NorpmRecursionError) as err:
+        specfile_expand_string("%oneshot", db)
+    assert err.value.cycle == ["oneshot", "oneshot"]
+
+
+def test_recursion_false_positives():
+    db = MacroRegistry()
+    db["foo"] = "v"
+    db["wrap"] = "%{?wrap:%{?foo:%foo}}"
+    assert specfile_expand_string("%wrap", db) == "v"
+    db["self"] = "%self"
+    assert specfile_expand_string("%self", db) == "%self"
+    db["lazy"] = "%{global lazy computed}%lazy"
+    assert specfile_expand_string("%lazy", db) == "computed"
+
+
+def test_preamble_end_in_expansion():
+    db = MacroRegistry()
+    db["d"] = "%%description\nfoo\nbar"
+    assert specfile_expand("Name: x\n%d\n", db) == \
+        "Name: x\n%description\nfoo\nbar\n"
+
+
+def test_preamble_end_lines_emitted_once():
+    """
+    The lines following the preamble terminator in the same expanded piece
+    are emitted once, and not interpreted as tags.
+    """
+    db = MacroRegistry()
+    db["desc"] = "%%description\nVersion: 2\nbar"
+    assert specfile_expand("Name: foo\n%desc\nbaz\n", db) == \
+        "Name: foo\n%description\nVersion: 2\nbar\nbaz\n"
+    assert "version" not in db
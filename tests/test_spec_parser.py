@@ -2,6 +2,7 @@
 Test rpmmacro parsing in spec-files.
 """
 
+from norpm import specfile
 from norpm.specfile import specfile_split
 from norpm.macro import MacroRegistry
 
@@ -87,3 +88,37 @@ def test_tricky_macros():
 def test_parse_tabelators():
     macros = MacroRegistry()
     assert specfile_split("%global\tfoo\t\tbar\n", macros) == ["%global\tfoo\t\tbar"]
+
+
+def test_snippet_classification():
+    # pylint: disable=protected-access
+    classify = specfile._classify_snippet
+    assert classify("%if 0%{?rhel}", True).kind == "condition"
+    assert classify("%if 0%{?rhel}", True).params == " 0%{?rhel}"
+    assert classify("%if 0%{?rhel}", False).kind == "call"
+    assert classify("%ifarch x86_64", True).name == "%ifarch"
+    assert classify("%iffoo", True).name == "iffoo"
+    assert classify("%else # comment", True).kind == "else"
+    assert classify("%else%foo", True).kind == "invalid"
+    assert classify("%endif", False).kind == "endif"
+    assert classify("%setup", True).kind == "special"
+    assert classify("%{define foo(a:)<l> 1}", True).definition == \
+        ("foo", "1", "a:", {"l"})
+    assert classify("%[1 + 1]", True).params == "1 + 1"
+    assert classify("%{?!foo:bar}", True) == specfile._ClassifiedSnippet(
+        "call", "foo", {"?", "!"}, [], "bar")
+    assert classify("%{ foo}", True).kind == "invalid"
+    assert classify("%{?!foo:bar}", True) is classify("%{?!foo:bar}", True)
+
+
+def test_definition_header_parser():
+    # pylint: disable=protected-access
+    parse = specfile._parse_definition
+    assert parse("foo  %bar ") == ("foo", "%bar ", None, set())
+    assert parse("foo(d:)<l> <o> a\\\nb") == ("foo", "a\\\nb", "d:", {"l", "o"})
+    assert parse("foo \nbody") == ("foo", "\nbody", None, set())
+    # let the macrofile parser handle the complicated cases
+    assert parse("foo") is None
+    assert parse("%{name}_foo 1") is None
+    assert parse("fo(o 1") is None
+    assert parse("foo \\\\<l> 1") is None
@@ -0,0 +1,81 @@
+"""
+Test the symbolic evaluation of specfile conditions.
+"""
+
+# pylint: disable=missing-function-docstring
+
+from norpm.batch import expand_spec
+from norpm.macro import MacroRegistry
+from norpm.symbolic import VariableSpace, specfile_expand_symbolic
+
+VARIABLES = {"fedora": [None, "41", "42", "43"], "rhel": [None, "9"]}
+TARGETS = ["x86_64", "aarch64", "s390x"]
+
+SPEC = """\
+Name: foo
+%define newer %[ 0%{?fedora} >= 42 ]
+%if %newer
+Release: 2
+%else
+Release: 1
+%endif
+%ifarch x86_64 aarch64
+ExclusiveArch: x86_64 aarch64
+%endif
+%if 0%{?rhel}
+%ifnarch s390x %{_arch}
+BuildArch: noarch
+%endif
+%if "%_arch" == "s390x"
+Summary: mainframe
+%endif
+%endif
+"""
+
+
+def _registry():
+    db = MacroRegistry()
+    db.target = "x86_64"
+    db["_arch"] = "x86_64"
+    return db
+
+
+def test_symbolic_tags():
+    db = _registry()
+    tags = specfile_expand_symbolic(SPEC, db, VARIABLES, TARGETS)
+    assert db.to_dict() == _registry().to_dict()
+
+    assert [(v, str(p)) for v, p in tags["release"]] == [
+        ("2", "%fedora in {42, 43}"),
+        ("1", "%fedora in {undefined, 41}"),
+    ]
+    assert [(v, str(p)) for v, p in tags["exclusivearch"]] == [
+        ("x86_64 aarch64", "target in {x86_64, aarch64}"),
+    ]
+    (value, predicate), = tags["buildarch"]
+    assert value == "noarch"
+    assert predicate.never  # %_arch is always the target
+    (_, predicate), = tags["summary"]
+    assert str(predicate) == "target == s390x && %rhel == 9"
+    assert predicate.values("target") == {"s390x"}
+    assert tags["name"][0][1].always
+
+
+def test_symbolic_matches_concrete():
+    """ Check the predicates against the concrete expansion in every world """
+    tags = specfile_expand_symbolic(SPEC, _registry(), VARIABLES, TARGETS)
+    space = VariableSpace(VARIABLES, TARGETS)
+    for world in space.true.worlds():
+        db = _registry()
+        db.target = db["_arch"] = world["target"]
+        for name in VARIABLES:
+            db.clear(name)
+            if world["%" + name] is not None:
+                db[name] = world["%" + name]
+        concrete = expand_spec("foo", SPEC, db)["tags"]
+        expected = {}
+        for tag, values in tags.items():
+            for value, predicate in values:
+                if predicate.holds(world):
+                    expected.setdefault(tag, []).append(value)
+        assert concrete == expected, world
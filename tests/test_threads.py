@@ -0,0 +1,68 @@
+"""
+Expand independent registries in parallel threads.
+"""
+
+# pylint: disable=missing-function-docstring
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+
+from norpm.getopt import getopt, libc_getopt
+from norpm.macro import MacroRegistry
+from norpm.specfile import specfile_expand, specfile_expand_string
+
+DATADIR = os.path.join(os.path.dirname(__file__), "full_spec_expansion")
+
+PARAMETRIC = """\
+%define opts(ab:c::) %{-a:A}%{-b:B=%{-b*}}%{-c:C=%{-c*}}:%*
+%global num %[ 1 + %{?fedora}%{!?fedora:0} ]
+Name: foo%num
+Release: %{opts -a -b x y -cz}
+"""
+
+
+def _specs():
+    specs = []
+    for filename in sorted(os.listdir(DATADIR)):
+        if filename.endswith(".spec"):
+            with open(os.path.join(DATADIR, filename), "r",
+                      encoding="utf8") as fd:
+                specs.append(fd.read())
+    return specs + [PARAMETRIC]
+
+
+def _expand(content):
+    db = MacroRegistry()
+    db.define("fedora", "43")
+    expanded = specfile_expand(content, db)
+    return expanded, specfile_expand_string("%{name}-%{release}", db)
+
+
+def test_threaded_expansion():
+    specs = _specs() * 16
+    random.Random(0).shuffle(specs)
+    expected = [_expand(spec) for spec in specs]
+    assert _expand(PARAMETRIC)[1] == "foo44-AB=xC=z:y"
+    with ThreadPoolExecutor(8) as executor:
+        assert list(executor.map(_expand, specs)) == expected
+
+
+def test_getopt_matches_libc():
+    rand = random.Random(0)
+    optstrings = ["ab:c::", ":-:", "-ab:", "+ab:", ":ab:", "", "a;b", "-"]
+    tokens = ["-a", "-b", "-ab", "-bfoo", "-c", "-cfoo", "foo", "--", "-",
+              "-x", "-:", "--a"]
+    for optstring in optstrings:
+        for _ in range(300):
+            params = [rand.choice(tokens) for _ in range(rand.randint(0, 5))]
+            assert getopt(params, optstring) == \
+                libc_getopt(params, optstring), (params, optstring)
+
+
+def test_getopt_threads():
+    params = ["-a", "x", "-bfoo", "y", "-c", "--", "-a"]
+    expected = ([("-a", ""), ("-b", "foo"), ("-c", "")], ["x", "y", "-a"])
+    with ThreadPoolExecutor(8) as executor:
+        results = executor.map(lambda _: getopt(params, "ab:c::"), range(500))
+        assert all(result == expected for result in results)
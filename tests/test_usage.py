@@ -0,0 +1,105 @@
+"""
+Test the corpus-wide macro usage index.
+"""
+
+# pylint: disable=missing-function-docstring
+
+import json
+import os
+from unittest import mock
+
+from norpm.batch import RegistryConfig
+from norpm.cli import usage_index as usage_cli
+from norpm.macro import MacroRegistry
+from norpm.specfile import READ_TARGET
+from norpm.usage import UsageIndex, registry_changes, reevaluate, update_index
+
+SPECS = {
+    "foo.spec": "Name: foo\n%global ver 1.%{?fedora}\nVersion: %ver\n",
+    "bar.spec": "Name: bar\nVersion: 2\n%ifarch x86_64\nBuildArch: noarch\n"
+                "%endif\n",
+    "baz.spec": "Name: baz\nLicense: %{?license_tag}\n",
+    "broken.spec": "%define foo %bar\n%define bar %foo\nName: %foo\n",
+}
+
+
+def _config(**defines):
+    return RegistryConfig(arch="x86_64", prefix="/nonexistent",
+                          defines=tuple(defines.items()))
+
+
+def _index(specs):
+    index = UsageIndex()
+    results = list(update_index(index, specs, _config(fedora="42"),
+                                processes=1))
+    assert len(results) == len(specs)
+    return index
+
+
+def test_usage_index():
+    specs = sorted(SPECS.items())
+    index = _index(specs)
+    assert index.readers({"fedora"}) == {"foo.spec"}
+    assert index.readers({READ_TARGET, "license_tag"}) == \
+        {"bar.spec", "baz.spec"}
+    assert index.failed == {"broken.spec"}
+    again = UsageIndex.from_dict(json.loads(json.dumps(index.to_dict())))
+    assert again.to_dict() == index.to_dict()
+
+    affected = [name for name, _ in index.affected(specs, {"fedora"})]
+    assert affected == ["broken.spec", "foo.spec"]
+    specs[0] = ("bar.spec", "Name: bar\n")
+    affected = [name for name, _ in index.affected(specs, set())]
+    assert affected == ["bar.spec", "broken.spec"]
+
+
+def test_registry_changes():
+    old = MacroRegistry()
+    old["a"] = "1"
+    old["b"] = "2"
+    new = MacroRegistry()
+    new["a"] = "1"
+    new["b"] = "3"
+    new["c"] = "4"
+    assert registry_changes(old, new) == {"b", "c"}
+    new.target = "s390x"
+    assert registry_changes(old, new) == {"b", "c", READ_TARGET}
+
+
+def test_reevaluate():
+    specs = sorted(SPECS.items())
+    index = _index(specs)
+    results = list(reevaluate(index, specs, _config(fedora="42"),
+                              _config(fedora="43"), processes=1))
+    assert [r["spec"] for r in results] == ["broken.spec", "foo.spec"]
+    assert results[1]["tags"]["version"] == ["1.43"]
+    # nothing read changed
+    results = list(reevaluate(index, specs, _config(fedora="43"),
+                              _config(fedora="43", unrelated="1"),
+                              processes=1))
+    assert [r["spec"] for r in results] == ["broken.spec"]
+
+
+def test_usage_index_cli(tmp_path, capsys):
+    for name, content in SPECS.items():
+        (tmp_path / name).write_text(content, encoding="utf8")
+    index = str(tmp_path / "index.json.gz")
+    common = [str(tmp_path), "--index", index, "-j", "1",
+              "--prefix", "/nonexistent", "--arch", "x86_64"]
+    with mock.patch("sys.argv", ["norpm-usage-index", "build"] + common +
+                    ["--define", "fedora", "42"]):
+        assert usage_cli._main() == 0
+    assert len(capsys.readouterr().out.splitlines()) == 4
+    assert UsageIndex.load(index).readers({"fedora"}) == \
+        {os.path.join(str(tmp_path), "foo.spec")}
+
+    with mock.patch("sys.argv", ["norpm-usage-index", "diff"] + common +
+                    ["--old-prefix", "/nonexistent", "--old-arch", "x86_64",
+                     "--old-define", "fedora", "42",
+                     "--define", "fedora", "43"]):
+        assert usage_cli._main() == 0
+    results = [json.loads(line)
+               for line in capsys.readouterr().out.splitlines()]
+    assert sorted(os.path.basename(r["spec"]) for r in results) == \
+        ["broken.spec", "foo.spec"]
+    assert "reads" not in results[0]